@@ -50,6 +50,10 @@ class LbaasAgentService(rpc_service.Service):
             None
         )
 
+    def stop(self):
+        self.manager.stop()
+        super(LbaasAgentService, self).stop()
+
 
 def main():
     eventlet.monkey_patch()
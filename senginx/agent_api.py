@@ -16,18 +16,53 @@
 #
 # @author: Mark McClain, DreamHost
 
+from neutron.openstack.common import log as logging
+from neutron.openstack.common.rpc import common as rpc_common
 from neutron.openstack.common.rpc import proxy
 
+LOG = logging.getLogger(__name__)
+
+# pools listed by each get_ready_devices call
+READY_DEVICES_PAGE = 1000
+
 
 class LbaasAgentApi(proxy.RpcProxy):
     """Agent side of the Agent to Plugin RPC API."""
 
     API_VERSION = '1.0'
+    # history
+    #   1.0 Initial version
+    #   1.1 Support get_logical_devices call
+    #   1.2 Support revisions in get_ready_devices call
+    #   1.3 Support update_pools_stats cast
+    #   1.4 Support update_member_statuses call
+    #   1.5 Support paging in get_ready_devices call
 
     def __init__(self, topic, context, host):
         super(LbaasAgentApi, self).__init__(topic, self.API_VERSION)
         self.context = context
         self.host = host
+        # API versions the server was found not to support
+        self.unsupported_versions = set()
+        # API versions the server answered a call for
+        self.supported_versions = set()
+
+    def _call_versioned(self, msg, version):
+        """Make a call needing a newer API, return None on older servers."""
+        if version in self.unsupported_versions:
+            return None
+        try:
+            result = self.call(self.context, msg, topic=self.topic,
+                               version=version)
+            self.supported_versions.add(version)
+            return result
+        except rpc_common.RemoteError as e:
+            if e.exc_type != 'UnsupportedRpcVersion':
+                raise
+            LOG.info(_('The server does not support the %s API, '
+                       'falling back to an older API'), version)
+            self.unsupported_versions.add(version)
+            return None
 
     def get_ready_devices(self):
         return self.call(
@@ -36,6 +71,46 @@ class LbaasAgentApi(proxy.RpcProxy):
             topic=self.topic
         )
 
+    def get_ready_device_revisions(self):
+        """Return {pool_id: revision} of the ready pools.
+
+        The revision is None when the server can't provide it. The pools
+        are listed a page at a time by the servers supporting it.
+        """
+        revisions = {}
+        marker = None
+        while True:
+            devices = self._call_versioned(
+                self.make_msg(
+                    'get_ready_devices',
+                    host=self.host,
+                    with_revisions=True,
+                    marker=marker,
+                    limit=READY_DEVICES_PAGE
+                ),
+                '1.5'
+            )
+            if devices is None:
+                break
+            revisions.update(
+                (pool_id, revision) for pool_id, revision in devices)
+            if len(devices) < READY_DEVICES_PAGE:
+                return revisions
+            marker = devices[-1][0]
+
+        devices = self._call_versioned(
+            self.make_msg(
+                'get_ready_devices',
+                host=self.host,
+                with_revisions=True
+            ),
+            '1.2'
+        )
+        if devices is not None:
+            return dict((pool_id, revision) for pool_id, revision in devices)
+
+        return dict((pool_id, None) for pool_id in self.get_ready_devices())
+
     def get_logical_device(self, pool_id):
         return self.call(
             self.context,
@@ -47,6 +122,28 @@ class LbaasAgentApi(proxy.RpcProxy):
             topic=self.topic
         )
 
+    def get_logical_devices(self, pool_ids):
+        """Return {pool_id: logical device}, ready pools only."""
+        devices = self._call_versioned(
+            self.make_msg(
+                'get_logical_devices',
+                pool_ids=pool_ids,
+                host=self.host
+            ),
+            '1.1'
+        )
+        if devices is not None:
+            return devices
+
+        devices = {}
+        for pool_id in pool_ids:
+            try:
+                devices[pool_id] = self.get_logical_device(pool_id)
+            except Exception:
+                LOG.exception(_('Unable to get logical device for pool: %s'),
+                              pool_id)
+        return devices
+
     def pool_destroyed(self, pool_id):
         return self.call(
             self.context,
@@ -79,3 +176,39 @@ class LbaasAgentApi(proxy.RpcProxy):
             ),
             topic=self.topic
         )
+
+    def update_pools_stats(self, pools_stats):
+        """Report {pool_id: stats} of several pools at once.
+
+        A cast is used once the server answered a first call for it, older
+        servers get one update_pool_stats call per pool.
+        """
+        msg = self.make_msg(
+            'update_pools_stats',
+            pools_stats=pools_stats,
+            host=self.host
+        )
+        if '1.3' in self.supported_versions:
+            return self.cast(self.context, msg, topic=self.topic,
+                             version='1.3')
+
+        if self._call_versioned(msg, '1.3') is not None:
+            return
+
+        for pool_id, stats in pools_stats.items():
+            self.update_pool_stats(pool_id, stats)
+
+    def update_member_statuses(self, statuses):
+        """Report {member_id: status} of the members whose health changed.
+
+        Returns False when the server does not support it.
+        """
+        result = self._call_versioned(
+            self.make_msg(
+                'update_member_statuses',
+                statuses=statuses,
+                host=self.host
+            ),
+            '1.4'
+        )
+        return result is not None
@@ -18,8 +18,13 @@
 # @author: Mark McClain, DreamHost
 # @author: Paul Yang, Neusoft
 
+import contextlib
+import os
+import time
 import weakref
 
+import eventlet
+from eventlet import semaphore
 from oslo.config import cfg
 
 from neutron.agent.common import config
@@ -27,9 +32,11 @@ from neutron.agent import rpc as agent_rpc
 from neutron.common import constants
 from neutron import context
 from neutron.openstack.common import importutils
+from neutron.openstack.common import jsonutils
 from neutron.openstack.common import log as logging
 from neutron.openstack.common import loopingcall
 from neutron.openstack.common import periodic_task
+from neutron.services.loadbalancer import constants as lb_const
 from neutron.services.loadbalancer.drivers.senginx import (
     agent_api,
     plugin_driver
@@ -59,8 +66,54 @@ OPTS = [
         default='root',
         help=_('The user group'),
     ),
+    cfg.IntOpt(
+        'sync_concurrency',
+        default=8,
+        help=_('Maximum number of pools refreshed concurrently during a '
+               'full sync'),
+    ),
+    cfg.IntOpt(
+        'sync_chunk_size',
+        default=200,
+        help=_('Number of logical devices fetched with a single RPC call '
+               'during a full sync'),
+    ),
+    cfg.FloatOpt(
+        'pool_work_debounce',
+        default=1.0,
+        help=_('Seconds to wait for more changes to a pool before '
+               'applying them'),
+    ),
+    cfg.FloatOpt(
+        'pool_work_max_delay',
+        default=10.0,
+        help=_('Maximum seconds a change to a pool can be delayed by '
+               'further changes'),
+    ),
 ]
 
+# number of slowest pools logged after a full sync
+SYNC_REPORT_SLOWEST = 5
+
+# shortest sleep of the pool work queue between two scans
+MIN_QUEUE_SLEEP = 0.05
+
+# seconds between two checks of the log sizes and ages
+LOG_ROTATE_INTERVAL = 60
+# seconds between the checks of the files the driver reads for the devices
+STALE_CHECK_INTERVAL = 60
+
+# largest number of pools reported in a single stats message
+STATS_BATCH_SIZE = 200
+
+# snapshot of the device cache in the state path
+CACHE_SNAPSHOT = 'devices.cache'
+CACHE_SNAPSHOT_VERSION = 1
+
+# vip fields never written to the snapshot, a device restored without them
+# is not adopted but fetched again
+SECRET_VIP_FIELDS = ('ssl_key',)
+
 
 class LogicalDeviceCache(object):
     """Manage a cache of known devices."""
@@ -81,6 +134,9 @@ class LogicalDeviceCache(object):
         self.devices = set()
         self.port_lookup = weakref.WeakValueDictionary()
         self.pool_lookup = weakref.WeakValueDictionary()
+        self.revisions = {}
+        self.configs = {}
+        self.dirty = False
 
     def put(self, device):
         port_id = device['vip']['port_id']
@@ -90,6 +146,9 @@ class LogicalDeviceCache(object):
             self.devices.add(d)
             self.port_lookup[port_id] = d
             self.pool_lookup[pool_id] = d
+        self.revisions[pool_id] = device.get('revision')
+        self.configs[pool_id] = device
+        self.dirty = True
 
     def remove(self, device):
         if not isinstance(device, self.Device):
@@ -98,11 +157,31 @@ class LogicalDeviceCache(object):
             )
         if device in self.devices:
             self.devices.remove(device)
+        self.revisions.pop(device.pool_id, None)
+        self.configs.pop(device.pool_id, None)
+        self.dirty = True
 
     def remove_by_pool_id(self, pool_id):
         d = self.pool_lookup.get(pool_id)
         if d:
             self.devices.remove(d)
+        self.revisions.pop(pool_id, None)
+        self.configs.pop(pool_id, None)
+        self.dirty = True
+
+    def invalidate(self, pool_id):
+        """Forget the revision of a pool, so that it is fetched again."""
+        if pool_id in self.revisions:
+            self.revisions[pool_id] = None
+            self.dirty = True
+
+    def get_revision(self, pool_id):
+        """Return the revision last applied for a pool, if known."""
+        return self.revisions.get(pool_id)
+
+    def get_config(self, pool_id):
+        """Return the logical device last applied for a pool, if known."""
+        return self.configs.get(pool_id)
 
     def get_by_pool_id(self, pool_id):
         return self.pool_lookup.get(pool_id)
@@ -113,6 +192,189 @@ class LogicalDeviceCache(object):
     def get_pool_ids(self):
         return self.pool_lookup.keys()
 
+    def save(self, path):
+        """Atomically write the cached logical devices to path.
+
+        The secrets of the vips are left out, and the file is only readable
+        by its owner.
+        """
+        snapshot = {
+            'version': CACHE_SNAPSHOT_VERSION,
+            'devices': [_strip_secrets(device)
+                        for device in self.configs.values()],
+        }
+        state_dir = os.path.dirname(path)
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir, 0o755)
+
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as snapshot_file:
+            snapshot_file.write(jsonutils.dumps(snapshot))
+        os.rename(tmp_path, path)
+        self.dirty = False
+
+    def load(self, path):
+        """Return the logical devices saved to path, without caching them."""
+        if not os.path.exists(path):
+            return []
+        try:
+            with open(path, 'r') as snapshot_file:
+                snapshot = jsonutils.loads(snapshot_file.read())
+        except ValueError:
+            LOG.warn(_('Ignoring corrupted device cache snapshot %s'), path)
+            return []
+        if snapshot.get('version') != CACHE_SNAPSHOT_VERSION:
+            return []
+        return snapshot['devices']
+
+
+class PoolLocks(object):
+    """Locks serializing the changes to the device of each pool.
+
+    A lock only lives while it is held or waited for.
+    """
+
+    def __init__(self):
+        self.locks = weakref.WeakValueDictionary()
+
+    @contextlib.contextmanager
+    def lock(self, pool_id):
+        lock = self.locks.get(pool_id)
+        if lock is None:
+            lock = self.locks[pool_id] = semaphore.Semaphore()
+        with lock:
+            yield
+
+
+class PoolWorkQueue(object):
+    """Debounce and coalesce the work requested for each pool.
+
+    Work for a pool is run once no more work was queued for it during the
+    debounce window, or once it waited for max_delay. Work for one pool is
+    never run concurrently by the queue, the handler has to exclude other
+    callers changing the same pool.
+    """
+
+    RELOAD = 'reload'
+    MODIFY = 'modify'
+
+    class Work(object):
+        """Inner class holding the pending work of a pool."""
+        def __init__(self, now):
+            self.first = now
+            self.due = now
+            self.destroy = False
+            self.refresh = None
+
+    def __init__(self, handler, debounce, max_delay, concurrency):
+        self.handler = handler
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.pending = {}
+        self.in_progress = set()
+        self.green_pool = eventlet.GreenPool(concurrency)
+        self.queued_count = 0
+        self.run_count = 0
+        self.running = False
+
+    def start(self):
+        self.running = True
+        eventlet.spawn_n(self._run_forever)
+
+    def stop(self):
+        """Stop running queued work, the work in progress is finished."""
+        self.running = False
+        self.green_pool.waitall()
+
+    def put_destroy(self, pool_id):
+        work = self._get_work(pool_id)
+        # a destroy cancels the refreshes queued before it
+        work.destroy = True
+        work.refresh = None
+
+    def put_refresh(self, pool_id, action):
+        work = self._get_work(pool_id)
+        if work.refresh != self.RELOAD:
+            work.refresh = action
+
+    def _get_work(self, pool_id):
+        now = time.time()
+        work = self.pending.get(pool_id)
+        if not work:
+            work = self.pending[pool_id] = self.Work(now)
+        work.due = min(now + self.debounce, work.first + self.max_delay)
+        self.queued_count += 1
+        return work
+
+    def has_work(self, pool_id):
+        """Whether work for a pool is queued or running."""
+        return pool_id in self.pending or pool_id in self.in_progress
+
+    def get_metrics(self):
+        ratio = 0.0
+        if self.queued_count:
+            ratio = 1 - float(self.run_count) / self.queued_count
+        return {'queue_depth': len(self.pending),
+                'queue_coalescing_ratio': round(ratio, 3)}
+
+    def _run_forever(self):
+        while self.running:
+            try:
+                next_due = self._run_due_work()
+            except Exception:
+                LOG.exception(_('Unexpected error in the pool work queue'))
+                next_due = None
+
+            delay = self.debounce
+            if next_due is not None:
+                delay = min(delay, next_due - time.time())
+            eventlet.sleep(max(delay, MIN_QUEUE_SLEEP))
+
+    def _run_due_work(self):
+        now = time.time()
+        next_due = None
+        for pool_id, work in list(self.pending.items()):
+            if pool_id in self.in_progress:
+                continue
+            if work.due > now:
+                if next_due is None or work.due < next_due:
+                    next_due = work.due
+                continue
+            del self.pending[pool_id]
+            self.in_progress.add(pool_id)
+            self.run_count += 1
+            self.green_pool.spawn_n(self._run, pool_id, work)
+        return next_due
+
+    def _run(self, pool_id, work):
+        try:
+            self.handler(pool_id, work.destroy, work.refresh)
+        except Exception:
+            LOG.exception(_('Unable to process work for pool: %s'), pool_id)
+        finally:
+            self.in_progress.discard(pool_id)
+
+
+class KnownPools(object):
+    """The pools known to the agent, as they are when looked up.
+
+    A pool is known when it is cached, has work in the queue, or was ready
+    at the last sync.
+    """
+
+    def __init__(self, cache, work_queue, ready_pool_ids=()):
+        self.cache = cache
+        self.work_queue = work_queue
+        self.ready_pool_ids = set(ready_pool_ids)
+
+    def __contains__(self, pool_id):
+        return (pool_id in self.ready_pool_ids or
+                self.cache.get_by_pool_id(pool_id) is not None or
+                self.work_queue.has_work(pool_id))
+
 
 class LbaasAgentManager(periodic_task.PeriodicTasks):
 
@@ -157,6 +419,29 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):
         self._setup_rpc()
         self.needs_resync = False
         self.cache = LogicalDeviceCache()
+        # held by the work queue and the syncs while they change a device
+        self.pool_locks = PoolLocks()
+        # the stats last reported for each pool
+        self.last_stats = {}
+        # the status each member has on the server, as far as the agent
+        # knows, by pool
+        self.member_statuses = {}
+        self.cache_path = os.path.join(conf.loadbalancer_state_path,
+                                       CACHE_SNAPSHOT)
+        self._restore_cache()
+        self.work_queue = PoolWorkQueue(
+            self._process_pool_work,
+            conf.pool_work_debounce,
+            conf.pool_work_max_delay,
+            conf.sync_concurrency
+        )
+        self.work_queue.start()
+
+    def stop(self):
+        self.work_queue.stop()
+        stop = getattr(self.driver, 'stop', None)
+        if stop:
+            stop()
 
     def _setup_rpc(self):
         self.plugin_rpc = agent_api.LbaasAgentApi(
@@ -176,12 +461,51 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):
         try:
             device_count = len(self.cache.devices)
             self.agent_state['configurations']['devices'] = device_count
+            get_configurations = getattr(self.driver, 'get_configurations',
+                                         None)
+            if get_configurations:
+                self.agent_state['configurations'].update(
+                    get_configurations())
+            self.agent_state['configurations'].update(
+                self.work_queue.get_metrics())
             self.state_rpc.report_state(self.context,
                                         self.agent_state)
             self.agent_state.pop('start_flag', None)
         except Exception:
             LOG.exception(_("Failed reporting state!"))
 
+    def _restore_cache(self):
+        """Adopt the devices left running by a previous agent.
+
+        Devices which are not running anymore, or whose running
+        configuration is not the cached one, are left to the first sync.
+        """
+        adopt = getattr(self.driver, 'adopt', None)
+        if not adopt:
+            return
+
+        devices = self.cache.load(self.cache_path)
+        for logical_config in devices:
+            pool_id = logical_config['pool']['id']
+            try:
+                if self.driver.exists(pool_id) and adopt(logical_config):
+                    self.cache.put(logical_config)
+                    self._set_member_statuses(logical_config)
+            except Exception:
+                LOG.exception(_('Unable to adopt device for pool: %s'),
+                              pool_id)
+
+        if devices:
+            LOG.info(_('Adopted %(adopted)d of %(cached)d cached devices'),
+                     {'adopted': len(self.cache.devices),
+                      'cached': len(devices)})
+
+    def _save_cache(self):
+        try:
+            self.cache.save(self.cache_path)
+        except Exception:
+            LOG.exception(_('Unable to save the device cache'))
+
     def initialize_service_hook(self, started_by):
         self.sync_state()
 
@@ -191,16 +515,106 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):
             self.needs_resync = False
             self.sync_state()
 
+    @periodic_task.periodic_task
+    def save_cache(self, context):
+        if self.cache.dirty:
+            self._save_cache()
+
     @periodic_task.periodic_task(spacing=6)
     def collect_stats(self, context):
-        for pool_id in self.cache.get_pool_ids():
+        pool_ids = set(self.cache.get_pool_ids())
+        changed = {}
+        member_statuses = {}
+        for pool_id in pool_ids:
             try:
                 stats = self.driver.get_stats(pool_id)
-                if stats:
-                    self.plugin_rpc.update_pool_stats(pool_id, stats)
             except Exception:
                 LOG.exception(_('Error upating stats'))
                 self.needs_resync = True
+                continue
+            # only the pools whose counters changed are reported
+            if stats and stats != self.last_stats.get(pool_id):
+                changed[pool_id] = stats
+            if stats:
+                member_statuses[pool_id] = dict(
+                    (member_id, member_stats[lb_const.STATS_STATUS])
+                    for member_id, member_stats in
+                    stats.get('members', {}).items()
+                    if lb_const.STATS_STATUS in member_stats)
+
+        for pool_id in set(self.last_stats) - pool_ids:
+            del self.last_stats[pool_id]
+        for pool_id in set(self.member_statuses) - pool_ids:
+            del self.member_statuses[pool_id]
+
+        self._report_member_statuses(member_statuses)
+
+        changed_ids = list(changed)
+        for i in range(0, len(changed_ids), STATS_BATCH_SIZE):
+            batch = dict((pool_id, changed[pool_id])
+                         for pool_id in changed_ids[i:i + STATS_BATCH_SIZE])
+            try:
+                self.plugin_rpc.update_pools_stats(batch)
+                self.last_stats.update(batch)
+            except Exception:
+                LOG.exception(_('Error upating stats'))
+                self.needs_resync = True
+
+    def _set_member_statuses(self, logical_config):
+        """Take the member statuses of the server from a logical device.
+
+        Only the members whose health check result differs from their
+        status on the server are reported afterwards.
+        """
+        self.member_statuses[logical_config['pool']['id']] = dict(
+            (member['id'], member['status'])
+            for member in logical_config.get('members', [])
+            if member.get('status') in plugin_driver.HEALTH_STATUSES)
+
+    def _report_member_statuses(self, member_statuses):
+        """Send the health transitions of all the pools in one call."""
+        transitions = {}
+        for pool_id, statuses in member_statuses.items():
+            last = self.member_statuses.get(pool_id, {})
+            for member_id, status in statuses.items():
+                if last.get(member_id) != status:
+                    transitions[member_id] = status
+        if transitions:
+            try:
+                self.plugin_rpc.update_member_statuses(transitions)
+            except Exception:
+                LOG.exception(_('Error updating member statuses'))
+                # the transitions are sent again on the next cycle
+                return
+        self.member_statuses.update(member_statuses)
+
+    @periodic_task.periodic_task(spacing=LOG_ROTATE_INTERVAL)
+    def rotate_logs(self, context):
+        rotate_logs = getattr(self.driver, 'rotate_logs', None)
+        if not rotate_logs:
+            return
+        try:
+            rotate_logs(self.cache.get_pool_ids())
+        except Exception:
+            LOG.exception(_('Error rotating logs'))
+
+    @periodic_task.periodic_task(spacing=STALE_CHECK_INTERVAL)
+    def check_stale_devices(self, context):
+        """Refresh the devices whose certificate files changed."""
+        for pool_id in self.cache.get_pool_ids():
+            try:
+                if self._is_stale(pool_id):
+                    self.work_queue.put_refresh(pool_id,
+                                                PoolWorkQueue.MODIFY)
+            except Exception:
+                LOG.exception(_('Unable to check device for pool: %s'),
+                              pool_id)
+
+    def _is_stale(self, pool_id):
+        is_stale = getattr(self.driver, 'is_stale', None)
+        logical_config = self.cache.get_config(pool_id)
+        return bool(is_stale and logical_config and
+                    is_stale(logical_config))
 
     def _vip_plug_callback(self, action, port):
         if action == 'plug':
@@ -210,66 +624,197 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):
 
     def sync_state(self):
         known_devices = set(self.cache.get_pool_ids())
+        start = time.time()
+        latencies = {}
+        # the driver can apply the changes of the whole sync at once
+        begin_batch = getattr(self.driver, 'begin_batch', None)
+        if begin_batch:
+            begin_batch()
         try:
-            ready_logical_devices = set(self.plugin_rpc.get_ready_devices())
+            revisions = self.plugin_rpc.get_ready_device_revisions()
+            ready_logical_devices = set(revisions)
 
+            green_pool = eventlet.GreenPool(self.conf.sync_concurrency)
+
+            # all destroys are done before any refresh starts, so a pool
+            # being recreated never races with the removal of its device
             for deleted_id in known_devices - ready_logical_devices:
-                self.destroy_device(deleted_id)
+                self._spawn_timed(green_pool, latencies,
+                                  self.destroy_device, deleted_id)
+            green_pool.waitall()
+
+            # only changed pools are fetched again, the other ones are
+            # just checked to be still running
+            changed_ids = []
+            for pool_id, revision in revisions.items():
+                if (revision is not None and
+                        revision == self.cache.get_revision(pool_id)):
+                    self._spawn_timed(green_pool, latencies,
+                                      self.check_device, pool_id)
+                else:
+                    changed_ids.append(pool_id)
+
+            # the next chunk is fetched while the previous one is applied
+            ready_ids = changed_ids
+            chunk_size = self.conf.sync_chunk_size
+            for i in range(0, len(ready_ids), chunk_size):
+                pool_ids = ready_ids[i:i + chunk_size]
+                devices = self.plugin_rpc.get_logical_devices(pool_ids)
+                for pool_id in pool_ids:
+                    if pool_id not in devices:
+                        LOG.warn(_('Unable to get logical device for '
+                                   'pool: %s'), pool_id)
+                        self.needs_resync = True
+                        continue
+                    self._spawn_timed(green_pool, latencies,
+                                      self.refresh_device, pool_id,
+                                      devices[pool_id])
+            green_pool.waitall()
+
+            # orphans are only removed after a sync which fully succeeded,
+            # a device which failed to sync is never mistaken for one
+            if not self.needs_resync:
+                self.remove_orphans(ready_logical_devices)
+        except Exception:
+            LOG.exception(_('Unable to retrieve ready devices'))
+            self.needs_resync = True
+        finally:
+            if begin_batch:
+                self._end_batch()
 
-            for pool_id in ready_logical_devices:
-                self.refresh_device(pool_id)
+        if self.cache.dirty:
+            self._save_cache()
+        self._report_sync(time.time() - start, latencies)
 
+    def _end_batch(self):
+        """Apply the changes the driver deferred during a sync."""
+        try:
+            failed_pool_ids = self.driver.end_batch()
         except Exception:
-            LOG.exception(_('Unable to retrieve ready devices'))
+            LOG.exception(_('Unable to apply the deferred changes'))
+            self.needs_resync = True
+            return
+
+        for pool_id in failed_pool_ids:
+            LOG.warn(_('Unable to apply the deferred change of pool %s'),
+                     pool_id)
+            self.cache.invalidate(pool_id)
             self.needs_resync = True
 
-        self.remove_orphans()
+    def _spawn_timed(self, green_pool, latencies, func, pool_id, *args):
+        """Run func for a pool on green_pool, recording its latency."""
+        def _timed():
+            pool_start = time.time()
+            try:
+                func(pool_id, *args)
+            except Exception:
+                LOG.exception(_('Unable to sync device for pool: %s'),
+                              pool_id)
+                self.needs_resync = True
+            latencies[pool_id] = time.time() - pool_start
 
-    def refresh_device(self, pool_id):
+        green_pool.spawn_n(_timed)
+
+    def _report_sync(self, duration, latencies):
+        self.agent_state['configurations']['last_sync_time'] = round(
+            duration, 3)
+
+        for pool_id, latency in latencies.items():
+            LOG.debug(_('Synced pool %(pool_id)s in %(latency).3fs'),
+                      {'pool_id': pool_id, 'latency': latency})
+
+        slowest = sorted(latencies.items(), key=lambda x: x[1],
+                         reverse=True)[:SYNC_REPORT_SLOWEST]
+        LOG.info(_('Synced %(count)d pools in %(duration).3fs, '
+                   'slowest: %(slowest)s'),
+                 {'count': len(latencies),
+                  'duration': duration,
+                  'slowest': ', '.join('%s (%.3fs)' % x for x in slowest)})
+
+    def refresh_device(self, pool_id, logical_config=None):
+        with self.pool_locks.lock(pool_id):
+            self._refresh_device(pool_id, logical_config)
+
+    def _refresh_device(self, pool_id, logical_config=None):
         try:
-            logical_config = self.plugin_rpc.get_logical_device(pool_id)
+            if logical_config is None:
+                logical_config = self.plugin_rpc.get_logical_device(pool_id)
 
             if self.driver.exists(pool_id):
                 self.driver.update(logical_config)
             else:
                 self.driver.create(logical_config)
             self.cache.put(logical_config)
+            self._set_member_statuses(logical_config)
         except Exception:
             LOG.exception(_('Unable to refresh device for pool: %s'), pool_id)
             self.needs_resync = True
 
+    def check_device(self, pool_id):
+        """Recreate an unchanged device if it is no longer running.
+
+        A running device is updated when the driver finds it stale.
+        """
+        with self.pool_locks.lock(pool_id):
+            if not self.driver.exists(pool_id):
+                LOG.info(_('Device for pool %s is not running, recreating'),
+                         pool_id)
+                self._refresh_device(pool_id)
+            elif self._is_stale(pool_id):
+                LOG.info(_('Device for pool %s is stale, updating'),
+                         pool_id)
+                self._refresh_device(pool_id,
+                                     self.cache.get_config(pool_id))
+
     def destroy_device(self, pool_id):
-        device = self.cache.get_by_pool_id(pool_id)
-        if not device:
-            return
-        try:
-            self.driver.destroy(pool_id)
-            self.plugin_rpc.pool_destroyed(pool_id)
-        except Exception:
-            LOG.exception(_('Unable to destroy device for pool: %s'), pool_id)
-            self.needs_resync = True
-        self.cache.remove(device)
+        with self.pool_locks.lock(pool_id):
+            device = self.cache.get_by_pool_id(pool_id)
+            if not device:
+                return
+            try:
+                self.driver.destroy(pool_id)
+                self.plugin_rpc.pool_destroyed(pool_id)
+            except Exception:
+                LOG.exception(_('Unable to destroy device for pool: %s'),
+                              pool_id)
+                self.needs_resync = True
+            self.cache.remove(device)
 
-    def remove_orphans(self):
+    def remove_orphans(self, ready_pool_ids=()):
+        # the pools created meanwhile are known once their lock is released
+        known_pool_ids = KnownPools(self.cache, self.work_queue,
+                                    ready_pool_ids)
         try:
-            self.driver.remove_orphans(self.cache.get_pool_ids())
+            self.driver.remove_orphans(known_pool_ids,
+                                       pool_lock=self.pool_locks.lock)
         except NotImplementedError:
             pass  # Not all drivers will support this
 
+    def _process_pool_work(self, pool_id, destroy, refresh):
+        """Apply the coalesced work queued for a pool."""
+        if destroy and self.cache.get_by_pool_id(pool_id):
+            self.destroy_device(pool_id)
+
+        if refresh == PoolWorkQueue.RELOAD:
+            self.refresh_device(pool_id)
+        elif (refresh == PoolWorkQueue.MODIFY and
+              self.cache.get_by_pool_id(pool_id)):
+            self.refresh_device(pool_id)
+
     def reload_pool(self, context, pool_id=None, host=None):
         """Handle RPC cast from plugin to reload a pool."""
         if pool_id:
-            self.refresh_device(pool_id)
+            self.work_queue.put_refresh(pool_id, PoolWorkQueue.RELOAD)
 
     def modify_pool(self, context, pool_id=None, host=None):
         """Handle RPC cast from plugin to modify a pool if known to agent."""
         if self.cache.get_by_pool_id(pool_id):
-            self.refresh_device(pool_id)
+            self.work_queue.put_refresh(pool_id, PoolWorkQueue.MODIFY)
 
     def destroy_pool(self, context, pool_id=None, host=None):
         """Handle RPC cast from plugin to destroy a pool if known to agent."""
         if self.cache.get_by_pool_id(pool_id):
-            self.destroy_device(pool_id)
+            self.work_queue.put_destroy(pool_id)
 
     def agent_updated(self, context, payload):
         """Handle the agent_updated notification event."""
@@ -281,3 +826,13 @@ class LbaasAgentManager(periodic_task.PeriodicTasks):
                 for pool_id in self.cache.get_pool_ids():
                     self.destroy_device(pool_id)
             LOG.info(_("agent_updated by server side %s!"), payload)
+
+
+def _strip_secrets(device):
+    vip = device.get('vip') or {}
+    if not any(field in vip for field in SECRET_VIP_FIELDS):
+        return device
+    device = dict(device, vip=dict(vip))
+    for field in SECRET_VIP_FIELDS:
+        device['vip'].pop(field, None)
+    return device
@@ -18,14 +18,167 @@
 # @author: Mark McClain, DreamHost
 # @author: Paul Yang, Neusoft
 
-import itertools
+import cStringIO
+import hashlib
+import os
+import re
 
 from oslo.config import cfg
 
 from neutron.agent.linux import utils
+from neutron.openstack.common import log as logging
 from neutron.plugins.common import constants as qconstants
 from neutron.services.loadbalancer import constants
-
+from neutron.services.loadbalancer.drivers.senginx import sizing
+from neutron.services.loadbalancer.drivers.senginx import tuning
+
+LOG = logging.getLogger(__name__)
+
+OPTS = [
+    cfg.IntOpt(
+        'upstream_keepalive',
+        default=32,
+        help=_('Idle connections to the members of an http pool kept open '
+               'by each worker, 0 disables connection reuse'),
+    ),
+    cfg.IntOpt(
+        'proxy_connect_timeout',
+        default=5,
+        help=_('Seconds to connect to a member, lowered to the timeout of '
+               'the pool health monitor'),
+    ),
+    cfg.IntOpt(
+        'proxy_read_timeout',
+        default=60,
+        help=_('Seconds between two reads from or writes to a member'),
+    ),
+    cfg.StrOpt(
+        'access_log_mode',
+        default='buffered',
+        help=_('Access logging of the pools: off, sync, buffered, or '
+               'sampled to log only a share of the http requests. The '
+               'traffic counters of the pools are taken from their access '
+               'logs, they are not reported when it is off'),
+    ),
+    cfg.DictOpt(
+        'access_log_pool_modes',
+        default={},
+        help=_('Access logging of specific pools, as pool_id:mode pairs'),
+    ),
+    cfg.StrOpt(
+        'access_log_buffer',
+        default='64k',
+        help=_('Size of the http access log buffer'),
+    ),
+    cfg.IntOpt(
+        'access_log_flush',
+        default=5,
+        help=_('Seconds after which a buffered access log is written'),
+    ),
+    cfg.IntOpt(
+        'access_log_sample_rate',
+        default=10,
+        help=_('Percentage of the http requests logged in sampled mode'),
+    ),
+    cfg.BoolOpt(
+        'ssl_termination',
+        default=True,
+        help=_('Terminate the TLS of HTTPS vips whose certificate and key '
+               'are available, instead of passing their traffic through'),
+    ),
+    cfg.StrOpt(
+        'ssl_cert_dir',
+        help=_('Directory holding <vip_id>.crt and <vip_id>.key for the '
+               'HTTPS vips which do not carry their own certificate'),
+    ),
+    cfg.StrOpt(
+        'ssl_session_cache_size',
+        default='10m',
+        help=_('Size of the TLS session cache shared by the workers of '
+               'each HTTPS vip'),
+    ),
+    cfg.IntOpt(
+        'ssl_session_timeout',
+        default=300,
+        help=_('Seconds a TLS session can be resumed'),
+    ),
+    cfg.StrOpt(
+        'ssl_protocols',
+        default='TLSv1 TLSv1.1 TLSv1.2',
+        help=_('TLS protocols accepted on the terminated HTTPS vips'),
+    ),
+    cfg.StrOpt(
+        'ssl_ciphers',
+        default='HIGH:!aNULL:!MD5',
+        help=_('TLS ciphers accepted on the terminated HTTPS vips'),
+    ),
+    cfg.BoolOpt(
+        'http_source_ip_consistent_hash',
+        default=False,
+        help=_('Balance the SOURCE_IP pools proxied by the http module with '
+               'a weighted consistent hash instead of ip_hash, it remaps '
+               'few clients when members change. The tcp module has no '
+               'consistent hash, tcp pools keep ip_hash'),
+    ),
+    cfg.StrOpt(
+        'http_consistent_hash_key',
+        default='source_ip',
+        help=_('Key of the http consistent hash: source_ip, uri or '
+               'header:<name>'),
+    ),
+    cfg.DictOpt(
+        'http_consistent_hash_pool_keys',
+        default={},
+        help=_('Key of the http consistent hash of specific pools, as '
+               'pool_id:key pairs'),
+    ),
+    cfg.BoolOpt(
+        'proxy_cache',
+        default=False,
+        help=_('Cache the responses of all the http pools'),
+    ),
+    cfg.ListOpt(
+        'proxy_cache_pools',
+        default=[],
+        help=_('Pools whose responses are cached even if proxy_cache is '
+               'off'),
+    ),
+    cfg.StrOpt(
+        'proxy_cache_max_size',
+        default='1g',
+        help=_('Largest size of the response cache of a pool on disk'),
+    ),
+    cfg.IntOpt(
+        'proxy_cache_inactive',
+        default=600,
+        help=_('Seconds after which an unused cached response is evicted'),
+    ),
+    cfg.StrOpt(
+        'proxy_cache_key',
+        default='$scheme$proxy_host$request_uri',
+        help=_('Key identifying a cached response'),
+    ),
+    cfg.IntOpt(
+        'proxy_cache_valid',
+        default=0,
+        help=_('Seconds responses without caching headers are cached, 0 '
+               'to only cache what the members allow'),
+    ),
+    cfg.ListOpt(
+        'proxy_cache_bypass',
+        default=['$http_authorization'],
+        help=_('Variables of a request which, when set, make it skip the '
+               'cache and leave its response out of it'),
+    ),
+    cfg.BoolOpt(
+        'proxy_cache_use_stale',
+        default=True,
+        help=_('Serve a stale response while it is refreshed, or when the '
+               'members fail'),
+    ),
+]
+
+cfg.CONF.register_opts(OPTS)
 
 PROTOCOL_MAP = {
     constants.PROTOCOL_TCP: 'tcp',
@@ -39,208 +192,733 @@ POOL_PROTOCOL_MAP = {
     constants.PROTOCOL_HTTPS: 'https',
 }
 
+# not an lbaas api method, http pools get it through
+# http_source_ip_consistent_hash
+LB_METHOD_CONSISTENT_HASH = 'CONSISTENT_HASH'
+
 BALANCE_MAP = {
     constants.LB_METHOD_ROUND_ROBIN: 'rr',
     constants.LB_METHOD_LEAST_CONNECTIONS: 'least_conn',
     constants.LB_METHOD_SOURCE_IP: 'ip_hash'
 }
 
+HASH_KEYS = {
+    'source_ip': '$remote_addr',
+    'uri': '$request_uri',
+}
+HEADER_HASH_KEY = re.compile(r'^header:([A-Za-z0-9-]+)$')
+
+# lb methods which need a directive, and which honour member weights
+UPSTREAM_OPTIONS = {
+    'http': {
+        'balance': (constants.LB_METHOD_LEAST_CONNECTIONS,
+                    constants.LB_METHOD_SOURCE_IP),
+        'weighted': (constants.LB_METHOD_ROUND_ROBIN,
+                     constants.LB_METHOD_LEAST_CONNECTIONS,
+                     constants.LB_METHOD_SOURCE_IP,
+                     LB_METHOD_CONSISTENT_HASH),
+        'persistence': True,
+        'keepalive': True,
+    },
+    'tcp': {
+        'balance': (constants.LB_METHOD_SOURCE_IP,),
+        'weighted': (constants.LB_METHOD_ROUND_ROBIN,),
+        'persistence': False,
+        'keepalive': False,
+    },
+}
+
+# idle connections kept per member, bounding upstream_keepalive for
+# small pools
+KEEPALIVE_PER_MEMBER = 8
+
+HEALTH_CHECK_MAP = {
+    constants.HEALTH_MONITOR_HTTP: 'http',
+    constants.HEALTH_MONITOR_HTTPS: 'ssl_hello',
+    constants.HEALTH_MONITOR_TCP: 'tcp',
+}
+
 ACTIVE = qconstants.ACTIVE
 INACTIVE = qconstants.INACTIVE
 
+INDENT = '    '
+
+# the local status listener, reachable from the agent without entering the
+# pool's namespace
+STATUS_SOCKET = 'status.sock'
+CHECK_STATUS_URI = '/senginx-check-http-status'
+STUB_STATUS_URI = '/senginx-stub-status'
+
+HTTP_ACCESS_LOG = 'http.access.log'
+TCP_ACCESS_LOG = 'tcp.access.log'
+ERROR_LOG = 'error.log'
+
+ACCESS_LOG_MODES = ('off', 'sync', 'buffered', 'sampled')
+DEFAULT_ACCESS_LOG_MODE = 'buffered'
+SAMPLE_VARIABLE = '$lbaas_log_sample'
+
+# the fragments of a pool included by a shared instance
+FRAGMENT_FILES = {
+    'http': 'http.conf',
+    'tcp': 'tcp.conf',
+}
+
+# upstream_addr is last as it can contain spaces when a request is retried
+LOG_FORMAT_NAME = 'lbaas'
+HTTP_LOG_FORMAT = '$msec $request_length $bytes_sent $upstream_addr'
+TCP_LOG_FORMAT = '$msec $bytes_received $bytes_sent $upstream_addr'
+
+# response cache of a pool in its state directory
+CACHE_DIR = 'cache'
+CACHE_ZONE_SIZE = '10m'
+
+# certificate and key of a terminated vip, named after their content
+SSL_MATERIAL_PREFIX = 'ssl-'
+SSL_MATERIAL_SUFFIX = '.pem'
+
 
 def save_config(conf_path, logical_config):
     """Convert a logical configuration to the SEnginx version."""
+    data = render_config(logical_config, os.path.dirname(conf_path))
+    if data is None:
+        return
+
+    utils.replace_file(conf_path, data)
+
+
+def render_config(logical_config, state_dir):
+    """Return the SEnginx configuration text, or None if there is no vip."""
+    nodes = build_config(logical_config, state_dir)
+    if nodes is None:
+        return
+
+    out = cStringIO.StringIO()
+    write_config(out, nodes)
+    return out.getvalue()
+
+
+def get_fragment_file(logical_config):
+    """Return the file name of a pool's fragment for a shared instance."""
+    return FRAGMENT_FILES[get_proxy_protocol(logical_config)]
+
+
+def get_proxy_protocol(logical_config):
+    """Return the SEnginx module proxying a vip, http or tcp.
+
+    HTTPS vips are terminated by the http module when their certificate
+    and key are available, their traffic is passed through otherwise.
+    """
+    protocol = logical_config['vip']['protocol']
+    if get_ssl_material(logical_config):
+        return 'http'
+    return PROTOCOL_MAP[protocol]
+
+
+def get_ssl_material(logical_config):
+    """Return the PEM certificate and key of a terminated vip, or None.
+
+    They are taken from the vip itself, else from ssl_cert_dir.
+    """
+    vip = logical_config['vip']
+    if (vip['protocol'] != constants.PROTOCOL_HTTPS or
+            not cfg.CONF.ssl_termination):
+        return None
+
+    if vip.get('ssl_certificate') and vip.get('ssl_key'):
+        return vip['ssl_certificate'], vip['ssl_key']
+
+    if not cfg.CONF.ssl_cert_dir:
+        return None
+    material = []
+    for ext in ('.crt', '.key'):
+        path = os.path.join(cfg.CONF.ssl_cert_dir, vip['id'] + ext)
+        try:
+            with open(path, 'r') as pem:
+                material.append(pem.read())
+        except IOError:
+            return None
+    return tuple(material)
+
+
+def get_ssl_material_file(material):
+    return '%s%s%s' % (SSL_MATERIAL_PREFIX,
+                       hashlib.sha1(''.join(material)).hexdigest(),
+                       SSL_MATERIAL_SUFFIX)
+
+
+def save_ssl_material(logical_config, state_dir):
+    """Write the certificate and key of a terminated vip in state_dir.
+
+    The file is only readable by its owner. It is named after its content
+    so that a new certificate changes the configuration. The files of
+    previous certificates are left for the last applied configuration,
+    until prune_ssl_material.
+    """
+    material = get_ssl_material(logical_config)
+    if not material:
+        return
+    path = os.path.join(state_dir, get_ssl_material_file(material))
+    if os.path.exists(path):
+        return
+
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as pem:
+        for text in material:
+            pem.write(text)
+            if not text.endswith('\n'):
+                pem.write('\n')
+    os.rename(tmp_path, path)
+
+
+def prune_ssl_material(logical_config, state_dir):
+    """Remove the certificate files not used by the logical config."""
+    material = get_ssl_material(logical_config)
+    keep = material and get_ssl_material_file(material)
+    for name in os.listdir(state_dir):
+        if (name.startswith(SSL_MATERIAL_PREFIX) and
+                name.endswith(SSL_MATERIAL_SUFFIX) and name != keep):
+            os.unlink(os.path.join(state_dir, name))
+
+
+def load_ssl_key(logical_config, state_dir):
+    """Return the key saved in state_dir with the vip's certificate.
+
+    The material file is named after the certificate and key, so a key
+    read back from it is the one it was written with. Returns None when
+    no saved material matches the certificate.
+    """
+    cert = logical_config['vip'].get('ssl_certificate')
+    if not cert or not os.path.isdir(state_dir):
+        return None
+    prefix = cert if cert.endswith('\n') else cert + '\n'
+    for name in os.listdir(state_dir):
+        if not (name.startswith(SSL_MATERIAL_PREFIX) and
+                name.endswith(SSL_MATERIAL_SUFFIX)):
+            continue
+        with open(os.path.join(state_dir, name), 'r') as pem:
+            text = pem.read()
+        if not text.startswith(prefix):
+            continue
+        # a newline was added after a key not ending with one
+        key = text[len(prefix):]
+        for candidate in (key, key[:-1]):
+            if (candidate and
+                    get_ssl_material_file((cert, candidate)) == name):
+                return candidate
+    return None
+
+
+def render_fragment(logical_config, state_dir):
+    """Return the text of a pool's fragment for a shared instance.
+
+    The fragment is written in the pool's state directory and included by
+    the configuration from render_shared_config once it passed the test.
+    """
+    proto = get_proxy_protocol(logical_config)
+
+    out = cStringIO.StringIO()
+    if logical_config['members']:
+        if proto == 'http':
+            nodes = _build_cache_path(logical_config, state_dir)
+            nodes.extend([_build_upstream(logical_config, 'http'),
+                          _build_http_server(logical_config, state_dir)])
+        else:
+            nodes = [_build_upstream(logical_config, 'tcp'),
+                     _build_tcp_server(logical_config, state_dir)]
+        write_config(out, nodes)
+
+    return out.getvalue()
+
+
+def render_shared_config(shared_dir, fragments):
+    """Return the configuration of an instance shared by many pools.
+
+    fragments maps http and tcp to the paths of the fragments to include.
+    """
+    http = Block('http')
+    http.add('include', '/usr/local/senginx/conf/mime.types')
+    http.add('default_type',
+             '/usr/local/senginx/conf/application/octet-stream')
+    http.add('log_format', LOG_FORMAT_NAME, "'%s'" % HTTP_LOG_FORMAT)
+    http.add('access_log', 'off')
+    http.append(_build_log_sampler())
+    http.add('sendfile', 'on')
+    http.add('keepalive_timeout', 65)
+    for path in fragments.get('http', ()):
+        http.add('include', path)
+    http.append(_build_status_server(shared_dir, True))
+
+    tcp = Block('tcp')
+    tcp.add('log_format', LOG_FORMAT_NAME, "'%s'" % TCP_LOG_FORMAT)
+    for path in fragments.get('tcp', ()):
+        tcp.add('include', path)
+
+    out = cStringIO.StringIO()
+    write_config(out, _build_global(None) + [http, tcp])
+    return out.getvalue()
+
+
+def build_config(logical_config, state_dir):
+    """Return the top level nodes of the SEnginx configuration."""
     protocol = logical_config['vip']['protocol']
     if not protocol:
         return
 
-    data = []
-    data.extend(_build_global(logical_config))
+    nodes = _build_global(logical_config)
 
     # build protocol specified configs
-    if PROTOCOL_MAP[protocol] == "http":
-        data.extend(_build_http(logical_config))
+    if get_proxy_protocol(logical_config) == "http":
+        nodes.extend(_build_http(logical_config, state_dir))
     else:
-        data.extend(_build_tcp(logical_config))
+        nodes.extend(_build_tcp(logical_config, state_dir))
+
+    return nodes
+
+
+def write_config(out, nodes):
+    """Stream the configuration nodes into the file-like object out."""
+    for node in nodes:
+        node.write(out, 0)
+
 
-    utils.replace_file(conf_path, '\n'.join(data))
+class Directive(object):
+    """A simple directive, rendered as 'name arg1 arg2;'."""
+
+    __slots__ = ('name', 'args')
+
+    def __init__(self, name, *args):
+        self.name = name
+        self.args = args
+
+    def write(self, out, depth):
+        out.write(INDENT * depth)
+        out.write(self.name)
+        for arg in self.args:
+            out.write(' ')
+            out.write(str(arg))
+        out.write(';\n')
+
+
+class Block(object):
+    """A block directive with nested directives and blocks.
+
+    Children can also be added as an iterable of nodes, which is consumed
+    lazily when the block is written, so a block can only be written once.
+    """
+
+    __slots__ = ('name', 'args', 'children')
+
+    def __init__(self, name, *args):
+        self.name = name
+        self.args = args
+        self.children = []
+
+    def add(self, name, *args):
+        self.children.append(Directive(name, *args))
+        return self
+
+    def append(self, node):
+        self.children.append(node)
+        return node
+
+    def extend(self, nodes):
+        self.children.append(nodes)
+        return self
+
+    def write(self, out, depth):
+        indent = INDENT * depth
+        out.write(indent)
+        out.write(' '.join((self.name,) + tuple(str(a) for a in self.args)))
+        out.write(' {\n')
+        for child in self.children:
+            if isinstance(child, (Directive, Block)):
+                child.write(out, depth + 1)
+            else:
+                for node in child:
+                    node.write(out, depth + 1)
+        out.write(indent)
+        out.write('}\n')
 
 
 def _build_global(config):
+    workers = sizing.get_worker_sizing(config)
+
+    events = Block('events')
+    events.add('worker_connections', workers['worker_connections'])
+
     opts = [
-            'user senginx %s;' % cfg.CONF.user_group,
-            'worker_processes 1;',
-            'error_log error.log;',
-            'pid nginx.pid;',
-            'events {',
-            'worker_connections 10240;',
-            '}',
-            '',
-            ]
+        Directive('user', 'senginx', cfg.CONF.user_group),
+        Directive('worker_processes', workers['worker_processes']),
+        Directive('worker_rlimit_nofile', workers['worker_rlimit_nofile']),
+    ]
+    if 'worker_cpu_affinity' in workers:
+        opts.append(Directive('worker_cpu_affinity',
+                              *workers['worker_cpu_affinity']))
+    opts.extend([
+        Directive('error_log', ERROR_LOG),
+        Directive('pid', 'nginx.pid'),
+        events,
+    ])
 
     return opts
 
 
-def _build_http(config):
-    opts = [
-            'http {',
-            'include /usr/local/senginx/conf/mime.types;',
-            'default_type /usr/local/senginx/conf/application/octet-stream;',
-            'access_log http.access.log;',
-            'sendfile on;',
-            'keepalive_timeout 65;',
-            ' ',
-            ]
+def _build_http(config, state_dir):
+    http = Block('http')
+    http.add('include', '/usr/local/senginx/conf/mime.types')
+    http.add('default_type',
+             '/usr/local/senginx/conf/application/octet-stream')
+    http.add('log_format', LOG_FORMAT_NAME, "'%s'" % HTTP_LOG_FORMAT)
+    if get_access_log_mode(config) == 'sampled':
+        http.append(_build_log_sampler())
+    http.extend(_build_access_log(config, HTTP_ACCESS_LOG, 'http'))
+    http.add('sendfile', 'on')
+    http.add('keepalive_timeout', 65)
 
-    opts.extend(_build_http_upstream(config));
-    opts.extend(_build_http_server(config));
+    if config['members']:
+        http.extend(_build_cache_path(config, state_dir))
+        http.append(_build_upstream(config, 'http'))
+        http.append(_build_http_server(config, state_dir=state_dir))
+    http.append(_build_status_server(state_dir, bool(config['members'])))
 
-    opts.append('}')
+    return [http]
 
-    return opts
 
+def _build_tcp(config, state_dir):
+    tcp = Block('tcp')
+    tcp.add('log_format', LOG_FORMAT_NAME, "'%s'" % TCP_LOG_FORMAT)
+    tcp.extend(_build_access_log(config, TCP_ACCESS_LOG, 'tcp'))
 
-def _build_http_upstream(config):
-    lb_method = config['pool']['lb_method']
+    if config['members']:
+        tcp.append(_build_upstream(config, 'tcp'))
+        tcp.append(_build_tcp_server(config))
 
-    if not config['members']:
-        return []
+    # tcp pools still need an http block to answer the status requests
+    http = Block('http')
+    http.append(_build_status_server(state_dir, False))
 
-    opts = [
-        'upstream %s {' % config['pool']['id'],
-    ]
+    return [tcp, http]
+
+
+def _build_upstream(config, proto):
+    """Build the upstream block shared by the http and tcp proxies."""
+    lb_method = _get_lb_method(config, proto)
+    options = UPSTREAM_OPTIONS[proto]
+
+    upstream = Block('upstream', config['pool']['id'])
 
-    if lb_method != constants.LB_METHOD_ROUND_ROBIN:
-        opts.append('%s;' % BALANCE_MAP.get(lb_method))
+    if lb_method == LB_METHOD_CONSISTENT_HASH:
+        upstream.add('hash', _get_hash_key(config), 'consistent')
+    elif lb_method in options['balance']:
+        upstream.add(BALANCE_MAP[lb_method])
 
-    opts.append('')
+    # must follow the balancing directive
+    if options['keepalive']:
+        keepalive = _get_upstream_keepalive(config)
+        if keepalive:
+            upstream.add('keepalive', keepalive)
 
     # add session persistence (if available)
-    persist_opts = _get_session_persistence(config)
-    opts.extend(persist_opts)
+    if options['persistence']:
+        upstream.extend(_get_session_persistence(config))
 
     # add the members
-    for member in config['members']:
-        if member['status'] in (ACTIVE, INACTIVE) and member['admin_state_up']:
-            server = (('server %(address)s:%(protocol_port)s '
-                       'weight=%(weight)s;') % member)
-            opts.append(server)
+    upstream.extend(_iter_servers(config['members'],
+                                  lb_method in options['weighted']))
 
     # add the first health_monitor (if available)
-    health_opts = _get_server_health_option(config)
-    opts.extend(health_opts)
+    upstream.extend(_get_server_health_option(config))
 
-    opts.append('}')
-    opts.append('')
+    return upstream
 
-    return opts
+
+def _get_lb_method(config, proto):
+    lb_method = config['pool']['lb_method']
+    # the tcp module of SEnginx has no consistent hash, only ip_hash
+    if (lb_method == constants.LB_METHOD_SOURCE_IP and proto == 'http' and
+            cfg.CONF.http_source_ip_consistent_hash):
+        return LB_METHOD_CONSISTENT_HASH
+    return lb_method
+
+
+def _get_hash_key(config):
+    """Return the variable hashed to pick the member of a request."""
+    pool_id = config['pool']['id']
+    key = cfg.CONF.http_consistent_hash_pool_keys.get(
+        pool_id, cfg.CONF.http_consistent_hash_key)
+
+    if key in HASH_KEYS:
+        return HASH_KEYS[key]
+    match = HEADER_HASH_KEY.match(key)
+    if match:
+        return '$http_%s' % match.group(1).lower().replace('-', '_')
+
+    LOG.warn(_('Invalid consistent hash key %(key)s for pool %(pool_id)s, '
+               'using source_ip'), {'key': key, 'pool_id': pool_id})
+    return HASH_KEYS['source_ip']
+
+
+def _iter_servers(members, weighted):
+    for member in members:
+        if member['status'] in (ACTIVE, INACTIVE) and member['admin_state_up']:
+            address = '%(address)s:%(protocol_port)s' % member
+            if weighted:
+                yield Directive('server', address,
+                                'weight=%s' % member['weight'])
+            else:
+                yield Directive('server', address)
 
 
-def _build_http_server(config):
+def _build_http_server(config, fragment_dir=None, state_dir=None):
+    """Build the vip server.
+
+    With fragment_dir, the server is part of a shared instance: it logs in
+    the pool's own state directory, connects to the members from the vip
+    address so that the vip's routes are used, and it does not expose the
+    status of the other pools.
+    """
     pool_protocol = config['pool']['protocol']
+    material = get_ssl_material(config)
 
-    if not config['members']:
-        return []
+    server = Block('server')
+    if material:
+        server.add('listen', _get_listen_address(config), 'ssl')
+        server.extend(_build_ssl_options(config, material,
+                                         fragment_dir or state_dir))
+    else:
+        server.add('listen', _get_listen_address(config))
+    if fragment_dir:
+        server.extend(_build_access_log(
+            config, os.path.join(fragment_dir, HTTP_ACCESS_LOG), 'http'))
+    server.extend(_build_http_tuning(config))
+
+    location = server.append(Block('location', '/'))
+    location.add('proxy_pass', '%s://%s' % (POOL_PROTOCOL_MAP[pool_protocol],
+                                            config['pool']['id']))
+    location.extend(_get_proxy_options(config))
+    location.extend(_get_cache_options(config))
+    if material:
+        location.add('proxy_set_header', 'X-Forwarded-Proto', 'https')
+    if fragment_dir:
+        location.add('proxy_bind',
+                     _get_first_ip_from_port(config['vip']['port']))
+
+    if config['healthmonitors'] and not fragment_dir:
+        location = server.append(Block('location', CHECK_STATUS_URI))
+        location.add('check_status', 'csv')
+
+    return server
+
+
+def _build_http_tuning(config):
+    """Build the compression and buffering options of the vip server."""
+    settings = tuning.get_http_tuning(config)
+    buffer_size = settings['proxy_buffer_size']
 
-    opts = [
-        'server {',
-        'listen %s:%d;' % (
-            _get_first_ip_from_port(config['vip']['port']),
-            config['vip']['protocol_port']
-        ),
-        '',
-        'location / {',
-        'proxy_pass %s://%s;' %
-        (POOL_PROTOCOL_MAP[pool_protocol], config['pool']['id']),
-        '}',
+    opts = []
+    if settings['gzip']:
+        opts.extend([
+            Directive('gzip', 'on'),
+            Directive('gzip_types', *tuning.GZIP_TYPES),
+            Directive('gzip_comp_level', settings['gzip_comp_level']),
+            Directive('gzip_min_length', settings['gzip_min_length']),
+            Directive('gzip_proxied', 'any'),
+            Directive('gzip_vary', 'on'),
+        ])
+    opts.extend([
+        # a buffered response frees the member before a slow client got it
+        Directive('proxy_buffering', 'on'),
+        Directive('proxy_buffer_size', '%dk' % buffer_size),
+        Directive('proxy_buffers', settings['proxy_buffers'],
+                  '%dk' % buffer_size),
+        Directive('proxy_busy_buffers_size', '%dk' % (2 * buffer_size)),
+        Directive('client_body_buffer_size',
+                  '%dk' % settings['client_body_buffer_size']),
+    ])
+    return opts
+
+
+def _build_ssl_options(config, material, state_dir):
+    pem = os.path.join(state_dir, get_ssl_material_file(material))
+    return [
+        Directive('ssl_certificate', pem),
+        Directive('ssl_certificate_key', pem),
+        Directive('ssl_protocols', *cfg.CONF.ssl_protocols.split()),
+        Directive('ssl_ciphers', cfg.CONF.ssl_ciphers),
+        Directive('ssl_prefer_server_ciphers', 'on'),
+        # resumed sessions skip the full handshake, in any worker
+        Directive('ssl_session_cache',
+                  'shared:ssl_%s:%s' % (config['pool']['id'],
+                                        cfg.CONF.ssl_session_cache_size)),
+        Directive('ssl_session_timeout', '%ds' % cfg.CONF.ssl_session_timeout),
+        Directive('ssl_session_tickets', 'on'),
     ]
 
-    if config['healthmonitors']:
-        opts.append('location /senginx-check-http-status {');
-        opts.append('check_status csv;');
-        opts.append('}');
 
+def _build_tcp_server(config, fragment_dir=None):
+    server = Block('server')
+    server.add('listen', _get_listen_address(config))
+    if fragment_dir:
+        server.extend(_build_access_log(
+            config, os.path.join(fragment_dir, TCP_ACCESS_LOG), 'tcp'))
+    server.add('proxy_pass', config['pool']['id'])
 
-    opts.append('}');
-    opts.append('');
+    return server
 
-    return opts
 
+def _build_status_server(state_dir, check_status):
+    server = Block('server')
+    server.add('listen', 'unix:%s' % os.path.join(state_dir, STATUS_SOCKET))
+    server.add('access_log', 'off')
 
-def _build_tcp(config):
-    opts = [
-            'tcp {',
-            'access_log tcp.access.log;',
-            ' ',
-            ]
+    location = server.append(Block('location', STUB_STATUS_URI))
+    location.add('stub_status', 'on')
 
-    opts.extend(_build_tcp_upstream(config));
-    opts.extend(_build_tcp_server(config));
+    if check_status:
+        location = server.append(Block('location', CHECK_STATUS_URI))
+        location.add('check_status', 'csv')
 
-    opts.append('}')
+    return server
 
-    return opts
 
+def is_cached(config):
+    """Whether the responses of a pool are cached."""
+    return (get_proxy_protocol(config) == 'http' and
+            (cfg.CONF.proxy_cache or
+             config['pool']['id'] in cfg.CONF.proxy_cache_pools))
+
+
+def _get_cache_zone(config):
+    return 'cache_%s' % config['pool']['id']
+
+
+def _build_cache_path(config, state_dir):
+    if not is_cached(config):
+        return []
+    return [Directive('proxy_cache_path',
+                      os.path.join(state_dir, CACHE_DIR),
+                      'levels=1:2',
+                      'keys_zone=%s:%s' % (_get_cache_zone(config),
+                                           CACHE_ZONE_SIZE),
+                      'max_size=%s' % cfg.CONF.proxy_cache_max_size,
+                      'inactive=%ds' % cfg.CONF.proxy_cache_inactive)]
 
-def _build_tcp_upstream(config):
-    lb_method = config['pool']['lb_method']
 
-    if not config['members']:
+def _get_cache_options(config):
+    if not is_cached(config):
         return []
 
     opts = [
-        'upstream %s {' % config['pool']['id'],
+        Directive('proxy_cache', _get_cache_zone(config)),
+        Directive('proxy_cache_key', '"%s"' % cfg.CONF.proxy_cache_key),
     ]
+    if cfg.CONF.proxy_cache_bypass:
+        # the responses of authenticated requests are not for everyone
+        opts.append(Directive('proxy_cache_bypass',
+                              *cfg.CONF.proxy_cache_bypass))
+        opts.append(Directive('proxy_no_cache', *cfg.CONF.proxy_cache_bypass))
+    if cfg.CONF.proxy_cache_valid > 0:
+        opts.append(Directive('proxy_cache_valid', '200', '301', '302',
+                              '%ds' % cfg.CONF.proxy_cache_valid))
+    if cfg.CONF.proxy_cache_use_stale:
+        # clients get the stale response while a single request refreshes it
+        opts.append(Directive('proxy_cache_use_stale', 'error', 'timeout',
+                              'updating', 'http_500', 'http_502', 'http_503',
+                              'http_504'))
+        opts.append(Directive('proxy_cache_lock', 'on'))
 
-    if lb_method == constants.LB_METHOD_SOURCE_IP:
-        opts.append('%s;' % BALANCE_MAP.get(lb_method))
+    return opts
 
-    opts.append('')
 
-    # add session persistence (if available)
-    #persist_opts = _get_session_persistence(config)
-    #opts.extend(persist_opts)
+def get_access_log_mode(config):
+    mode = cfg.CONF.access_log_pool_modes.get(config['pool']['id'],
+                                              cfg.CONF.access_log_mode)
+    if mode not in ACCESS_LOG_MODES:
+        return DEFAULT_ACCESS_LOG_MODE
+    return mode
 
-    # add the members
-    for member in config['members']:
-        if member['status'] in (ACTIVE, INACTIVE) and member['admin_state_up']:
-            server = (('server %(address)s:%(protocol_port)s') % member)
-            if lb_method == constants.LB_METHOD_ROUND_ROBIN:
-                server = server + ((' weight=%(weight)s;') % member)
-            else:
-                server = server + ';'
-            opts.append(server)
 
-    # add the first health_monitor (if available)
-    health_opts = _get_server_health_option(config)
-    opts.extend(health_opts)
+def get_access_log_scale(config):
+    """Return the factor from the logged requests to all the requests.
 
-    opts.append('}')
-    opts.append('')
+    Returns None when nothing is logged.
+    """
+    protocol = config['vip']['protocol']
+    mode = get_access_log_mode(config)
+    if mode == 'off':
+        return None
+    if (mode == 'sampled' and protocol and
+            get_proxy_protocol(config) == 'http'):
+        return 100.0 / _get_sample_rate()
+    return 1.0
 
-    return opts
 
+def _get_sample_rate():
+    return min(max(cfg.CONF.access_log_sample_rate, 1), 100)
 
-def _build_tcp_server(config):
-    if not config['members']:
-        return []
+
+def _build_access_log(config, path, proto):
+    mode = get_access_log_mode(config)
+    if mode == 'off':
+        return [Directive('access_log', 'off')]
+
+    args = [path, LOG_FORMAT_NAME]
+
+    # one line per session is written for tcp, so it is never buffered
+    if proto == 'http' and mode != 'sync':
+        args.append('buffer=%s' % cfg.CONF.access_log_buffer)
+        args.append('flush=%ds' % cfg.CONF.access_log_flush)
+        if mode == 'sampled':
+            args.append('if=%s' % SAMPLE_VARIABLE)
+
+    return [Directive('access_log', *args)]
+
+
+def _build_log_sampler():
+    sampler = Block('split_clients', '"${remote_addr}${remote_port}${msec}"',
+                    SAMPLE_VARIABLE)
+    sampler.add('%d%%' % _get_sample_rate(), 1)
+    sampler.add('*', '""')
+    return sampler
+
+
+def _get_upstream_keepalive(config):
+    members = sum(1 for member in config['members']
+                  if member['admin_state_up'])
+    return min(cfg.CONF.upstream_keepalive, KEEPALIVE_PER_MEMBER * members)
+
+
+def _get_proxy_options(config):
+    connect_timeout = cfg.CONF.proxy_connect_timeout
+    for monitor in config['healthmonitors']:
+        if monitor['admin_state_up']:
+            # a member this slow would be marked down by the monitor anyway
+            connect_timeout = max(min(connect_timeout,
+                                      int(monitor['timeout'])), 1)
+            break
 
     opts = [
-        'server {',
-        'listen %s:%d;' % (
-            _get_first_ip_from_port(config['vip']['port']),
-            config['vip']['protocol_port']
-        ),
-        '',
-        'proxy_pass %s;' % config['pool']['id'],
-        '}',
-        ''
+        Directive('proxy_connect_timeout', '%ds' % connect_timeout),
+        Directive('proxy_read_timeout', '%ds' % cfg.CONF.proxy_read_timeout),
+        Directive('proxy_send_timeout', '%ds' % cfg.CONF.proxy_read_timeout),
     ]
 
+    # reuse the member connections
+    if _get_upstream_keepalive(config):
+        opts.append(Directive('proxy_http_version', '1.1'))
+        opts.append(Directive('proxy_set_header', 'Connection', '""'))
+
     return opts
 
 
+def _get_listen_address(config):
+    return '%s:%d' % (_get_first_ip_from_port(config['vip']['port']),
+                      config['vip']['protocol_port'])
+
+
 def _get_first_ip_from_port(port):
     for fixed_ip in port['fixed_ips']:
         return fixed_ip['ip_address']
@@ -258,31 +936,34 @@ def _get_server_health_option(config):
     else:
         return []
 
-    opts = []
+    check_type = HEALTH_CHECK_MAP.get(monitor['type'])
+    if not check_type:
+        return []
 
-    delay = int(monitor['delay']) * 1000
-    timeout = int(monitor['timeout']) * 1000
+    opts = [
+        Directive('check',
+                  'interval=%d' % (int(monitor['delay']) * 1000),
+                  'fall=%d' % monitor['max_retries'],
+                  'timeout=%d' % (int(monitor['timeout']) * 1000),
+                  'type=%s' % check_type)
+    ]
 
     if monitor['type'] == constants.HEALTH_MONITOR_HTTP:
-        opts.append('check interval=%d fall=%d'
-                    ' timeout=%d type=http;' %
-                    (delay, monitor['max_retries'], timeout))
-        opts.append('check_http_send "%(http_method)s %(url_path)s '
-                    'HTTP/1.0\\r\\n\\r\\n";' % monitor)
-        opts.append('check_http_expect_alive %s;' %
-                    ' '.join(_expand_expected_codes(monitor['expected_codes'])))
-    elif monitor['type'] == constants.HEALTH_MONITOR_HTTPS:
-        opts.append('check interval=%d fall=%d'
-                    ' timeout=%d type=ssl_hello;' %
-                    (delay, monitor['max_retries'], timeout))
-    elif monitor['type'] == constants.HEALTH_MONITOR_TCP:
-        opts.append('check interval=%d fall=%d'
-                    ' timeout=%d type=tcp;' %
-                    (delay, monitor['max_retries'], timeout))
+        opts.append(Directive('check_http_send',
+                              '"%(http_method)s %(url_path)s '
+                              'HTTP/1.0\\r\\n\\r\\n"' % monitor))
+        opts.append(Directive('check_http_expect_alive',
+                              *_expand_expected_codes(
+                                  monitor['expected_codes'])))
 
     return opts
 
 
+def has_health_check(config):
+    """Whether SEnginx checks the health of the members of a pool."""
+    return bool(_get_server_health_option(config))
+
+
 def _get_session_persistence(config):
     persistence = config['vip'].get('session_persistence')
     if not persistence:
@@ -293,12 +974,14 @@ def _get_session_persistence(config):
         # XXX: no source ip persistence is availiable currently
         return opts
     elif persistence['type'] == constants.SESSION_PERSISTENCE_HTTP_COOKIE:
-        opts.append('persistence insert_cookie cookie_name=senginx timeout=30;')
+        opts.append(Directive('persistence', 'insert_cookie',
+                              'cookie_name=senginx', 'timeout=30'))
     elif (persistence['type'] == constants.SESSION_PERSISTENCE_APP_COOKIE and
           persistence.get('cookie_name')):
-        opts.append('persistence insert_cookie cookie_name=senginx ' \
-                'monitor_cookie=%s timeout=30;' %
-                persistence['cookie_name'])
+        opts.append(Directive('persistence', 'insert_cookie',
+                              'cookie_name=senginx',
+                              'monitor_cookie=%s' % persistence['cookie_name'],
+                              'timeout=30'))
 
     return opts
 
@@ -324,7 +1007,7 @@ def _expand_expected_codes(codes):
         for i in range(int(low), int(hi) + 1):
             l_codes.append(str(i))
     else:
-        l_codes = codes.replace(',', ' ').split(' ')
+        l_codes = codes.replace(',', ' ').split()
 
     for code in l_codes:
         code = code.strip()
@@ -339,4 +1022,4 @@ def _expand_expected_codes(codes):
         elif i_code >= 500 and i_code < 600:
             retval.append('http_5xx')
 
-    return list(set(retval))
+    return sorted(set(retval))
@@ -18,22 +18,104 @@
 # @author: Mark McClain, DreamHost
 # @author: Paul Yang, Neusoft
 
+import hashlib
 import os
 import shutil
 import socket
+import time
 
+import eventlet
+from eventlet import semaphore
 import netaddr
+from oslo.config import cfg
 
 from neutron.agent.linux import ip_lib
 from neutron.agent.linux import utils
 from neutron.common import exceptions
+from neutron.openstack.common import jsonutils
 from neutron.openstack.common import log as logging
 from neutron.plugins.common import constants
 from neutron.services.loadbalancer import constants as lb_const
 from neutron.services.loadbalancer.drivers.senginx import cfg as secfg
+from neutron.services.loadbalancer.drivers.senginx import privhelper
+from neutron.services.loadbalancer.drivers.senginx import process
+from neutron.services.loadbalancer.drivers.senginx import sizing
+from neutron.services.loadbalancer.drivers.senginx import stats
 
 LOG = logging.getLogger(__name__)
 NS_PREFIX = 'qlbaas-'
+NETNS_RUN_DIR = '/var/run/netns'
+
+OPTS = [
+    cfg.BoolOpt(
+        'shared_instance',
+        default=False,
+        help=_('Serve the pools from a single SEnginx instance in a shared '
+               'namespace when their addresses allow it'),
+    ),
+    cfg.IntOpt(
+        'log_max_size',
+        default=100 * 1024 * 1024,
+        help=_('Size in bytes above which a SEnginx log is rotated'),
+    ),
+    cfg.IntOpt(
+        'log_max_age',
+        default=24 * 3600,
+        help=_('Seconds after which a SEnginx log is rotated'),
+    ),
+    cfg.IntOpt(
+        'log_keep',
+        default=3,
+        help=_('Number of rotated logs kept for each SEnginx log'),
+    ),
+    cfg.IntOpt(
+        'log_retention',
+        default=7 * 24 * 3600,
+        help=_('Seconds after which a rotated log is removed'),
+    ),
+    cfg.BoolOpt(
+        'privileged_helper',
+        default=False,
+        help=_('Run the privileged commands of the driver through a '
+               'long-lived helper instead of one root helper per command'),
+    ),
+    cfg.BoolOpt(
+        'orphan_dry_run',
+        default=False,
+        help=_('Only report the SEnginx instances, namespaces and state '
+               'directories of unknown pools instead of removing them'),
+    ),
+    cfg.IntOpt(
+        'orphan_concurrency',
+        default=4,
+        help=_('Number of orphaned pools torn down at the same time'),
+    ),
+]
+
+cfg.CONF.register_opts(OPTS)
+
+# state directory and namespace name of the shared instance
+SHARED_ID = 'shared'
+
+# policy routing tables of the vip subnets in the shared namespace, their
+# allocation is recorded in the state directory of the shared instance
+ROUTE_TABLES = 'route.tables'
+ROUTE_TABLE_BASE = 1000
+
+# priority of the rules selecting the table of a vip address
+ROUTE_RULE_PRIORITY = 1000
+
+# plugged state of the vip port in a pool's state directory
+PLUG_STATE = 'plug.state'
+
+# a configuration is tested as a candidate before it replaces the applied
+# one, which is kept as the last good one until the next successful apply
+CANDIDATE_SUFFIX = '.candidate'
+LAST_GOOD_SUFFIX = '.last-good'
+
+# the mtime of this empty file next to a log is the time the log started,
+# the log's own mtime and ctime change with every write
+LOG_STARTED_SUFFIX = '.started'
 
 
 class SEnginxNSDriver(object):
@@ -43,86 +125,852 @@ class SEnginxNSDriver(object):
         self.vif_driver = vif_driver
         self.vip_plug_callback = vip_plug_callback
         self.pool_to_port_id = {}
+        self.pool_to_members = {}
+        self.pool_stats = {}
+        self.status_connections = stats.StatusConnectionPool()
+        self.logical_digests = {}
+        self.shared_ports = {}
+        self.route_tables = None
+        # changes to the shared instance are applied by a single reload,
+        # deferred until end_batch while a batch is open
+        self.shared_lock = semaphore.Semaphore()
+        self.shared_changes = {}
+        self.shared_errors = {}
+        self.shared_batch = False
+        self.shared_deferred = set()
+        self.pool_sizing = {}
+        self.pool_log_scale = {}
+        self.process_tracker = process.ProcessTracker()
+        self.counters = {'reloads_applied': 0, 'reloads_skipped': 0}
+        self.orphaned_pools = []
+        self.privhelper = None
+        if cfg.CONF.privileged_helper:
+            self.privhelper = privhelper.PrivHelperClient(root_helper)
+
+    def stop(self):
+        if self.privhelper:
+            self.privhelper.stop()
 
     def create(self, logical_config):
         pool_id = logical_config['pool']['id']
         namespace = get_ns_name(pool_id)
+        self._remember_pool(logical_config)
 
-        self._plug(namespace, logical_config['vip']['port'])
+        if self._use_shared(logical_config):
+            self._plug(pool_id, get_ns_name(SHARED_ID),
+                       logical_config['vip']['port'], shared=True)
+            self._spawn_shared(logical_config)
+            return
+
+        self.shared_ports.pop(pool_id, None)
+        self._plug(pool_id, namespace, logical_config['vip']['port'])
         self._spawn(logical_config)
 
     def update(self, logical_config):
-        #pool_id = logical_config['pool']['id']
-        #pid_path = self._get_state_file_path(pool_id, 'pid')
+        pool_id = logical_config['pool']['id']
+        self._remember_pool(logical_config)
+
+        shared = self._use_shared(logical_config)
+        if shared != self._is_shared(pool_id):
+            LOG.info(_('Moving pool %(pool_id)s to %(instance)s instance'),
+                     {'pool_id': pool_id,
+                      'instance': shared and 'the shared' or 'its own'})
+            self.destroy(pool_id)
+            self.create(logical_config)
+            return
 
-        extra_args = ['-s', 'reload']
-        #extra_args.extend(p.strip() for p in open(pid_path, 'r'))
-        self._spawn(logical_config, extra_args)
+        # the same logical config was applied by this agent already
+        logical_digest = _get_logical_digest(logical_config)
+        if self.logical_digests.get(pool_id) == logical_digest:
+            self._skip_reload(pool_id)
+            return
 
-    def _spawn(self, logical_config, extra_cmd_args=()):
+        # the logical config changed in a way that does not affect SEnginx
+        state_dir = self._get_state_file_path(pool_id, '')
+        if shared:
+            data = secfg.render_fragment(logical_config, state_dir)
+        else:
+            data = secfg.render_config(logical_config, state_dir)
+        if self._get_applied_digest(pool_id) == _get_digest(data):
+            self.logical_digests[pool_id] = logical_digest
+            self._skip_reload(pool_id)
+            return
+
+        if shared:
+            self._spawn_shared(logical_config, data)
+        else:
+            extra_args = ['-s', 'reload']
+            self._spawn(logical_config, extra_args, data)
+
+    def adopt(self, logical_config):
+        """Take over a pool left running by a previous agent.
+
+        Returns False when the running configuration is not the one the
+        logical config renders to, the pool then needs an update. The key
+        of a vip, left out of the agent's snapshot, is restored in
+        logical_config from the certificate file saved with it.
+        """
+        pool_id = logical_config['pool']['id']
+        state_dir = self._get_state_file_path(pool_id, '')
+        vip = logical_config['vip']
+        if vip.get('ssl_certificate') and not vip.get('ssl_key'):
+            ssl_key = secfg.load_ssl_key(logical_config, state_dir)
+            if ssl_key:
+                vip['ssl_key'] = ssl_key
+        if self._is_shared(pool_id):
+            data = secfg.render_fragment(logical_config, state_dir)
+        else:
+            data = secfg.render_config(logical_config, state_dir)
+        if self._get_applied_digest(pool_id) != _get_digest(data):
+            return False
+
+        self._remember_pool(logical_config)
+        self.logical_digests[pool_id] = _get_logical_digest(logical_config)
+        return True
+
+    def is_stale(self, logical_config):
+        """Return True when logical_config was not applied as it is now.
+
+        The certificate files of a vip in ssl_cert_dir can change without
+        the logical config changing.
+        """
+        pool_id = logical_config['pool']['id']
+        return (self.logical_digests.get(pool_id) !=
+                _get_logical_digest(logical_config))
+
+    def get_configurations(self):
+        """Return the driver details reported in the agent state."""
+        configurations = dict(self.counters)
+        configurations['orphaned_pools'] = self.orphaned_pools
+
+        # pools in the shared instance do not have workers of their own
+        own_sizing = [workers
+                      for pool_id, workers in self.pool_sizing.items()
+                      if pool_id not in self.shared_ports]
+        profiles = {}
+        for workers in own_sizing:
+            profiles[workers['profile']] = (
+                profiles.get(workers['profile'], 0) + 1)
+        configurations['worker_profiles'] = profiles
+        configurations['worker_processes'] = sum(
+            workers['worker_processes'] for workers in own_sizing)
+
+        return configurations
+
+    def _skip_reload(self, pool_id):
+        self.counters['reloads_skipped'] += 1
+        LOG.debug(_('Configuration of pool %s is unchanged, '
+                    'skipping reload'), pool_id)
+
+    def _spawn(self, logical_config, extra_cmd_args=(), data=None):
         pool_id = logical_config['pool']['id']
         namespace = get_ns_name(pool_id)
         conf_path = self._get_state_file_path(pool_id, 'conf')
         base_path = self._get_state_file_path(pool_id, '')
-        #pid_path = self._get_state_file_path(pool_id, 'pid')
-        #sock_path = self._get_state_file_path(pool_id, 'sock')
 
-        secfg.save_config(conf_path, logical_config)
-        cmd = ['/usr/local/senginx/sbin/nginx', '-c', conf_path, '-p', base_path]
+        if data is None:
+            data = secfg.render_config(logical_config, base_path)
+        if data is not None:
+            secfg.save_ssl_material(logical_config, base_path)
+            self._stage_config(conf_path, base_path, namespace, data)
+
+        cmd = [process.SENGINX_BIN, '-c', conf_path, '-p', base_path]
         cmd.extend(extra_cmd_args)
 
-        ns = ip_lib.IPWrapper(self.root_helper, namespace)
-        ns.netns.execute(cmd)
+        try:
+            self._execute(cmd, namespace)
+        except RuntimeError:
+            self._rollback(pool_id, conf_path, base_path, namespace,
+                           restart=not extra_cmd_args)
+            raise
+        self.counters['reloads_applied'] += 1
+        if not extra_cmd_args:
+            # a new master was started
+            self.process_tracker.invalidate(pool_id)
+
+        if data is not None:
+            self._save_last_good(conf_path, data)
+            secfg.prune_ssl_material(logical_config, base_path)
+            if not secfg.is_cached(logical_config):
+                self._remove_cache(pool_id)
+
+        # remember what is running now
+        self._save_applied_digest(pool_id, data)
+        self.logical_digests[pool_id] = _get_logical_digest(logical_config)
+
+    def _spawn_shared(self, logical_config, data=None):
+        """Write the pool's fragment and reload the shared instance."""
+        pool_id = logical_config['pool']['id']
+        state_dir = self._get_state_file_path(pool_id, '')
+        fragment = secfg.get_fragment_file(logical_config)
+
+        if data is None:
+            data = secfg.render_fragment(logical_config, state_dir)
+        secfg.save_ssl_material(logical_config, state_dir)
+        # the fragment is only included once it passed the test
+        fragment_path = os.path.join(state_dir, fragment)
+        utils.replace_file(fragment_path + CANDIDATE_SUFFIX, data)
+
+        self._apply_shared(pool_id, logical_config, data)
+
+    def begin_batch(self):
+        """Defer the reloads of the shared instance until end_batch."""
+        self.shared_batch = True
+
+    def end_batch(self):
+        """Apply the deferred changes to the shared instance at once.
+
+        Returns the pools whose deferred change could not be applied.
+        """
+        self.shared_batch = False
+        deferred, self.shared_deferred = self.shared_deferred, set()
+        with self.shared_lock:
+            self._apply_shared_changes()
+        return [pool_id for pool_id in deferred
+                if self.shared_errors.pop(pool_id, None)]
+
+    def _apply_shared(self, pool_id, logical_config=None, data=None):
+        """Apply a pool's change to the shared instance.
+
+        Without a logical config, the pool was removed. The pending changes
+        of all the pools are applied by a single reload, by whichever
+        caller gets the lock first.
+        """
+        self.shared_changes[pool_id] = (logical_config, data)
+        if self.shared_batch:
+            self.shared_deferred.add(pool_id)
+            return
+
+        with self.shared_lock:
+            if pool_id in self.shared_changes:
+                self._apply_shared_changes()
+        error = self.shared_errors.pop(pool_id, None)
+        if error:
+            raise error
+
+    def _apply_shared_changes(self):
+        """Reload the shared instance with the pending changes.
+
+        Must be called with shared_lock held.
+        """
+        changes, self.shared_changes = self.shared_changes, {}
+        if not changes:
+            return
+
+        candidates = dict(
+            (pool_id, self._get_state_file_path(
+                pool_id, secfg.get_fragment_file(logical_config)))
+            for pool_id, (logical_config, data) in changes.items()
+            if logical_config is not None)
+        passed, tested = self._test_fragments(candidates)
+        if not passed and len(candidates) == len(changes):
+            # no pool was removed, the shared instance is unchanged
+            return
+        for pool_id in passed:
+            self._promote_fragment(pool_id, candidates[pool_id])
+
+        if not self._has_shared_pools():
+            # the last pool is gone
+            self._stop_shared()
+            return
+
+        try:
+            self._reload_shared(test=not tested)
+        except RuntimeError as e:
+            for pool_id in changes:
+                if pool_id in passed:
+                    self._rollback_fragments(pool_id)
+                self.shared_errors.setdefault(pool_id, e)
+            self._restart_shared()
+            return
+        self.counters['reloads_applied'] += 1
+
+        for pool_id in passed:
+            self._commit_shared(*changes[pool_id])
+
+    def _test_fragments(self, candidates):
+        """Test the candidate fragments of pools, {pool_id: fragment path}.
+
+        The candidates are tested together with the applied fragments of
+        the other pools, a single test for the whole batch, then one by one
+        if that fails. Returns the pools whose candidate passed, and whether
+        they passed together. The errors of the other ones are recorded.
+        """
+        if not candidates:
+            return set(), False
+        try:
+            self._test_shared(candidates)
+            return set(candidates), True
+        except RuntimeError as e:
+            if len(candidates) == 1:
+                self.shared_errors.update(dict.fromkeys(candidates, e))
+                return set(), False
+
+        passed = set()
+        for pool_id, path in candidates.items():
+            try:
+                self._test_shared({pool_id: path})
+                passed.add(pool_id)
+            except RuntimeError as e:
+                self.shared_errors[pool_id] = e
+        return passed, False
+
+    def _test_shared(self, candidates):
+        """Test the shared configuration including candidate fragments."""
+        conf_path = self._get_state_file_path(SHARED_ID, 'conf')
+        base_path = self._get_state_file_path(SHARED_ID, '')
+        data = secfg.render_shared_config(
+            base_path, self._get_shared_fragments(candidates))
+        self._test_config(conf_path + CANDIDATE_SUFFIX, base_path,
+                          get_ns_name(SHARED_ID), data)
+
+    def _get_shared_fragments(self, candidates=None):
+        """Return the fragments included by the shared configuration.
+
+        The applied fragments of the pools are returned by protocol. A pool
+        in candidates, {pool_id: fragment path}, only has its candidate
+        fragment included instead.
+        """
+        candidates = candidates or {}
+        fragments = dict((proto, []) for proto in secfg.FRAGMENT_FILES)
+        confs_dir = os.path.abspath(os.path.normpath(self.state_path))
+        if not os.path.isdir(confs_dir):
+            return fragments
+
+        for pool_id in sorted(os.listdir(confs_dir)):
+            if pool_id == SHARED_ID:
+                continue
+            for proto, fragment in secfg.FRAGMENT_FILES.items():
+                path = os.path.join(confs_dir, pool_id, fragment)
+                if pool_id in candidates:
+                    if candidates[pool_id] == path:
+                        fragments[proto].append(path + CANDIDATE_SUFFIX)
+                elif os.path.exists(path):
+                    fragments[proto].append(path)
+        return fragments
+
+    def _promote_fragment(self, pool_id, fragment_path):
+        """Make the tested candidate the applied fragment of a pool."""
+        for fragment in secfg.FRAGMENT_FILES.values():
+            self._keep_last_good(self._get_state_file_path(
+                pool_id, fragment, ensure_state_dir=False))
+        os.rename(fragment_path + CANDIDATE_SUFFIX, fragment_path)
+        self._remove_fragments(pool_id,
+                               keep=os.path.basename(fragment_path))
+
+    def _commit_shared(self, logical_config, data):
+        """Record a pool's fragment as running in the shared instance."""
+        pool_id = logical_config['pool']['id']
+        state_dir = self._get_state_file_path(pool_id, '')
+        fragment = secfg.get_fragment_file(logical_config)
+
+        self._save_last_good(os.path.join(state_dir, fragment), data)
+        for other in secfg.FRAGMENT_FILES.values():
+            if other != fragment:
+                _remove_file(self._get_state_file_path(
+                    pool_id, other + LAST_GOOD_SUFFIX,
+                    ensure_state_dir=False))
+        secfg.prune_ssl_material(logical_config, state_dir)
+        if not secfg.is_cached(logical_config):
+            self._remove_cache(pool_id)
+
+        # remember what is running now
+        self._save_applied_digest(pool_id, data)
+        self.logical_digests[pool_id] = _get_logical_digest(logical_config)
+
+    def _reload_shared(self, test=True):
+        """Start the shared instance, or reload it if it is running.
+
+        Without test, the configuration including the applied fragments
+        passed the test already, with their candidates. Must be called with
+        shared_lock held.
+        """
+        namespace = get_ns_name(SHARED_ID)
+        conf_path = self._get_state_file_path(SHARED_ID, 'conf')
+        base_path = self._get_state_file_path(SHARED_ID, '')
+
+        data = secfg.render_shared_config(base_path,
+                                          self._get_shared_fragments())
+        if test:
+            self._stage_config(conf_path, base_path, namespace, data)
+        else:
+            self._keep_last_good(conf_path)
+            utils.replace_file(conf_path, data)
+
+        cmd = [process.SENGINX_BIN, '-c', conf_path, '-p', base_path]
+        if self._instance_alive(SHARED_ID):
+            cmd.extend(['-s', 'reload'])
+        else:
+            self.process_tracker.invalidate(SHARED_ID)
+
+        try:
+            self._execute(cmd, namespace)
+        except RuntimeError:
+            # the fragments are rolled back by the caller before a restart
+            self._rollback(SHARED_ID, conf_path, base_path, namespace,
+                           restart=False)
+            raise
+        self._save_last_good(conf_path, data)
+
+    def _stop_shared(self):
+        pid_path = self._get_state_file_path(SHARED_ID, 'nginx.pid',
+                                             ensure_state_dir=False)
+        kill_pids_in_file(self.root_helper, pid_path, helper=self.privhelper)
+        self.process_tracker.invalidate(SHARED_ID)
+
+    def _restart_shared(self):
+        """Start the shared instance again after a failed start."""
+        if (not self._has_shared_pools() or
+                self._instance_alive(SHARED_ID)):
+            return
+        try:
+            self._reload_shared()
+        except RuntimeError:
+            LOG.exception(_('Unable to restart the shared instance with '
+                            'its last good configuration'))
+
+    def _stage_config(self, conf_path, base_path, namespace, data):
+        """Test a configuration, then make it the one to apply.
+
+        The configuration is written next to the applied one and tested by
+        SEnginx in the namespace of the instance, the running master never
+        sees a configuration failing the test.
+        """
+        candidate_path = conf_path + CANDIDATE_SUFFIX
+        self._test_config(candidate_path, base_path, namespace, data)
+        self._keep_last_good(conf_path)
+        os.rename(candidate_path, conf_path)
+
+    def _test_config(self, candidate_path, base_path, namespace, data):
+        """Write a configuration to candidate_path and test it."""
+        utils.replace_file(candidate_path, data)
+        try:
+            self._execute([process.SENGINX_BIN, '-t', '-c', candidate_path,
+                           '-p', base_path], namespace)
+        except RuntimeError:
+            LOG.error(_('Configuration %s failed the test, keeping the '
+                        'applied one'), candidate_path)
+            raise
+
+    def _save_last_good(self, conf_path, data):
+        utils.replace_file(conf_path + LAST_GOOD_SUFFIX, data)
+
+    def _keep_last_good(self, path):
+        """Copy an applied file which has no last good copy yet.
+
+        Agents older than the last good copies left applied files without
+        them, these are the last good ones before they are replaced.
+        """
+        last_good_path = path + LAST_GOOD_SUFFIX
+        if os.path.exists(path) and not os.path.exists(last_good_path):
+            shutil.copyfile(path, last_good_path)
+
+    def _rollback(self, instance_id, conf_path, base_path, namespace,
+                  restart):
+        """Restore the last good configuration after a failed apply.
+
+        With restart, the instance failed to start and is started again
+        with that configuration.
+        """
+        last_good_path = conf_path + LAST_GOOD_SUFFIX
+        if not os.path.exists(last_good_path):
+            # nothing was ever applied, the applied files get a last good
+            # copy before they are replaced
+            _remove_file(conf_path)
+            return
+
+        LOG.warn(_('Restoring the last good configuration %s'),
+                 last_good_path)
+        with open(last_good_path, 'r') as last_good:
+            utils.replace_file(conf_path, last_good.read())
+        if not restart:
+            return
+
+        self.process_tracker.invalidate(instance_id)
+        try:
+            self._execute([process.SENGINX_BIN, '-c', conf_path,
+                           '-p', base_path], namespace)
+        except RuntimeError:
+            LOG.exception(_('Unable to start %s with its last good '
+                            'configuration'), instance_id)
+
+    def _rollback_fragments(self, pool_id):
+        """Restore the last good fragments of a shared pool."""
+        for fragment in secfg.FRAGMENT_FILES.values():
+            path = self._get_state_file_path(pool_id, fragment,
+                                             ensure_state_dir=False)
+            if os.path.exists(path + LAST_GOOD_SUFFIX):
+                with open(path + LAST_GOOD_SUFFIX, 'r') as last_good:
+                    utils.replace_file(path, last_good.read())
+            else:
+                _remove_file(path)
+
+    def _use_shared(self, logical_config):
+        """Whether a pool can be served by the shared instance.
+
+        The vip port of a pool which can is recorded in shared_ports right
+        away, so that the next pools are checked against its subnets.
+        """
+        if (not cfg.CONF.shared_instance or
+                not logical_config['vip']['protocol']):
+            return False
+
+        pool_id = logical_config['pool']['id']
+        port = logical_config['vip']['port']
+
+        # tenant networks can overlap, but the connected routes of the
+        # shared namespace are in its main table: the subnets of the vips
+        # must not overlap unless they are the same
+        subnets = _get_subnets(port)
+        for other_id, other_port in self.shared_ports.items():
+            if other_id == pool_id:
+                continue
+            for subnet_id, cidr in _get_subnets(other_port).items():
+                for other_subnet_id, other_cidr in subnets.items():
+                    if (subnet_id != other_subnet_id and
+                            cidr.first <= other_cidr.last and
+                            other_cidr.first <= cidr.last):
+                        return False
+
+        # the http connections to the members are bound to the vip address
+        # to use its routes, tcp connections and health checks can't be, so
+        # their members have to be on the vip subnets
+        if (secfg.get_proxy_protocol(logical_config) == 'tcp' or
+                secfg.has_health_check(logical_config)):
+            for member in logical_config['members']:
+                address = netaddr.IPAddress(member['address'])
+                if not any(address in cidr for cidr in subnets.values()):
+                    return False
+
+        self.shared_ports[pool_id] = port
+        return True
+
+    def _is_shared(self, pool_id):
+        return any(
+            os.path.exists(self._get_state_file_path(
+                pool_id, fragment, ensure_state_dir=False))
+            for fragment in secfg.FRAGMENT_FILES.values()
+        )
+
+    def _remove_fragments(self, pool_id, keep=None):
+        for fragment in secfg.FRAGMENT_FILES.values():
+            path = self._get_state_file_path(pool_id, fragment,
+                                             ensure_state_dir=False)
+            if fragment != keep and os.path.exists(path):
+                os.unlink(path)
+
+    def _has_shared_pools(self):
+        confs_dir = os.path.abspath(os.path.normpath(self.state_path))
+        if not os.path.isdir(confs_dir):
+            return False
+        return any(self._is_shared(pool_id)
+                   for pool_id in os.listdir(confs_dir)
+                   if pool_id != SHARED_ID)
+
+    def _destroy_shared(self, pool_id):
+        namespace = get_ns_name(SHARED_ID)
+
+        self._remove_fragments(pool_id)
+        if self._has_shared_pools():
+            self._apply_shared(pool_id)
+        else:
+            # the shared instance is stopped right away with its last pool,
+            # even in a batch, as its namespace is removed below
+            with self.shared_lock:
+                self.shared_changes[pool_id] = (None, None)
+                self._apply_shared_changes()
+
+        # unplug the port
+        self.shared_ports.pop(pool_id, None)
+        routes = self._get_plug_state(pool_id).get('routes')
+        if routes:
+            self._del_vip_routes(namespace, routes)
+        port_id = self._get_port_id(pool_id)
+        if port_id:
+            self._unplug(namespace, port_id)
+
+        if not self._has_shared_pools():
+            ns = ip_lib.IPWrapper(self.root_helper, namespace)
+            ns.garbage_collect_namespace()
+
+    def _remember_pool(self, logical_config):
+        pool_id = logical_config['pool']['id']
 
         # remember the pool<>port mapping
         self.pool_to_port_id[pool_id] = logical_config['vip']['port']['id']
 
+        # remember the member addresses to map statistics to members
+        self.pool_to_members[pool_id] = dict(
+            ('%(address)s:%(protocol_port)s' % member, member['id'])
+            for member in logical_config['members']
+        )
+
+        # sampled logs only account a share of the traffic
+        scale = secfg.get_access_log_scale(logical_config)
+        if scale is None and self.pool_log_scale.get(pool_id, 1.0):
+            LOG.warn(_('Access logging of pool %s is off, its traffic '
+                       'counters are not reported'), pool_id)
+        self.pool_log_scale[pool_id] = scale
+
+        # remember the worker sizing to report it
+        self.pool_sizing[pool_id] = sizing.get_worker_sizing(logical_config)
+
+        # remember the vip ports plugged in the shared namespace
+        if self._is_shared(pool_id):
+            self.shared_ports[pool_id] = logical_config['vip']['port']
+
     def destroy(self, pool_id):
+        if self._is_shared(pool_id):
+            self._destroy_shared(pool_id)
+            self.logical_digests.pop(pool_id, None)
+            self._forget_stats(pool_id)
+            self.pool_to_members.pop(pool_id, None)
+            self.pool_sizing.pop(pool_id, None)
+            self.pool_log_scale.pop(pool_id, None)
+            self._remove_state_dir(pool_id)
+            return
+
         namespace = get_ns_name(pool_id)
         ns = ip_lib.IPWrapper(self.root_helper, namespace)
         pid_path = self._get_state_file_path(pool_id, 'nginx.pid')
 
         # kill the process
-        kill_pids_in_file(self.root_helper, pid_path)
+        kill_pids_in_file(self.root_helper, pid_path, helper=self.privhelper)
+        self.process_tracker.invalidate(pool_id)
+        self.shared_ports.pop(pool_id, None)
+        self.logical_digests.pop(pool_id, None)
+        self._forget_stats(pool_id)
+        self.pool_to_members.pop(pool_id, None)
+        self.pool_sizing.pop(pool_id, None)
+        self.pool_log_scale.pop(pool_id, None)
 
         # unplug the ports
-        if pool_id in self.pool_to_port_id:
-            self._unplug(namespace, self.pool_to_port_id[pool_id])
+        port_id = self._get_port_id(pool_id)
+        if port_id:
+            self._unplug(namespace, port_id)
 
         ns.garbage_collect_namespace()
+        self._remove_state_dir(pool_id)
+
+    def _remove_cache(self, pool_id):
+        """Remove the response cache of a pool, written by the workers."""
+        cache_dir = self._get_state_file_path(pool_id, secfg.CACHE_DIR,
+                                              ensure_state_dir=False)
+        if os.path.isdir(cache_dir):
+            self._execute(['rm', '-rf', cache_dir])
 
+    def _remove_state_dir(self, pool_id):
         # remove the configuration directory
         conf_dir = os.path.dirname(self._get_state_file_path(pool_id, ''))
         if os.path.isdir(conf_dir):
-            utils.execute(['rm', '-rf', conf_dir], self.root_helper)
+            self._execute(['rm', '-rf', conf_dir])
 
     def exists(self, pool_id):
-        namespace = get_ns_name(pool_id)
-        root_ns = ip_lib.IPWrapper(self.root_helper)
+        if self._is_shared(pool_id):
+            return self._instance_alive(SHARED_ID)
 
-        pid_path = self._get_state_file_path(pool_id, 'nginx.pid')
-        if root_ns.netns.exists(namespace) and os.path.exists(pid_path):
-            with open(pid_path, 'r') as pids:
-                for pid in pids:
-                    pid = pid.strip()
-                    try:
-                        utils.execute(['kill', '-0', pid], self.root_helper)
-                    except RuntimeError:
-                        LOG.exception(
-                            _('Unable to kill -0 senginx master process: %s'),
-                            pid
-                        )
-                        return False
-            return True
+        return self._instance_alive(pool_id)
+
+    def _instance_alive(self, instance_id):
+        """Check the SEnginx master of an instance without any command."""
+        namespace = get_ns_name(instance_id)
+        if not os.path.exists(os.path.join(NETNS_RUN_DIR, namespace)):
+            self.process_tracker.invalidate(instance_id)
+            return False
 
-        return False
+        return self.process_tracker.is_alive(
+            instance_id,
+            self._get_state_file_path(instance_id, 'nginx.pid',
+                                      ensure_state_dir=False),
+            self._get_state_file_path(instance_id, 'conf',
+                                      ensure_state_dir=False))
 
     def get_stats(self, pool_id):
-        # TODO: support this function
-        return {}
+        pool_stats = self._get_pool_stats(pool_id)
+        if not pool_stats:
+            return {}
+
+        return pool_stats.get_stats(self.pool_to_members.get(pool_id, {}),
+                                    self.pool_log_scale.get(pool_id, 1.0))
+
+    def _get_pool_stats(self, pool_id):
+        pool_stats = self.pool_stats.get(pool_id)
+        if not pool_stats:
+            state_dir = self._get_state_file_path(pool_id, '',
+                                                  ensure_state_dir=False)
+            if not os.path.isdir(state_dir):
+                return
+            if self._is_shared(pool_id):
+                pool_stats = stats.PoolStats(
+                    state_dir,
+                    self._get_state_file_path(SHARED_ID, secfg.STATUS_SOCKET),
+                    pool_id,
+                    self.status_connections)
+            else:
+                pool_stats = stats.PoolStats(
+                    state_dir, connections=self.status_connections)
+            self.pool_stats[pool_id] = pool_stats
+        return pool_stats
 
-    def remove_orphans(self, known_pool_ids):
-        raise NotImplementedError()
+    def _forget_stats(self, pool_id):
+        pool_stats = self.pool_stats.pop(pool_id, None)
+        # the status listener of the shared instance serves other pools
+        if pool_stats and not pool_stats.upstream:
+            self.status_connections.close(pool_stats.sock_path)
+
+    def rotate_logs(self, pool_ids):
+        """Rotate the logs which are too large or too old.
+
+        The renamed logs are reopened by sending USR1 to the masters.
+        """
+        instance_ids = set()
+        for pool_id in pool_ids:
+            instance_id = pool_id
+            if self._is_shared(pool_id):
+                instance_id = SHARED_ID
+                # the error log is the one of the shared instance
+                if self._rotate_logs(SHARED_ID, [secfg.ERROR_LOG]):
+                    instance_ids.add(SHARED_ID)
+            if self._rotate_logs(pool_id, [secfg.HTTP_ACCESS_LOG,
+                                           secfg.TCP_ACCESS_LOG,
+                                           secfg.ERROR_LOG]):
+                instance_ids.add(instance_id)
+
+        for instance_id in instance_ids:
+            pid_path = self._get_state_file_path(instance_id, 'nginx.pid',
+                                                 ensure_state_dir=False)
+            kill_pids_in_file(self.root_helper, pid_path, '-USR1',
+                              helper=self.privhelper)
+
+    def _rotate_logs(self, pool_id, logs):
+        """Rename the logs of a pool needing it, return True if any was."""
+        now = time.time()
+        rotated = False
+        for log in logs:
+            path = self._get_state_file_path(pool_id, log,
+                                             ensure_state_dir=False)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+
+            started = self._get_log_started(path, now)
+            if (size < cfg.CONF.log_max_size and
+                    now - started < cfg.CONF.log_max_age):
+                continue
+
+            # account the logged traffic before the log goes away, the
+            # lines written until the log is reopened are read later
+            pool_stats = None
+            if pool_id != SHARED_ID:
+                pool_stats = self._get_pool_stats(pool_id)
+            scale = self.pool_log_scale.get(pool_id, 1.0)
+            if pool_stats and scale:
+                pool_stats.read_logs(scale)
+
+            rotated_path = '%s.%d' % (path, now)
+            os.rename(path, rotated_path)
+            if pool_stats:
+                pool_stats.log_rotated(path, rotated_path)
+            self._set_log_started(path, now)
+            rotated = True
+            self._remove_old_logs(path, now)
+
+        return rotated
+
+    def _get_log_started(self, path, now):
+        """Return the time a log started, now if it is not known."""
+        try:
+            return os.path.getmtime(path + LOG_STARTED_SUFFIX)
+        except OSError:
+            self._set_log_started(path, now)
+            return now
+
+    def _set_log_started(self, path, now):
+        open(path + LOG_STARTED_SUFFIX, 'w').close()
+        os.utime(path + LOG_STARTED_SUFFIX, (now, now))
+
+    def _remove_old_logs(self, path, now):
+        log_dir, log = os.path.split(path)
+        prefix = log + '.'
+        rotated = sorted(
+            (int(name[len(prefix):]), name)
+            for name in os.listdir(log_dir)
+            if name.startswith(prefix) and name[len(prefix):].isdigit()
+        )
+        for i, (rotated_at, name) in enumerate(reversed(rotated)):
+            if (i >= cfg.CONF.log_keep or
+                    now - rotated_at > cfg.CONF.log_retention):
+                os.unlink(os.path.join(log_dir, name))
+
+    def remove_orphans(self, known_pool_ids, pool_lock=None):
+        """Tear down the pools left behind while the agent was down.
+
+        A pool is an orphan when it has a state directory or a namespace
+        but is not in known_pool_ids. With pool_lock, a pool is checked
+        again under its lock before it is torn down, known_pool_ids then
+        has to reflect the pools created meanwhile. Returns the orphaned
+        pool ids.
+        """
+        pool_ids = set()
+        confs_dir = os.path.abspath(os.path.normpath(self.state_path))
+        if os.path.isdir(confs_dir):
+            pool_ids.update(
+                name for name in os.listdir(confs_dir)
+                if os.path.isdir(os.path.join(confs_dir, name)))
+        if os.path.isdir(NETNS_RUN_DIR):
+            pool_ids.update(
+                name[len(NS_PREFIX):] for name in os.listdir(NETNS_RUN_DIR)
+                if name.startswith(NS_PREFIX))
+
+        # the shared instance goes away with its last pool
+        pool_ids.discard(SHARED_ID)
+        orphans = sorted(pool_id for pool_id in pool_ids
+                         if pool_id not in known_pool_ids)
+
+        # reported in the agent state, to be removed by hand
+        self.orphaned_pools = []
+        if cfg.CONF.orphan_dry_run:
+            for pool_id in orphans:
+                LOG.info(_('Would remove orphaned pool %s'), pool_id)
+            self.orphaned_pools = orphans
+            return orphans
+
+        # every shared orphan reloads the shared instance, keep them serial
+        green_pool = eventlet.GreenPool(cfg.CONF.orphan_concurrency)
+        for pool_id in orphans:
+            if self._is_shared(pool_id):
+                self._remove_orphan(pool_id, known_pool_ids, pool_lock)
+            else:
+                green_pool.spawn_n(self._remove_orphan, pool_id,
+                                   known_pool_ids, pool_lock)
+        green_pool.waitall()
+
+        return orphans
+
+    def _remove_orphan(self, pool_id, known_pool_ids, pool_lock=None):
+        if not pool_lock:
+            self._remove_orphan_unlocked(pool_id)
+            return
+        with pool_lock(pool_id):
+            if pool_id in known_pool_ids:
+                LOG.debug(_('Pool %s is no longer an orphan'), pool_id)
+                return
+            self._remove_orphan_unlocked(pool_id)
+
+    def _remove_orphan_unlocked(self, pool_id):
+        LOG.info(_('Removing orphaned pool %s'), pool_id)
+        namespace = get_ns_name(pool_id)
+        try:
+            if (not self._get_port_id(pool_id) and
+                    os.path.exists(os.path.join(NETNS_RUN_DIR, namespace))):
+                # the vip port is unknown, unplug what is left in there
+                ns = ip_lib.IPWrapper(self.root_helper, namespace)
+                for device in ns.get_devices(exclude_loopback=True):
+                    self.vif_driver.unplug(device.name, namespace=namespace)
+            self.destroy(pool_id)
+        except Exception:
+            LOG.exception(_('Unable to remove orphaned pool %s'), pool_id)
 
     def _get_state_file_path(self, pool_id, kind, ensure_state_dir=True):
         """Returns the file name for a given kind of config file."""
@@ -133,9 +981,98 @@ class SEnginxNSDriver(object):
                 os.makedirs(conf_dir, 0o755)
         return os.path.join(conf_dir, kind)
 
-    def _plug(self, namespace, port, reuse_existing=True):
-        self.vip_plug_callback('plug', port)
+    def _get_applied_digest(self, pool_id):
+        digest_path = self._get_state_file_path(pool_id, 'conf.digest',
+                                                ensure_state_dir=False)
+        if os.path.exists(digest_path):
+            with open(digest_path, 'r') as digest:
+                return digest.read().strip()
+
+    def _save_applied_digest(self, pool_id, data):
+        digest_path = self._get_state_file_path(pool_id, 'conf.digest')
+        utils.replace_file(digest_path, _get_digest(data))
+
+    def _get_port_id(self, pool_id):
+        """Return the vip port of a pool, even if the agent restarted."""
+        if pool_id in self.pool_to_port_id:
+            return self.pool_to_port_id[pool_id]
+        return self._get_plug_state(pool_id).get('port_id')
+
+    def _get_plug_state(self, pool_id):
+        path = self._get_state_file_path(pool_id, PLUG_STATE,
+                                         ensure_state_dir=False)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, 'r') as state:
+                return jsonutils.loads(state.read())
+        except ValueError:
+            LOG.warn(_('Ignoring corrupted plug state %s'), path)
+            return {}
+
+    def _save_plug_state(self, pool_id, plug_state):
+        path = self._get_state_file_path(pool_id, PLUG_STATE)
+        utils.replace_file(path, jsonutils.dumps(plug_state))
+
+    def _plug(self, pool_id, namespace, port, reuse_existing=True,
+              shared=False):
+        """Plug the vip port of a pool, applying only what changed.
+
+        The plugged state is recorded in the pool's state directory, it
+        stays valid as long as the namespace and the device exist.
+        """
         interface_name = self.vif_driver.get_device_name(Wrap(port))
+        plug_state = _get_plug_state(namespace, interface_name, port, shared)
+
+        current = {}
+        if os.path.exists(os.path.join(NETNS_RUN_DIR, namespace)):
+            current = self._get_plug_state(pool_id)
+        if current and not ip_lib.device_exists(
+                current['interface'], self.root_helper, current['namespace']):
+            LOG.warn(_('Vip port of pool %s was unplugged, plugging it '
+                       'again'), pool_id)
+            current = {}
+        if current == plug_state:
+            LOG.debug(_('Vip port of pool %s is plugged already'), pool_id)
+            return
+
+        same_device = all(current.get(key) == plug_state[key]
+                          for key in ('namespace', 'port_id', 'mac_address'))
+        if not same_device:
+            if current.get('routes'):
+                self._del_vip_routes(current['namespace'], current['routes'])
+            if current.get('port_id') not in (None, port['id']):
+                self._unplug(current['namespace'], current['port_id'])
+            self._plug_device(namespace, interface_name, port,
+                              reuse_existing)
+
+        if not same_device:
+            current = {}
+
+        if current.get('cidrs') != plug_state['cidrs']:
+            self.vif_driver.init_l3(interface_name, plug_state['cidrs'],
+                                    namespace=namespace)
+
+        if shared:
+            self._del_vip_routes(
+                namespace, [route for route in current.get('routes', ())
+                            if route not in plug_state['routes']])
+            if current.get('routes') != plug_state['routes']:
+                self._add_vip_routes(namespace, interface_name,
+                                     plug_state['routes'])
+        else:
+            gw_ip = plug_state['gateway_ip']
+            if current.get('gateway_ip') not in (None, gw_ip):
+                self._execute(['route', 'del', 'default'], namespace,
+                              check_exit_code=False)
+            if gw_ip and current.get('gateway_ip') != gw_ip:
+                cmd = ['route', 'add', 'default', 'gw', gw_ip]
+                self._execute(cmd, namespace, check_exit_code=False)
+
+        self._save_plug_state(pool_id, plug_state)
+
+    def _plug_device(self, namespace, interface_name, port, reuse_existing):
+        self.vip_plug_callback('plug', port)
 
         if ip_lib.device_exists(interface_name, self.root_helper, namespace):
             if not reuse_existing:
@@ -151,19 +1088,99 @@ class SEnginxNSDriver(object):
                 namespace=namespace
             )
 
-        cidrs = [
-            '%s/%s' % (ip['ip_address'],
-                       netaddr.IPNetwork(ip['subnet']['cidr']).prefixlen)
-            for ip in port['fixed_ips']
-        ]
-        self.vif_driver.init_l3(interface_name, cidrs, namespace=namespace)
+    def _add_vip_routes(self, namespace, interface_name, routes):
+        """Route the traffic from the vip addresses through their subnets.
+
+        The shared namespace has no default route, each vip subnet gets its
+        own routing table, with the connected route of the subnet and its
+        gateway, selected by the source address.
+        """
+        for address, subnet_id, cidr, gw_ip in routes:
+            table = str(self._allocate_route_table(subnet_id, address))
+            self._execute(['ip', 'route', 'replace', cidr,
+                           'dev', interface_name, 'src', address,
+                           'table', table], namespace)
+            if gw_ip:
+                self._execute(['ip', 'route', 'replace', 'default',
+                               'via', gw_ip, 'dev', interface_name,
+                               'table', table], namespace)
+            self._execute(['ip', 'rule', 'del', 'from', address], namespace,
+                          check_exit_code=False)
+            self._execute(['ip', 'rule', 'add', 'from', address,
+                           'table', table,
+                           'priority', str(ROUTE_RULE_PRIORITY)], namespace)
+
+    def _del_vip_routes(self, namespace, routes):
+        for route in routes:
+            address, subnet_id = route[:2]
+            self._execute(['ip', 'rule', 'del', 'from', address], namespace,
+                          check_exit_code=False)
+            table = self._release_route_table(subnet_id, address)
+            if table:
+                self._execute(['ip', 'route', 'flush', 'table', str(table)],
+                              namespace, check_exit_code=False)
+
+    def _get_route_tables(self):
+        """Return the routing tables of the vip subnets.
 
-        gw_ip = port['fixed_ips'][0]['subnet'].get('gateway_ip')
-        if gw_ip:
-            cmd = ['route', 'add', 'default', 'gw', gw_ip]
-            ip_wrapper = ip_lib.IPWrapper(self.root_helper,
-                                          namespace=namespace)
-            ip_wrapper.netns.execute(cmd, check_exit_code=False)
+        Maps the subnet ids to their table and the vip addresses using it.
+        """
+        if self.route_tables is None:
+            self.route_tables = {}
+            path = self._get_state_file_path(SHARED_ID, ROUTE_TABLES,
+                                             ensure_state_dir=False)
+            if os.path.exists(path):
+                try:
+                    with open(path, 'r') as tables:
+                        self.route_tables = jsonutils.loads(tables.read())
+                except ValueError:
+                    LOG.warn(_('Ignoring corrupted route tables %s'), path)
+        return self.route_tables
+
+    def _save_route_tables(self):
+        path = self._get_state_file_path(SHARED_ID, ROUTE_TABLES)
+        utils.replace_file(path, jsonutils.dumps(self.route_tables))
+
+    def _allocate_route_table(self, subnet_id, address):
+        """Return the routing table of a subnet, allocating a free one."""
+        tables = self._get_route_tables()
+        if subnet_id not in tables:
+            used = set(table for table, addresses in tables.values())
+            table = ROUTE_TABLE_BASE
+            while table in used:
+                table += 1
+            tables[subnet_id] = [table, []]
+
+        table, addresses = tables[subnet_id]
+        if address not in addresses:
+            addresses.append(address)
+            self._save_route_tables()
+        return table
+
+    def _release_route_table(self, subnet_id, address):
+        """Release the table of a subnet once no vip address uses it.
+
+        Returns the released table.
+        """
+        tables = self._get_route_tables()
+        if subnet_id not in tables:
+            return
+        table, addresses = tables[subnet_id]
+        if address in addresses:
+            addresses.remove(address)
+        if addresses:
+            self._save_route_tables()
+            return
+        del tables[subnet_id]
+        self._save_route_tables()
+        return table
+
+    def _execute(self, cmd, namespace=None, check_exit_code=True):
+        """Run a privileged command, in a namespace if one is given."""
+        if namespace:
+            cmd = ['ip', 'netns', 'exec', namespace] + list(cmd)
+        return privhelper.execute(self.privhelper, cmd, self.root_helper,
+                                  check_exit_code=check_exit_code)
 
     def _unplug(self, namespace, port_id):
         port_stub = {'id': port_id}
@@ -186,13 +1203,63 @@ def get_ns_name(namespace_id):
     return NS_PREFIX + namespace_id
 
 
-def kill_pids_in_file(root_helper, pid_path):
+def _get_subnets(port):
+    return dict((ip['subnet']['id'], netaddr.IPNetwork(ip['subnet']['cidr']))
+                for ip in port['fixed_ips'])
+
+
+def _get_plug_state(namespace, interface_name, port, shared):
+    """Return what plugging a vip port sets up, as recorded in PLUG_STATE."""
+    plug_state = {
+        'namespace': namespace,
+        'interface': interface_name,
+        'port_id': port['id'],
+        'mac_address': port['mac_address'],
+        'cidrs': [
+            '%s/%s' % (ip['ip_address'],
+                       netaddr.IPNetwork(ip['subnet']['cidr']).prefixlen)
+            for ip in port['fixed_ips']
+        ],
+    }
+
+    if shared:
+        plug_state['routes'] = sorted(
+            [ip['ip_address'], ip['subnet']['id'],
+             str(netaddr.IPNetwork(ip['subnet']['cidr']).cidr),
+             ip['subnet'].get('gateway_ip')]
+            for ip in port['fixed_ips'])
+    else:
+        plug_state['gateway_ip'] = (
+            port['fixed_ips'][0]['subnet'].get('gateway_ip'))
+
+    return plug_state
+
+
+def _remove_file(path):
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+def _get_digest(data):
+    return hashlib.sha1(data or '').hexdigest()
+
+
+def _get_logical_digest(logical_config):
+    """Digest a logical config and the certificate files read for it."""
+    material = secfg.get_ssl_material(logical_config)
+    material_file = material and secfg.get_ssl_material_file(material)
+    return _get_digest(jsonutils.dumps([logical_config, material_file],
+                                       sort_keys=True))
+
+
+def kill_pids_in_file(root_helper, pid_path, sig='-QUIT', helper=None):
     if os.path.exists(pid_path):
         with open(pid_path, 'r') as pids:
             for pid in pids:
                 pid = pid.strip()
                 try:
-                    utils.execute(['kill', '-QUIT', pid], root_helper)
+                    privhelper.execute(helper, ['kill', sig, pid],
+                                       root_helper)
                 except RuntimeError:
                     LOG.exception(
                         _('Unable to kill senginx master process: %s'),
@@ -18,22 +18,28 @@
 # @author: Mark McClain, DreamHost
 # @author: Paul Yang, Neusoft
 
+import hashlib
 import uuid
 
 from oslo.config import cfg
+from sqlalchemy import orm
 
 from neutron.common import constants as q_const
 from neutron.common import exceptions as q_exc
 from neutron.common import rpc as q_rpc
 from neutron.db import agents_db
 from neutron.db.loadbalancer import loadbalancer_db
+from neutron.db import models_v2
 from neutron.extensions import lbaas_agentscheduler
+from neutron.extensions import loadbalancer
 from neutron.extensions import portbindings
 from neutron.openstack.common import importutils
+from neutron.openstack.common import jsonutils
 from neutron.openstack.common import log as logging
 from neutron.openstack.common import rpc
 from neutron.openstack.common.rpc import proxy
 from neutron.plugins.common import constants
+from neutron.services.loadbalancer import agent_scheduler
 from neutron.services.loadbalancer.drivers import abstract_driver
 
 LOG = logging.getLogger(__name__)
@@ -44,6 +50,12 @@ ACTIVE_PENDING = (
     constants.PENDING_UPDATE
 )
 
+# member statuses set from the health checks of the agents
+HEALTH_STATUSES = (
+    constants.ACTIVE,
+    constants.INACTIVE
+)
+
 AGENT_SCHEDULER_OPTS = [
     cfg.StrOpt('loadbalancer_pool_scheduler_driver',
                default='neutron.services.loadbalancer.agent_scheduler'
@@ -58,10 +70,35 @@ cfg.CONF.register_opts(AGENT_SCHEDULER_OPTS)
 TOPIC_PROCESS_ON_HOST = 'q-lbaas-process-on-host'
 TOPIC_LOADBALANCER_AGENT = 'lbaas_process_on_host_agent'
 
+# rows fetched at a time when listing the pools of an agent
+READY_POOLS_BATCH = 1000
+
+# the columns a pool's revision is hashed from, with the address and
+# subnet of each vip port fixed ip. Changes of other columns, or of the
+# subnets themselves, are not rendered or only picked up by a refresh.
+POOL_REVISION_FIELDS = ('protocol', 'lb_method', 'admin_state_up')
+VIP_REVISION_FIELDS = ('id', 'port_id', 'protocol', 'protocol_port',
+                       'connection_limit', 'admin_state_up')
+PERSISTENCE_REVISION_FIELDS = ('type', 'cookie_name')
+MEMBER_REVISION_FIELDS = ('id', 'address', 'protocol_port', 'weight',
+                          'admin_state_up')
+MONITOR_REVISION_FIELDS = ('id', 'type', 'delay', 'timeout', 'max_retries',
+                           'http_method', 'url_path', 'expected_codes',
+                           'admin_state_up')
+
+PENDING = (constants.PENDING_CREATE, constants.PENDING_UPDATE)
+
 
 class LoadBalancerCallbacks(object):
 
-    RPC_API_VERSION = '1.0'
+    RPC_API_VERSION = '1.5'
+    # history
+    #   1.0 Initial version
+    #   1.1 Support get_logical_devices call
+    #   1.2 Support revisions in get_ready_devices call
+    #   1.3 Support update_pools_stats call
+    #   1.4 Support update_member_statuses call
+    #   1.5 Support paging in get_ready_devices call
 
     def __init__(self, plugin):
         self.plugin = plugin
@@ -70,29 +107,112 @@ class LoadBalancerCallbacks(object):
         return q_rpc.PluginRpcDispatcher(
             [self, agents_db.AgentExtRpcCallback(self.plugin)])
 
-    def get_ready_devices(self, context, host=None):
+    def get_ready_devices(self, context, host=None, with_revisions=False,
+                          marker=None, limit=None):
+        """Return the ids of the pools the agent on host should serve.
+
+        With with_revisions, [pool_id, revision] pairs are returned instead,
+        the revision is None for pools with pending changes. Revisions are
+        hashed from a few columns of the pools, a page of pools at a time,
+        without building their logical devices. With limit, at most limit
+        pools are returned, the first ones after marker in id order.
+        """
+        pages = self._iter_ready_pool_pages(context, host, marker, limit)
+        if not with_revisions:
+            return [pool_id for page in pages for pool_id in page]
+
+        devices = []
+        for page in pages:
+            revisions = self._get_revisions(context, page)
+            devices.extend([pool_id, revisions.get(pool_id)]
+                           for pool_id in page)
+        return devices
+
+    def _iter_ready_pool_pages(self, context, host, marker=None, limit=None):
+        """Yield the ids of the ready pools, READY_POOLS_BATCH at a time.
+
+        The pools are paged in id order from marker by queries of their
+        own, only a page of rows is held at once.
+        """
+        while limit is None or limit > 0:
+            size = READY_POOLS_BATCH
+            if limit is not None:
+                size = min(size, limit)
+                limit -= size
+            page = self._get_ready_pool_ids(context, host, marker, size)
+            if page:
+                yield page
+            if len(page) < size:
+                return
+            marker = page[-1]
+
+    def _get_ready_pool_ids(self, context, host, marker, limit):
+        """Return a page of the ready pools bound to the agent on host.
+
+        A single query joins the pools to their vips and agent bindings.
+        """
+        binding = agent_scheduler.PoolLoadbalancerAgentBinding
         with context.session.begin(subtransactions=True):
             qry = (context.session.query(loadbalancer_db.Pool.id).
-                   join(loadbalancer_db.Vip))
-
+                   join(loadbalancer_db.Vip).
+                   join(binding,
+                        binding.pool_id == loadbalancer_db.Pool.id).
+                   join(agents_db.Agent,
+                        agents_db.Agent.id == binding.agent_id))
+
+            qry = qry.filter(agents_db.Agent.host == host)
+            qry = qry.filter(agents_db.Agent.agent_type ==
+                             q_const.AGENT_TYPE_LOADBALANCER)
             qry = qry.filter(loadbalancer_db.Vip.status.in_(ACTIVE_PENDING))
             qry = qry.filter(loadbalancer_db.Pool.status.in_(ACTIVE_PENDING))
             up = True  # makes pep8 and sqlalchemy happy
             qry = qry.filter(loadbalancer_db.Vip.admin_state_up == up)
             qry = qry.filter(loadbalancer_db.Pool.admin_state_up == up)
-            agents = self.plugin.get_lbaas_agents(context,
-                                                  filters={'host': [host]})
-            if not agents:
-                return []
-            elif len(agents) > 1:
-                LOG.warning(_('Multiple lbaas agents found on host %s'), host)
-
-            pools = self.plugin.list_pools_on_lbaas_agent(context,
-                                                          agents[0].id)
-            pool_ids = [pool['id'] for pool in pools['pools']]
-            qry = qry.filter(loadbalancer_db.Pool.id.in_(pool_ids))
+            if marker:
+                qry = qry.filter(loadbalancer_db.Pool.id > marker)
+            qry = qry.order_by(loadbalancer_db.Pool.id).limit(limit)
             return [id for id, in qry]
 
+    def _get_revisions(self, context, pool_ids):
+        """Return {pool_id: revision} of pools, see _get_revision."""
+        lb_db = loadbalancer_db
+        session = context.session
+        with session.begin(subtransactions=True):
+            pools = session.query(
+                lb_db.Pool.id, lb_db.Pool.status, lb_db.Vip.status,
+                *(_get_columns(lb_db.Pool, POOL_REVISION_FIELDS) +
+                  _get_columns(lb_db.Vip, VIP_REVISION_FIELDS) +
+                  _get_columns(lb_db.SessionPersistence,
+                               PERSISTENCE_REVISION_FIELDS) +
+                  [models_v2.IPAllocation.ip_address,
+                   models_v2.IPAllocation.subnet_id]))
+            pools = pools.join(lb_db.Vip, lb_db.Vip.id == lb_db.Pool.vip_id)
+            pools = pools.outerjoin(
+                lb_db.SessionPersistence,
+                lb_db.SessionPersistence.vip_id == lb_db.Vip.id)
+            pools = pools.outerjoin(
+                models_v2.IPAllocation,
+                models_v2.IPAllocation.port_id == lb_db.Vip.port_id)
+            pools = pools.filter(lb_db.Pool.id.in_(pool_ids))
+
+            members = session.query(
+                lb_db.Member.pool_id, lb_db.Member.status,
+                *_get_columns(lb_db.Member, MEMBER_REVISION_FIELDS))
+            members = members.filter(lb_db.Member.pool_id.in_(pool_ids))
+
+            monitors = session.query(
+                lb_db.PoolMonitorAssociation.pool_id,
+                lb_db.PoolMonitorAssociation.status,
+                *_get_columns(lb_db.HealthMonitor, MONITOR_REVISION_FIELDS))
+            monitors = monitors.join(
+                lb_db.HealthMonitor,
+                lb_db.HealthMonitor.id ==
+                lb_db.PoolMonitorAssociation.monitor_id)
+            monitors = monitors.filter(
+                lb_db.PoolMonitorAssociation.pool_id.in_(pool_ids))
+
+            return _hash_revisions(pools, members, monitors)
+
     def get_logical_device(self, context, pool_id=None, activate=True,
                            **kwargs):
         with context.session.begin(subtransactions=True):
@@ -100,51 +220,132 @@ class LoadBalancerCallbacks(object):
             qry = qry.filter_by(id=pool_id)
             pool = qry.one()
 
-            if activate:
-                # set all resources to active
-                if pool.status in ACTIVE_PENDING:
-                    pool.status = constants.ACTIVE
-
-                if pool.vip.status in ACTIVE_PENDING:
-                    pool.vip.status = constants.ACTIVE
+            return self._make_logical_device(context, pool, activate)
 
-                for m in pool.members:
-                    if m.status in ACTIVE_PENDING:
-                        m.status = constants.ACTIVE
+    def get_logical_devices(self, context, pool_ids=None, activate=True,
+                            host=None):
+        """Return {pool_id: logical device} for several pools at once.
 
-                for hm in pool.monitors:
-                    if hm.status in ACTIVE_PENDING:
-                        hm.status = constants.ACTIVE
+        Pools which are not active are left out of the result, without any
+        status change. All the pools are loaded with a few eager queries,
+        fixed ips of their vip ports included, and the subnets of these
+        ports are looked up only once.
+        """
+        devices = {}
+        if not pool_ids:
+            return devices
 
-            if (pool.status != constants.ACTIVE
-                or pool.vip.status != constants.ACTIVE):
-                raise q_exc.Invalid(_('Expected active pool and vip'))
+        with context.session.begin(subtransactions=True):
+            qry = context.session.query(loadbalancer_db.Pool)
+            qry = qry.options(
+                orm.joinedload('vip'),
+                orm.joinedload('vip.session_persistence'),
+                orm.joinedload('vip.port'),
+                orm.joinedload('vip.port.fixed_ips'),
+                orm.subqueryload('members'),
+                orm.subqueryload('monitors'),
+                orm.joinedload('monitors.healthmonitor')
+            )
+            qry = qry.filter(loadbalancer_db.Pool.id.in_(pool_ids))
+            pools = qry.all()
 
-            retval = {}
-            retval['pool'] = self.plugin._make_pool_dict(pool)
-            retval['vip'] = self.plugin._make_vip_dict(pool.vip)
-            retval['vip']['port'] = (
-                self.plugin._core_plugin._make_port_dict(pool.vip.port)
+            subnet_ids = set(
+                fixed_ip.subnet_id
+                for pool in pools if pool.vip and pool.vip.port
+                for fixed_ip in pool.vip.port.fixed_ips
             )
-            for fixed_ip in retval['vip']['port']['fixed_ips']:
-                fixed_ip['subnet'] = (
+            subnets = {}
+            if subnet_ids:
+                subnets = dict(
+                    (subnet['id'], subnet)
+                    for subnet in self.plugin._core_plugin.get_subnets(
+                        context, filters={'id': list(subnet_ids)})
+                )
+
+            for pool in pools:
+                if not pool.vip:
+                    continue
+                try:
+                    devices[pool.id] = self._make_logical_device(
+                        context, pool, activate, subnets)
+                except q_exc.Invalid:
+                    LOG.debug(_('Skipping pool %s which is not active'),
+                              pool.id)
+
+        return devices
+
+    def _make_logical_device(self, context, pool, activate, subnets=None):
+        """Build the logical device of a pool, in the caller's transaction.
+
+        subnets is an optional {subnet_id: subnet} cache, it is filled with
+        the subnets which have to be looked up.
+        """
+        if subnets is None:
+            subnets = {}
+
+        # checked before any status is changed, get_logical_devices commits
+        # the transaction even when this pool is skipped
+        allowed = activate and ACTIVE_PENDING or (constants.ACTIVE,)
+        if pool.status not in allowed or pool.vip.status not in allowed:
+            raise q_exc.Invalid(_('Expected active pool and vip'))
+
+        if activate:
+            # set all resources to active
+            pool.status = constants.ACTIVE
+            pool.vip.status = constants.ACTIVE
+
+            for m in pool.members:
+                if m.status in ACTIVE_PENDING:
+                    m.status = constants.ACTIVE
+
+            for hm in pool.monitors:
+                if hm.status in ACTIVE_PENDING:
+                    hm.status = constants.ACTIVE
+
+        retval = {}
+        retval['pool'] = self.plugin._make_pool_dict(pool)
+        retval['vip'] = self.plugin._make_vip_dict(pool.vip)
+        retval['vip']['port'] = (
+            self.plugin._core_plugin._make_port_dict(pool.vip.port)
+        )
+        for fixed_ip in retval['vip']['port']['fixed_ips']:
+            subnet_id = fixed_ip['subnet_id']
+            if subnet_id not in subnets:
+                subnets[subnet_id] = (
                     self.plugin._core_plugin.get_subnet(
                         context,
-                        fixed_ip['subnet_id']
+                        subnet_id
                     )
                 )
-            retval['members'] = [
-                self.plugin._make_member_dict(m)
-                for m in pool.members if m.status in (constants.ACTIVE,
-                                                      constants.INACTIVE)
-            ]
-            retval['healthmonitors'] = [
-                self.plugin._make_health_monitor_dict(hm.healthmonitor)
-                for hm in pool.monitors
-                if hm.status == constants.ACTIVE
-            ]
+            fixed_ip['subnet'] = subnets[subnet_id]
+        retval['members'] = [
+            self.plugin._make_member_dict(m)
+            for m in pool.members if m.status in (constants.ACTIVE,
+                                                  constants.INACTIVE)
+        ]
+        retval['healthmonitors'] = [
+            self.plugin._make_health_monitor_dict(hm.healthmonitor)
+            for hm in pool.monitors
+            if hm.status == constants.ACTIVE
+        ]
+        vip = pool.vip
+        retval['revision'] = _get_revision(
+            (_get_values(pool, POOL_REVISION_FIELDS) +
+             _get_values(vip, VIP_REVISION_FIELDS) +
+             _get_values(vip.session_persistence,
+                         PERSISTENCE_REVISION_FIELDS)),
+            [[ip.ip_address, ip.subnet_id] for ip in vip.port.fixed_ips],
+            [_get_values(m, MEMBER_REVISION_FIELDS)
+             for m in pool.members
+             if m.status in (constants.ACTIVE, constants.INACTIVE)],
+            [_get_values(hm.healthmonitor, MONITOR_REVISION_FIELDS)
+             for hm in pool.monitors if hm.status == constants.ACTIVE]
+        )
+        if not activate and _has_pending(pool):
+            # pending resources are only activated by the agent's fetch
+            retval['revision'] = None
 
-            return retval
+        return retval
 
     def pool_destroyed(self, context, pool_id=None, host=None):
         """Agent confirmation hook that a pool has been destroyed.
@@ -212,6 +413,133 @@ class LoadBalancerCallbacks(object):
     def update_pool_stats(self, context, pool_id=None, stats=None, host=None):
         self.plugin.update_pool_stats(context, pool_id, data=stats)
 
+    def update_pools_stats(self, context, pools_stats=None, host=None):
+        """Save the statistics of several pools in a single transaction.
+
+        Returns the number of pools updated, pools deleted or being deleted
+        in the meantime are skipped.
+        """
+        pools_stats = pools_stats or {}
+        updated = 0
+        with context.session.begin(subtransactions=True):
+            # a missing pool, or one which can't be modified anymore, would
+            # roll the whole batch back
+            qry = context.session.query(loadbalancer_db.Pool.id)
+            qry = qry.filter(loadbalancer_db.Pool.id.in_(list(pools_stats)))
+            qry = qry.filter(
+                loadbalancer_db.Pool.status != constants.PENDING_DELETE)
+            pool_ids = [pool_id for pool_id, in qry]
+
+            for pool_id in pool_ids:
+                # a failure inside a subtransaction would deactivate the
+                # whole batch, a savepoint only rolls back this pool
+                try:
+                    with context.session.begin_nested():
+                        self.plugin.update_pool_stats(
+                            context, pool_id, data=pools_stats[pool_id])
+                except loadbalancer.StateInvalid:
+                    LOG.debug(_('Skipping the stats of pool %s, it is '
+                                'being deleted'), pool_id)
+                    continue
+                updated += 1
+        return updated
+
+    def update_member_statuses(self, context, statuses=None, host=None):
+        """Apply the health check results of several members at once.
+
+        statuses maps member ids to ACTIVE or INACTIVE, only members in one
+        of these states are changed. Returns the number of members updated.
+        """
+        statuses = statuses or {}
+        updated = 0
+        with context.session.begin(subtransactions=True):
+            qry = context.session.query(loadbalancer_db.Member)
+            qry = qry.filter(loadbalancer_db.Member.id.in_(list(statuses)))
+            qry = qry.filter(loadbalancer_db.Member.status.in_(
+                HEALTH_STATUSES))
+            for member in qry:
+                status = statuses[member.id]
+                if status in HEALTH_STATUSES and member.status != status:
+                    member.status = status
+                    updated += 1
+        return updated
+
+
+def _get_revision(pool, fixed_ips, members, monitors):
+    """Return a hash of the columns a logical device is rendered from.
+
+    pool holds the values of the pool, vip and session persistence revision
+    fields, the other arguments are lists of the values of each vip fixed
+    ip, member and monitor. Member statuses follow the health checks and
+    are rendered alike, they are left out so that a health change does not
+    refresh the device.
+    """
+    return hashlib.sha1(jsonutils.dumps([
+        list(pool),
+        sorted(list(values) for values in fixed_ips),
+        sorted(list(values) for values in members),
+        sorted(list(values) for values in monitors),
+    ])).hexdigest()
+
+
+def _hash_revisions(pools, members, monitors):
+    """Return {pool_id: revision} from the rows of the revision queries.
+
+    pools rows hold the pool id, the pool and vip statuses, the revision
+    fields and one fixed ip. members and monitors rows hold the pool id,
+    the status and the revision fields.
+    """
+    values = {}
+    pending = set()
+    for row in pools:
+        pool_id, pool_status, vip_status = row[:3]
+        if pool_id not in values:
+            values[pool_id] = (row[3:-2], [], [], [])
+            if (pool_status != constants.ACTIVE or
+                    vip_status != constants.ACTIVE):
+                pending.add(pool_id)
+        if row[-2] is not None:
+            values[pool_id][1].append(row[-2:])
+
+    for row in members:
+        pool_id, status = row[:2]
+        if pool_id not in values:
+            continue
+        if status in PENDING:
+            pending.add(pool_id)
+        elif status in (constants.ACTIVE, constants.INACTIVE):
+            values[pool_id][2].append(row[2:])
+
+    for row in monitors:
+        pool_id, status = row[:2]
+        if pool_id not in values:
+            continue
+        if status in PENDING:
+            pending.add(pool_id)
+        elif status == constants.ACTIVE:
+            values[pool_id][3].append(row[2:])
+
+    return dict(
+        (pool_id,
+         None if pool_id in pending else _get_revision(*pool_values))
+        for pool_id, pool_values in values.items()
+    )
+
+
+def _get_columns(model, fields):
+    return [getattr(model, field) for field in fields]
+
+
+def _get_values(obj, fields):
+    if obj is None:
+        return [None] * len(fields)
+    return [getattr(obj, field) for field in fields]
+
+
+def _has_pending(pool):
+    return (any(m.status in PENDING for m in pool.members) or
+            any(hm.status in PENDING for hm in pool.monitors))
+
 
 class LoadBalancerAgentApi(proxy.RpcProxy):
     """Plugin side of plugin to agent RPC API."""
@@ -338,6 +666,93 @@ class SEnginxOnHostPluginDriver(abstract_driver.LoadBalancerAbstractDriver):
         agent = self.get_pool_agent(context, member['pool_id'])
         self.agent_rpc.modify_pool(context, member['pool_id'], agent['host'])
 
+    def create_members(self, context, members):
+        """Create several members in a single transaction.
+
+        members are member dicts as accepted by the plugin's create_member,
+        each affected pool is notified once. Returns the created members.
+        """
+        # the plugin's own methods would notify for each member
+        lb_db = loadbalancer_db.LoadBalancerPluginDb
+        with context.session.begin(subtransactions=True):
+            created = [
+                lb_db.create_member(self.plugin, context, {'member': member})
+                for member in members
+            ]
+        self._modify_pools(context,
+                           set(member['pool_id'] for member in created))
+        return created
+
+    def update_members(self, context, members):
+        """Update several members, given as {member_id: member dict}.
+
+        Pools the members moved from are notified as well. Returns the
+        updated members.
+        """
+        lb_db = loadbalancer_db.LoadBalancerPluginDb
+        for member in members.values():
+            # like the plugin, the agent sets them ACTIVE once applied
+            member.setdefault('status', constants.PENDING_UPDATE)
+        with context.session.begin(subtransactions=True):
+            old_pool_ids = set(
+                self.plugin.get_member(context, member_id)['pool_id']
+                for member_id in members)
+            updated = [
+                lb_db.update_member(self.plugin, context, member_id,
+                                    {'member': member})
+                for member_id, member in members.items()
+            ]
+
+        pool_ids = set(member['pool_id'] for member in updated)
+        self._modify_pools(context, old_pool_ids - pool_ids, required=False)
+        self._modify_pools(context, pool_ids)
+        return updated
+
+    def delete_members(self, context, member_ids):
+        """Delete several members in a single transaction."""
+        with context.session.begin(subtransactions=True):
+            pool_ids = set()
+            for member_id in member_ids:
+                pool_ids.add(
+                    self.plugin.get_member(context, member_id)['pool_id'])
+                self.plugin._delete_db_member(context, member_id)
+        self._modify_pools(context, pool_ids)
+
+    def create_pool_health_monitors(self, context, associations):
+        """Associate health monitors to pools in a single transaction.
+
+        associations is a list of (health_monitor_id, pool_id) pairs.
+        """
+        # the plugin's own method would notify for each association
+        lb_db = loadbalancer_db.LoadBalancerPluginDb
+        with context.session.begin(subtransactions=True):
+            for health_monitor_id, pool_id in associations:
+                lb_db.create_pool_health_monitor(
+                    self.plugin, context,
+                    {'health_monitor': {'id': health_monitor_id}}, pool_id)
+        self._modify_pools(context, set(pair[1] for pair in associations))
+
+    def delete_pool_health_monitors(self, context, associations):
+        """Remove (health_monitor_id, pool_id) associations at once."""
+        with context.session.begin(subtransactions=True):
+            for health_monitor_id, pool_id in associations:
+                self.plugin._delete_db_pool_health_monitor(
+                    context, health_monitor_id, pool_id)
+        self._modify_pools(context, set(pair[1] for pair in associations))
+
+    def _modify_pools(self, context, pool_ids, required=True):
+        """Notify the agent hosting each pool once."""
+        for pool_id in pool_ids:
+            if required:
+                agent = self.get_pool_agent(context, pool_id)
+            else:
+                agent = self.plugin.get_lbaas_agent_hosting_pool(context,
+                                                                 pool_id)
+                if not agent:
+                    continue
+                agent = agent['agent']
+            self.agent_rpc.modify_pool(context, pool_id, agent['host'])
+
     def update_health_monitor(self, context, old_health_monitor,
                               health_monitor, pool_id):
         # monitors are unused here because agent will fetch what is necessary
@@ -0,0 +1,273 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+"""A long-lived privileged helper for the SEnginx driver.
+
+The helper is started once through the root helper and runs the commands
+allowed by the rootwrap filters on behalf of the agent, so a command costs
+a fork instead of a new rootwrap interpreter. The agent talks to it over a
+unix socket which only the agent user can open, one JSON request per line.
+
+The rootwrap configuration and the socket directory are fixed, the agent
+only passes its uid, so that the helper enforces the same filters as
+rootwrap and never writes where the agent tells it to.
+"""
+
+import ConfigParser
+import errno
+import json
+import logging as std_logging
+import os
+import socket
+import SocketServer
+import stat
+import subprocess
+import sys
+import threading
+import time
+
+from neutron.agent.linux import utils
+from neutron.openstack.common import log as logging
+from neutron.rootwrap import wrapper
+
+LOG = logging.getLogger(__name__)
+
+HELPER_CMD = 'neutron-senginx-privhelper'
+ROOTWRAP_CONFIG = '/etc/neutron/rootwrap.conf'
+
+# created by the helper, owned by root so that only it writes there
+SOCKET_DIR = '/var/run/neutron-senginx'
+SOCKET_PATH = os.path.join(SOCKET_DIR, 'privhelper.sock')
+
+CONNECT_TIMEOUT = 5
+START_RETRY_INTERVAL = 60
+MAX_REQUEST_LENGTH = 64 * 1024
+
+
+class HelperUnavailable(Exception):
+    pass
+
+
+class PrivHelperClient(object):
+    """Run privileged commands through the helper, starting it if needed."""
+
+    def __init__(self, root_helper, sock_path=SOCKET_PATH):
+        self.sock_path = sock_path
+        self.root_helper = root_helper
+        self.next_start = 0
+
+    def execute(self, cmd, check_exit_code=True, process_input=None):
+        request = {'cmd': cmd, 'input': process_input}
+        try:
+            reply = self._request(request)
+        except (IOError, socket.error):
+            self._start()
+            try:
+                reply = self._request(request)
+            except (IOError, socket.error) as e:
+                raise HelperUnavailable(str(e))
+
+        if 'error' in reply:
+            # the command is not allowed by the filters
+            raise RuntimeError(reply['error'])
+
+        if reply['returncode'] and check_exit_code:
+            raise RuntimeError(_('\nCommand: %(cmd)s\nExit code: %(code)s\n'
+                                 'Stdout: %(stdout)r\nStderr: %(stderr)r') %
+                               {'cmd': cmd, 'code': reply['returncode'],
+                                'stdout': reply['stdout'],
+                                'stderr': reply['stderr']})
+        return reply['stdout']
+
+    def stop(self):
+        """Stop the helper if it is running, it removes its socket."""
+        try:
+            self._request({'stop': True})
+        except (IOError, socket.error):
+            # not running
+            pass
+
+    def _request(self, request):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(self.sock_path)
+            # the command itself may take its time
+            sock.settimeout(None)
+            sock.sendall(json.dumps(request) + '\n')
+            reply = sock.makefile('r').readline()
+        finally:
+            sock.close()
+
+        if not reply:
+            raise IOError(errno.ECONNRESET,
+                          _('Privileged helper closed the connection'))
+        return json.loads(reply)
+
+    def _start(self):
+        now = time.time()
+        if now < self.next_start:
+            raise HelperUnavailable(_('Privileged helper is not running'))
+        self.next_start = now + START_RETRY_INTERVAL
+
+        LOG.info(_('Starting the privileged helper on %s'), self.sock_path)
+        try:
+            # returns once the helper listens on its socket
+            utils.execute([HELPER_CMD, str(os.getuid())], self.root_helper)
+        except RuntimeError as e:
+            raise HelperUnavailable(str(e))
+
+
+def execute(helper, cmd, root_helper, check_exit_code=True,
+            process_input=None):
+    """Run a command through the helper if any, else through rootwrap."""
+    if helper:
+        try:
+            return helper.execute(cmd, check_exit_code, process_input)
+        except HelperUnavailable as e:
+            LOG.warn(_('Privileged helper unavailable, using the root '
+                       'helper: %s'), e)
+
+    return utils.execute(cmd, root_helper, check_exit_code=check_exit_code,
+                         process_input=process_input)
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline(MAX_REQUEST_LENGTH)
+        if not line:
+            return
+        stop = False
+        try:
+            request = json.loads(line)
+            stop = request.get('stop', False)
+            if stop:
+                reply = {'returncode': 0, 'stdout': '', 'stderr': ''}
+            else:
+                reply = self.server.run(request['cmd'], request.get('input'))
+        except Exception as e:
+            reply = {'error': str(e)}
+        self.wfile.write(json.dumps(reply) + '\n')
+        if stop:
+            self.server.stop()
+
+
+class _HelperServer(SocketServer.ThreadingMixIn,
+                    SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, sock_path, config, filters):
+        if os.path.exists(sock_path):
+            os.unlink(sock_path)
+        SocketServer.UnixStreamServer.__init__(self, sock_path,
+                                               _RequestHandler)
+        self.sock_path = sock_path
+        self.config = config
+        self.filters = filters
+
+    def stop(self):
+        """Remove the socket and make serve_forever return."""
+        try:
+            os.unlink(self.sock_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        # shutdown waits for serve_forever, which may run in this thread
+        threading.Thread(target=self.shutdown).start()
+
+    def run(self, userargs, process_input=None):
+        userargs = [str(arg) for arg in userargs]
+        try:
+            obj = wrapper.match_filter(self.filters, userargs,
+                                       exec_dirs=self.config.exec_dirs)
+        except wrapper.FilterMatchNotExecutable as exc:
+            return {'error': 'Executable not found: %s' % exc.match.exec_path}
+        except wrapper.NoFilterMatched:
+            return {'error': 'Unauthorized command: %s' % ' '.join(userargs)}
+
+        command = obj.get_command(userargs, exec_dirs=self.config.exec_dirs)
+        if self.config.use_syslog:
+            std_logging.info('Executing %s (filter match = %s)' % (
+                command, obj.name))
+
+        proc = subprocess.Popen(command,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                close_fds=True,
+                                env=obj.get_environment(userargs))
+        stdout, stderr = proc.communicate(process_input)
+        return {'returncode': proc.returncode,
+                'stdout': stdout,
+                'stderr': stderr}
+
+
+def _daemonize():
+    if os.fork():
+        # the agent waits for this process, the socket is ready already
+        os._exit(0)
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+
+def _make_socket_dir():
+    """Create the socket directory, refusing one root does not own."""
+    try:
+        os.mkdir(SOCKET_DIR, 0o755)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(SOCKET_DIR)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != 0:
+        sys.stderr.write('%s is not a directory owned by root\n' % SOCKET_DIR)
+        sys.exit(1)
+    os.chmod(SOCKET_DIR, 0o755)
+
+
+def main():
+    """Entry point, run through the root helper as:
+
+        neutron-senginx-privhelper <uid>
+    """
+    if len(sys.argv) != 2 or not sys.argv[1].isdigit():
+        sys.stderr.write('Usage: %s <uid>\n' % HELPER_CMD)
+        sys.exit(1)
+    owner = int(sys.argv[1])
+
+    rawconfig = ConfigParser.RawConfigParser()
+    rawconfig.read(ROOTWRAP_CONFIG)
+    config = wrapper.RootwrapConfig(rawconfig)
+    if config.use_syslog:
+        wrapper.setup_syslog(HELPER_CMD, config.syslog_log_facility,
+                             config.syslog_log_level)
+    filters = wrapper.load_filters(config.filters_path)
+
+    _make_socket_dir()
+    server = _HelperServer(SOCKET_PATH, config, filters)
+    # only the agent may send commands
+    os.chmod(SOCKET_PATH, 0o600)
+    os.chown(SOCKET_PATH, owner, -1)
+
+    _daemonize()
+    try:
+        # until the agent stops
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,88 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+import os
+
+from neutron.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+SENGINX_BIN = '/usr/local/senginx/sbin/nginx'
+PROC_PATH = '/proc'
+
+
+class ProcessTracker(object):
+    """Check the liveness of SEnginx masters without running commands.
+
+    A master is trusted when its command line runs SENGINX_BIN with the
+    configuration of the instance. Verified masters are cached with their
+    start time, so a recycled pid is never mistaken for them.
+    """
+
+    def __init__(self):
+        self.masters = {}
+
+    def is_alive(self, instance_id, pid_path, conf_path):
+        pid = _read_pid(pid_path)
+        start_time = pid and _get_start_time(pid)
+        if not start_time:
+            self.invalidate(instance_id)
+            return False
+
+        if self.masters.get(instance_id) == (pid, start_time):
+            return True
+
+        if not _is_senginx_master(pid, conf_path):
+            LOG.debug(_('Process %(pid)s is not the SEnginx master of '
+                        '%(instance)s'), {'pid': pid, 'instance': instance_id})
+            self.invalidate(instance_id)
+            return False
+
+        self.masters[instance_id] = (pid, start_time)
+        return True
+
+    def invalidate(self, instance_id):
+        self.masters.pop(instance_id, None)
+
+
+def _read_pid(pid_path):
+    try:
+        with open(pid_path, 'r') as pid_file:
+            return int(pid_file.read().split()[0])
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+def _get_start_time(pid):
+    try:
+        with open(os.path.join(PROC_PATH, str(pid), 'stat'), 'r') as stat:
+            # the command name can contain spaces, the fields after it
+            # start with the state, the start time is the 22nd field
+            return stat.read().rsplit(')', 1)[1].split()[19]
+    except (IOError, IndexError):
+        return None
+
+
+def _is_senginx_master(pid, conf_path):
+    try:
+        with open(os.path.join(PROC_PATH, str(pid), 'cmdline'), 'r') as cmd:
+            # the master rewrites its title into a single string
+            cmdline = cmd.read().replace('\0', ' ').split()
+    except IOError:
+        return False
+    return SENGINX_BIN in cmdline and conf_path in cmdline
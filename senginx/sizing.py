@@ -0,0 +1,135 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+import multiprocessing
+import zlib
+
+from oslo.config import cfg
+
+from neutron.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+OPTS = [
+    cfg.StrOpt(
+        'worker_profile',
+        default='auto',
+        help=_('Worker sizing profile of the SEnginx instances: small, '
+               'medium, large, or auto to pick one from each pool'),
+    ),
+    cfg.BoolOpt(
+        'worker_cpu_affinity',
+        default=False,
+        help=_('Bind the workers of an instance to distinct CPUs'),
+    ),
+]
+
+cfg.CONF.register_opts(OPTS)
+
+AUTO = 'auto'
+
+# worker_processes None means one worker per CPU
+PROFILES = {
+    'small': {'worker_processes': 1, 'worker_connections': 1024},
+    'medium': {'worker_processes': 2, 'worker_connections': 10240},
+    'large': {'worker_processes': None, 'worker_connections': 65535},
+}
+
+# the auto profile thresholds
+SMALL_CONNECTION_LIMIT = 1000
+LARGE_CONNECTION_LIMIT = 20000
+LARGE_MEMBER_COUNT = 100
+
+MIN_WORKER_CONNECTIONS = 512
+
+# descriptors for the logs, the listeners and the status socket of a worker
+RLIMIT_NOFILE_MARGIN = 64
+
+
+def get_profile_name(config):
+    """Return the profile of a pool, config is None for a shared instance."""
+    profile = cfg.CONF.worker_profile
+    if profile != AUTO:
+        if profile not in PROFILES:
+            LOG.warn(_('Unknown worker profile %s, using auto'), profile)
+        else:
+            return profile
+
+    if config is None:
+        return 'large'
+
+    limit = config['vip'].get('connection_limit') or -1
+    if limit > LARGE_CONNECTION_LIMIT:
+        return 'large'
+    if len(config['members']) >= LARGE_MEMBER_COUNT:
+        return 'large'
+    if 0 < limit <= SMALL_CONNECTION_LIMIT:
+        return 'small'
+    return 'medium'
+
+
+def get_worker_sizing(config, cpu_count=None):
+    """Return the worker settings of an instance.
+
+    config is the logical config of the pool, or None for a shared instance.
+    """
+    name = get_profile_name(config)
+    profile = PROFILES[name]
+    cpu_count = cpu_count or _get_cpu_count()
+
+    processes = min(profile['worker_processes'] or cpu_count, cpu_count)
+    connections = profile['worker_connections']
+
+    # each proxied connection needs a client and a member connection; the
+    # connections are not spread evenly over the workers, so every worker
+    # must be able to take the whole limit
+    limit = config and config['vip'].get('connection_limit') or -1
+    if limit > 0:
+        needed = 2 * limit + 1
+        connections = min(connections, max(needed, MIN_WORKER_CONNECTIONS))
+
+    sizing = {
+        'profile': name,
+        'worker_processes': processes,
+        'worker_connections': connections,
+        'worker_rlimit_nofile': 2 * connections + RLIMIT_NOFILE_MARGIN,
+    }
+
+    if cfg.CONF.worker_cpu_affinity:
+        # spread the pools over the CPUs instead of all starting on CPU 0
+        offset = 0
+        if config:
+            offset = zlib.crc32(config['pool']['id']) & 0xffffffff
+        sizing['worker_cpu_affinity'] = [
+            _get_cpu_mask((offset + i) % cpu_count, cpu_count)
+            for i in range(processes)
+        ]
+
+    return sizing
+
+
+def _get_cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _get_cpu_mask(cpu, cpu_count):
+    return ''.join(i == cpu and '1' or '0'
+                   for i in reversed(range(cpu_count)))
@@ -0,0 +1,424 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+import httplib
+import os
+import socket
+
+from neutron.agent.linux import utils
+from neutron.openstack.common import jsonutils
+from neutron.openstack.common import log as logging
+from neutron.services.loadbalancer import constants as lb_const
+from neutron.services.loadbalancer.drivers.senginx import cfg as secfg
+
+LOG = logging.getLogger(__name__)
+
+STATUS_TIMEOUT = 2
+
+# connections to the status listeners kept open between two polls
+MAX_IDLE_STATUS_CONNECTIONS = 32
+
+# bound the work and the memory spent on a single collection
+READ_CHUNK_SIZE = 64 * 1024
+MAX_READ_PER_CYCLE = 16 * 1024 * 1024
+MAX_LINE_LENGTH = 4096
+MAX_TRACKED_PEERS = 1024
+
+CHECK_STATUS_MAP = {
+    'up': secfg.ACTIVE,
+    'down': secfg.INACTIVE,
+}
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """An HTTP connection to the status listener of a SEnginx instance."""
+
+    def __init__(self, sock_path, timeout=STATUS_TIMEOUT):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.sock_path = sock_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.sock_path)
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class StatusConnectionPool(object):
+    """Reuse the connections to the status listeners between polls.
+
+    At most max_idle connections are kept open. The pools are polled in
+    turn, so once the pool is full new connections are closed instead of
+    evicting the kept ones, which would never be reused otherwise.
+    """
+
+    def __init__(self, max_idle=MAX_IDLE_STATUS_CONNECTIONS):
+        self.max_idle = max_idle
+        self.idle = {}
+
+    def fetch(self, sock_path, uri):
+        conn = self.idle.pop(sock_path, None)
+        if conn is not None:
+            try:
+                return self._fetch(conn, sock_path, uri)
+            except (socket.error, httplib.HTTPException):
+                # the listener closed the idle connection, open a new one
+                conn.close()
+
+        return self._fetch(UnixHTTPConnection(sock_path), sock_path, uri)
+
+    def _fetch(self, conn, sock_path, uri):
+        try:
+            conn.request('GET', uri)
+            response = conn.getresponse()
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+
+        if response.status != httplib.OK:
+            conn.close()
+            raise IOError(_('Unexpected status %(status)s from %(uri)s') %
+                          {'status': response.status, 'uri': uri})
+
+        if response.will_close or len(self.idle) >= self.max_idle:
+            conn.close()
+        else:
+            self.idle[sock_path] = conn
+        return data
+
+    def close(self, sock_path):
+        conn = self.idle.pop(sock_path, None)
+        if conn is not None:
+            conn.close()
+
+
+def fetch_status(sock_path, uri, connections=None):
+    if connections is not None:
+        return connections.fetch(sock_path, uri)
+
+    conn = UnixHTTPConnection(sock_path)
+    try:
+        conn.request('GET', uri)
+        response = conn.getresponse()
+        if response.status != httplib.OK:
+            raise IOError(_('Unexpected status %(status)s from %(uri)s') %
+                          {'status': response.status, 'uri': uri})
+        return response.read()
+    finally:
+        conn.close()
+
+
+def parse_stub_status(data):
+    """Return the number of active connections from stub_status output."""
+    for line in data.splitlines():
+        if line.startswith('Active connections:'):
+            return int(line.split(':', 1)[1])
+    return 0
+
+
+def parse_check_status(data, upstream=None):
+    """Return {'address:port': status} from check_status csv output.
+
+    Each line is: index,upstream,name,status,rise,fall,type,port
+    With upstream, only the servers of that upstream are returned.
+    """
+    statuses = {}
+    for line in data.splitlines():
+        fields = line.split(',')
+        if len(fields) < 4:
+            continue
+        if upstream and fields[1].strip() != upstream:
+            continue
+        status = CHECK_STATUS_MAP.get(fields[3].strip())
+        if status:
+            statuses[fields[2].strip()] = status
+    return statuses
+
+
+class AccessLogReader(object):
+    """Incrementally account an access log written with secfg log formats.
+
+    The byte offset, the inode and the running totals are saved next to the
+    log, so every line is parsed once, even across agent restarts. The
+    totals are scaled as the lines are accounted, to the traffic a sampled
+    log stands for.
+    """
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.state_path = log_path + '.state'
+        self.inode = None
+        self.offset = 0
+        # the offset is within a runaway line, skipped up to its end
+        self.skipping = False
+        # the renamed log, written until SEnginx reopens its logs
+        self.rotated_path = None
+        self.totals = _new_counters()
+        self.peers = {}
+        self._load_state()
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, 'r') as state_file:
+                state = jsonutils.loads(state_file.read())
+            self.inode = state['inode']
+            self.offset = state['offset']
+            self.skipping = state.get('skipping', False)
+            self.rotated_path = state.get('rotated_path')
+            self.totals = state['totals']
+            self.peers = state['peers']
+        except Exception:
+            LOG.warn(_('Ignoring corrupted access log state %s'),
+                     self.state_path)
+
+    def _save_state(self):
+        state = {
+            'inode': self.inode,
+            'offset': self.offset,
+            'skipping': self.skipping,
+            'rotated_path': self.rotated_path,
+            'totals': self.totals,
+            'peers': self.peers,
+        }
+        utils.replace_file(self.state_path, jsonutils.dumps(state))
+
+    def rotated(self, rotated_path):
+        """Record that the log was renamed to rotated_path.
+
+        The lines written to it until the log is reopened are read before
+        the new log.
+        """
+        self.rotated_path = rotated_path
+        self._save_state()
+
+    def read(self, scale=1.0):
+        """Account the lines appended since the last call."""
+        if self.rotated_path and not self._read_rotated(scale):
+            return
+
+        try:
+            st = os.stat(self.log_path)
+        except OSError:
+            return
+
+        # the log was rotated or truncated, start over from its beginning
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            self.inode = st.st_ino
+            self.offset = 0
+            self.skipping = False
+
+        if st.st_size == self.offset:
+            return
+
+        with open(self.log_path, 'rb') as log_file:
+            log_file.seek(self.offset)
+            self._read_lines(log_file, st.st_size - self.offset, scale)
+
+        self._save_state()
+
+    def _read_rotated(self, scale):
+        """Read the end of the rotated log, return True once it is done.
+
+        It is done when it was read to its end after the log was reopened.
+        """
+        reopened = os.path.exists(self.log_path)
+        try:
+            st = os.stat(self.rotated_path)
+        except OSError:
+            st = None
+
+        if st and st.st_ino == self.inode and st.st_size > self.offset:
+            with open(self.rotated_path, 'rb') as log_file:
+                log_file.seek(self.offset)
+                self._read_lines(log_file, st.st_size - self.offset, scale)
+            done = reopened and self.offset >= st.st_size
+        else:
+            done = reopened
+
+        if done:
+            self.rotated_path = None
+        self._save_state()
+        return done
+
+    def _read_lines(self, log_file, size, scale):
+        pending = ''
+        remaining = min(size, MAX_READ_PER_CYCLE)
+        while remaining > 0:
+            chunk = log_file.read(min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+
+            if self.skipping:
+                end = chunk.find('\n')
+                if end < 0:
+                    self.offset += len(chunk)
+                    continue
+                self.offset += end + 1
+                chunk = chunk[end + 1:]
+                self.skipping = False
+
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                self.offset += len(line) + 1
+                self._account(line, scale)
+
+            # never buffer a runaway line, its end is not a line either
+            if len(pending) > MAX_LINE_LENGTH:
+                self.offset += len(pending)
+                pending = ''
+                self.skipping = True
+
+        # an incomplete last line is read again on the next call
+
+    def _account(self, line, scale):
+        fields = line.split()
+        if len(fields) < 4:
+            return
+        try:
+            bytes_in = int(fields[1])
+            bytes_out = int(fields[2])
+        except ValueError:
+            return
+
+        _add(self.totals, bytes_in, bytes_out, scale)
+
+        # with retries only the last peer has served the request
+        peer = fields[-1].rstrip(',')
+        if peer == '-':
+            return
+        if peer not in self.peers:
+            if len(self.peers) >= MAX_TRACKED_PEERS:
+                return
+            self.peers[peer] = _new_counters()
+        _add(self.peers[peer], bytes_in, bytes_out, scale)
+
+
+class PoolStats(object):
+    """Statistics collector of one pool.
+
+    For a pool served by a shared instance, sock_path is the status listener
+    of that instance and upstream is the pool's upstream in it. connections
+    is an optional StatusConnectionPool shared by the pools.
+    """
+
+    def __init__(self, state_dir, sock_path=None, upstream=None,
+                 connections=None):
+        self.sock_path = (sock_path or
+                          os.path.join(state_dir, secfg.STATUS_SOCKET))
+        self.upstream = upstream
+        self.connections = connections
+        self.readers = [
+            AccessLogReader(os.path.join(state_dir, secfg.HTTP_ACCESS_LOG)),
+            AccessLogReader(os.path.join(state_dir, secfg.TCP_ACCESS_LOG)),
+        ]
+
+    def read_logs(self, scale=1.0):
+        for reader in self.readers:
+            reader.read(scale)
+
+    def log_rotated(self, log_path, rotated_path):
+        for reader in self.readers:
+            if reader.log_path == log_path:
+                reader.rotated(rotated_path)
+
+    def get_member_statuses(self):
+        try:
+            data = fetch_status(self.sock_path, secfg.CHECK_STATUS_URI,
+                                self.connections)
+        except (IOError, socket.error, httplib.HTTPException):
+            # no health monitor or the pool has no members
+            return {}
+        return parse_check_status(data, self.upstream)
+
+    def get_active_connections(self):
+        if self.upstream:
+            # a shared instance only counts connections of all its pools
+            return 0
+        try:
+            data = fetch_status(self.sock_path, secfg.STUB_STATUS_URI,
+                                self.connections)
+        except (IOError, socket.error, httplib.HTTPException):
+            LOG.debug(_('Unable to get stub status from %s'), self.sock_path)
+            return 0
+        # do not count the status request itself
+        return max(parse_stub_status(data) - 1, 0)
+
+    def get_stats(self, members, scale=1.0):
+        """Return the pool statistics.
+
+        members maps 'address:port' of every pool member to its id, the
+        logged counters are multiplied by scale when logs are sampled. A
+        scale of None means nothing is logged, the counters taken from the
+        logs are then left out rather than reported as zeros.
+        """
+        counted = scale is not None
+        stats = {}
+        member_stats = {}
+        if counted:
+            self.read_logs(scale)
+            stats = _new_counters()
+            for reader in self.readers:
+                _merge(stats, reader.totals)
+                for peer, counters in reader.peers.items():
+                    member_id = members.get(peer)
+                    if member_id:
+                        _merge(member_stats.setdefault(member_id,
+                                                       _new_counters()),
+                               counters)
+
+        for peer, status in self.get_member_statuses().items():
+            member_id = members.get(peer)
+            if member_id:
+                member_stats.setdefault(
+                    member_id, counted and _new_counters() or {})[
+                        lb_const.STATS_STATUS] = status
+
+        stats[lb_const.STATS_ACTIVE_CONNECTIONS] = (
+            self.get_active_connections())
+        stats['members'] = member_stats
+
+        return stats
+
+
+def _new_counters():
+    return {
+        lb_const.STATS_IN_BYTES: 0,
+        lb_const.STATS_OUT_BYTES: 0,
+        lb_const.STATS_TOTAL_CONNECTIONS: 0,
+    }
+
+
+def _add(counters, bytes_in, bytes_out, scale=1.0):
+    counters[lb_const.STATS_IN_BYTES] += bytes_in * scale
+    counters[lb_const.STATS_OUT_BYTES] += bytes_out * scale
+    counters[lb_const.STATS_TOTAL_CONNECTIONS] += scale
+
+
+def _merge(counters, other):
+    for key in (lb_const.STATS_IN_BYTES, lb_const.STATS_OUT_BYTES,
+                lb_const.STATS_TOTAL_CONNECTIONS):
+        counters[key] += int(other[key])
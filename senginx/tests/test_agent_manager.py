@@ -0,0 +1,246 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+import os
+import shutil
+import stat
+import tempfile
+
+import eventlet
+import mock
+
+from neutron.services.loadbalancer import constants as lb_const
+from neutron.services.loadbalancer.drivers.senginx import agent_manager
+from neutron.tests import base
+
+
+def make_config(pool_id):
+    return {'pool': {'id': pool_id}, 'vip': {'port_id': 'port1'}}
+
+
+class TestLbaasAgentManager(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestLbaasAgentManager, self).setUp()
+        # the rpc and driver set up of __init__ are not needed
+        self.mgr = agent_manager.LbaasAgentManager.__new__(
+            agent_manager.LbaasAgentManager)
+        self.mgr.driver = mock.Mock()
+        self.mgr.plugin_rpc = mock.Mock()
+        self.mgr.cache = agent_manager.LogicalDeviceCache()
+        self.mgr.pool_locks = agent_manager.PoolLocks()
+        self.mgr.last_stats = {}
+        self.mgr.member_statuses = {}
+        self.mgr.needs_resync = False
+        self.events = []
+
+    def record(self, name):
+        def _record(*args):
+            self.events.append(name + '-start')
+            eventlet.sleep(0.01)
+            self.events.append(name + '-end')
+        return _record
+
+    def test_refresh_and_destroy_are_serialized(self):
+        self.mgr.cache.put(make_config('pool1'))
+        self.mgr.driver.exists.return_value = True
+        self.mgr.driver.update.side_effect = self.record('update')
+        self.mgr.driver.destroy.side_effect = self.record('destroy')
+
+        pool = eventlet.GreenPool()
+        pool.spawn_n(self.mgr.refresh_device, 'pool1', make_config('pool1'))
+        pool.spawn_n(self.mgr.destroy_device, 'pool1')
+        pool.waitall()
+
+        self.assertEqual(['update-start', 'update-end',
+                          'destroy-start', 'destroy-end'], self.events)
+        self.assertFalse(self.mgr.needs_resync)
+
+    def test_check_device_recreates_under_lock(self):
+        self.mgr.driver.exists.return_value = False
+        self.mgr.plugin_rpc.get_logical_device.return_value = make_config(
+            'pool1')
+        self.mgr.driver.create.side_effect = self.record('create')
+
+        pool = eventlet.GreenPool()
+        pool.spawn_n(self.mgr.check_device, 'pool1')
+        pool.spawn_n(self.mgr.check_device, 'pool1')
+        pool.waitall()
+
+        self.assertEqual(['create-start', 'create-end'] * 2, self.events)
+
+    def test_check_device_updates_a_stale_device(self):
+        config = make_config('pool1')
+        self.mgr.cache.put(config)
+        self.mgr.driver.exists.return_value = True
+        self.mgr.driver.is_stale.return_value = False
+        self.mgr.check_device('pool1')
+        self.assertFalse(self.mgr.driver.update.called)
+
+        self.mgr.driver.is_stale.return_value = True
+        self.mgr.check_device('pool1')
+        self.mgr.driver.update.assert_called_once_with(config)
+        self.assertFalse(self.mgr.plugin_rpc.get_logical_device.called)
+
+    def prepare_sync(self, revisions):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        self.mgr.conf = mock.Mock(sync_concurrency=4, sync_chunk_size=10)
+        self.mgr.agent_state = {'configurations': {}}
+        self.mgr.cache_path = os.path.join(state_dir,
+                                           agent_manager.CACHE_SNAPSHOT)
+        self.mgr.remove_orphans = mock.Mock()
+        self.mgr.driver.end_batch.return_value = []
+        self.mgr.driver.exists.return_value = False
+        self.mgr.plugin_rpc.get_ready_device_revisions.return_value = (
+            revisions)
+        self.mgr.plugin_rpc.get_logical_devices.side_effect = (
+            lambda pool_ids: dict((pool_id, make_config(pool_id))
+                                  for pool_id in pool_ids))
+
+    def test_sync_refreshes_pools_concurrently(self):
+        self.prepare_sync({'pool1': 'rev1', 'pool2': 'rev2', 'pool3': None})
+        self.mgr.driver.create.side_effect = self.record('create')
+
+        self.mgr.sync_state()
+        self.assertEqual(['create-start'] * 3 + ['create-end'] * 3,
+                         self.events)
+        self.assertEqual(['pool1', 'pool2', 'pool3'],
+                         sorted(self.mgr.cache.get_pool_ids()))
+        self.mgr.remove_orphans.assert_called_once_with(
+            set(['pool1', 'pool2', 'pool3']))
+
+    def test_sync_destroys_before_refreshing(self):
+        self.prepare_sync({'pool2': 'rev2'})
+        self.mgr.cache.put(make_config('pool1'))
+        self.mgr.driver.destroy.side_effect = self.record('destroy')
+        self.mgr.driver.create.side_effect = self.record('create')
+
+        self.mgr.sync_state()
+        self.assertEqual(['destroy-start', 'destroy-end',
+                          'create-start', 'create-end'], self.events)
+        self.assertEqual(['pool2'], list(self.mgr.cache.get_pool_ids()))
+
+    def test_failed_sync_does_not_remove_orphans(self):
+        self.prepare_sync({'pool1': 'rev1', 'pool2': 'rev2'})
+
+        def create(logical_config):
+            if logical_config['pool']['id'] == 'pool2':
+                raise RuntimeError()
+        self.mgr.driver.create.side_effect = create
+
+        self.mgr.sync_state()
+        self.assertTrue(self.mgr.needs_resync)
+        self.assertFalse(self.mgr.remove_orphans.called)
+
+    def test_stop_stops_the_driver(self):
+        self.mgr.work_queue = mock.Mock()
+        self.mgr.stop()
+        self.assertTrue(self.mgr.work_queue.stop.called)
+        self.assertTrue(self.mgr.driver.stop.called)
+
+    def test_pool_locks_are_released(self):
+        with self.mgr.pool_locks.lock('pool1'):
+            self.assertIn('pool1', self.mgr.pool_locks.locks)
+        self.assertNotIn('pool1', self.mgr.pool_locks.locks)
+
+    def test_snapshot_is_private_and_has_no_keys(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        path = os.path.join(state_dir, agent_manager.CACHE_SNAPSHOT)
+        config = make_config('pool1')
+        config['vip']['ssl_key'] = 'secret'
+        self.mgr.cache.put(config)
+
+        self.mgr.cache.save(path)
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(path).st_mode))
+        with open(path) as snapshot:
+            self.assertNotIn('secret', snapshot.read())
+        self.assertEqual('port1',
+                         self.mgr.cache.load(path)[0]['vip']['port_id'])
+        # the cached device keeps its key
+        self.assertEqual('secret', config['vip']['ssl_key'])
+
+    def test_only_member_statuses_differing_from_the_server_are_sent(self):
+        config = make_config('pool1')
+        config['members'] = [{'id': 'member1', 'status': 'ACTIVE'},
+                             {'id': 'member2', 'status': 'INACTIVE'},
+                             {'id': 'member3', 'status': 'ACTIVE'}]
+        self.mgr.driver.exists.return_value = False
+        self.mgr.refresh_device('pool1', config)
+        self.mgr.driver.get_stats.return_value = {'members': dict(
+            (member_id, {lb_const.STATS_STATUS: status})
+            for member_id, status in (('member1', 'ACTIVE'),
+                                      ('member2', 'ACTIVE'),
+                                      ('member3', 'ACTIVE')))}
+
+        self.mgr.collect_stats(None)
+        self.mgr.plugin_rpc.update_member_statuses.assert_called_once_with(
+            {'member2': 'ACTIVE'})
+
+        # the server applied the report, then changed member1 meanwhile
+        config['members'][1]['status'] = 'ACTIVE'
+        config['members'][0]['status'] = 'INACTIVE'
+        self.mgr.refresh_device('pool1', config)
+        self.mgr.collect_stats(None)
+        self.mgr.plugin_rpc.update_member_statuses.assert_called_with(
+            {'member1': 'ACTIVE'})
+        self.assertEqual(
+            2, self.mgr.plugin_rpc.update_member_statuses.call_count)
+
+    def test_failed_deferred_change_is_fetched_again(self):
+        config = make_config('pool1')
+        config['revision'] = 'rev1'
+        self.mgr.cache.put(config)
+        self.mgr.driver.end_batch.return_value = ['pool1']
+
+        self.mgr._end_batch()
+        self.assertIsNone(self.mgr.cache.get_revision('pool1'))
+        self.assertTrue(self.mgr.needs_resync)
+
+
+class TestPoolWorkQueue(base.BaseTestCase):
+
+    def test_coalesce_and_stop(self):
+        handled = []
+        queue = agent_manager.PoolWorkQueue(
+            lambda *args: handled.append(args), 0.01, 1.0, 2)
+        queue.start()
+        queue.put_refresh('pool1', queue.MODIFY)
+        queue.put_refresh('pool1', queue.RELOAD)
+        queue.put_refresh('pool1', queue.MODIFY)
+        eventlet.sleep(0.2)
+        queue.stop()
+        eventlet.sleep(0.1)
+
+        queue.put_destroy('pool1')
+        eventlet.sleep(0.2)
+        self.assertEqual([('pool1', False, queue.RELOAD)], handled)
+        self.assertEqual(1, len(queue.pending))
+
+    def test_known_pools_include_queued_work(self):
+        cache = agent_manager.LogicalDeviceCache()
+        queue = agent_manager.PoolWorkQueue(mock.Mock(), 1.0, 1.0, 1)
+        known_pool_ids = agent_manager.KnownPools(cache, queue, ['pool1'])
+        cache.put(make_config('pool2'))
+        self.assertIn('pool1', known_pool_ids)
+        self.assertIn('pool2', known_pool_ids)
+        self.assertNotIn('pool3', known_pool_ids)
+
+        queue.put_refresh('pool3', queue.RELOAD)
+        self.assertIn('pool3', known_pool_ids)
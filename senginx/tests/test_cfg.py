@@ -0,0 +1,239 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+import os
+
+import mock
+from oslo.config import cfg
+
+from neutron.services.loadbalancer.drivers.senginx import agent_manager
+from neutron.services.loadbalancer.drivers.senginx import cfg as secfg
+from neutron.services.loadbalancer.drivers.senginx import sizing
+from neutron.tests import base
+
+GOLDEN_DIR = os.path.join(os.path.dirname(__file__), 'golden')
+
+# set to rewrite the golden files from the current output
+UPDATE_GOLDEN = 'SENGINX_UPDATE_GOLDEN'
+
+STATE_DIR = '/var/lib/neutron/lbaas/pool1'
+
+PROTOCOLS = ('HTTP', 'HTTPS', 'TCP')
+LB_METHODS = ('ROUND_ROBIN', 'LEAST_CONNECTIONS', 'SOURCE_IP')
+MONITORS = (None, 'PING', 'TCP', 'HTTP', 'HTTPS')
+
+
+def make_config(protocol='HTTP', lb_method='ROUND_ROBIN', monitor='HTTP',
+                members=2):
+    """Return the logical config of a pool with members on two hosts."""
+    config = {
+        'pool': {
+            'id': 'pool1',
+            'protocol': protocol,
+            'lb_method': lb_method,
+        },
+        'vip': {
+            'id': 'vip1',
+            'protocol': protocol,
+            'protocol_port': 80,
+            'connection_limit': -1,
+            'port': {
+                'id': 'port1',
+                'fixed_ips': [{
+                    'ip_address': '10.0.0.5',
+                    'subnet_id': 'subnet1',
+                    'subnet': {
+                        'id': 'subnet1',
+                        'cidr': '10.0.0.0/24',
+                        'gateway_ip': '10.0.0.1',
+                    },
+                }],
+            },
+            'session_persistence': None,
+        },
+        'members': [
+            {
+                'id': 'member%d' % i,
+                'address': '10.0.%d.%d' % (1 + i // 250, 1 + i % 250),
+                'protocol_port': 8080,
+                'weight': 1 + i % 3,
+                'status': 'ACTIVE',
+                'admin_state_up': True,
+            }
+            for i in range(members)
+        ],
+        'healthmonitors': [],
+    }
+    if protocol == 'HTTP':
+        config['vip']['session_persistence'] = {'type': 'HTTP_COOKIE'}
+    if monitor:
+        config['healthmonitors'].append({
+            'id': 'monitor1',
+            'type': monitor,
+            'delay': 5,
+            'timeout': 3,
+            'max_retries': 2,
+            'http_method': 'GET',
+            'url_path': '/health',
+            'expected_codes': '200-204',
+            'admin_state_up': True,
+        })
+    return config
+
+
+def matches_golden(name, data):
+    """Compare data to a golden file, or rewrite it with UPDATE_GOLDEN."""
+    path = os.path.join(GOLDEN_DIR, name)
+    if os.environ.get(UPDATE_GOLDEN):
+        with open(path, 'w') as golden:
+            golden.write(data)
+        return True
+    with open(path) as golden:
+        return golden.read() == data
+
+
+def get_golden_name(protocol, lb_method, monitor):
+    return '%s_%s_%s.conf' % (protocol.lower(), lb_method.lower(),
+                              (monitor or 'none').lower())
+
+
+class TestSEnginxCfg(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestSEnginxCfg, self).setUp()
+        cfg.CONF.register_opts(agent_manager.OPTS)
+        # the rendered worker settings depend on the CPUs of the host
+        patcher = mock.patch.object(sizing, '_get_cpu_count',
+                                    return_value=4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_golden_configs(self):
+        mismatches = []
+        for protocol in PROTOCOLS:
+            for lb_method in LB_METHODS:
+                for monitor in MONITORS:
+                    name = get_golden_name(protocol, lb_method, monitor)
+                    data = secfg.render_config(
+                        make_config(protocol, lb_method, monitor), STATE_DIR)
+                    if not matches_golden(name, data):
+                        mismatches.append(name)
+
+        self.assertEqual([], mismatches)
+
+    def test_render_is_deterministic(self):
+        config = make_config(members=100)
+        self.assertEqual(secfg.render_config(config, STATE_DIR),
+                         secfg.render_config(config, STATE_DIR))
+
+    def test_render_without_vip_protocol(self):
+        config = make_config()
+        config['vip']['protocol'] = None
+        self.assertIsNone(secfg.render_config(config, STATE_DIR))
+
+    def test_render_without_members(self):
+        data = secfg.render_config(make_config(members=0), STATE_DIR)
+        self.assertNotIn('upstream pool1', data)
+        self.assertIn('stub_status on;', data)
+
+    def test_render_skips_pending_members(self):
+        config = make_config(members=3)
+        config['members'][1]['status'] = 'PENDING_CREATE'
+        config['members'][2]['admin_state_up'] = False
+        data = secfg.render_config(config, STATE_DIR)
+        self.assertIn('server 10.0.1.1:8080', data)
+        self.assertNotIn('10.0.1.2:8080', data)
+        self.assertNotIn('10.0.1.3:8080', data)
+
+    def test_http_consistent_hash_golden(self):
+        cfg.CONF.set_override('http_source_ip_consistent_hash', True)
+        self.addCleanup(cfg.CONF.clear_override,
+                        'http_source_ip_consistent_hash')
+        data = secfg.render_config(make_config('HTTP', 'SOURCE_IP'),
+                                   STATE_DIR)
+        self.assertIn('hash $remote_addr consistent;', data)
+        self.assertIn('server 10.0.1.2:8080 weight=2;', data)
+        self.assertNotIn('ip_hash;', data)
+        self.assertTrue(matches_golden(
+            'http_source_ip_http_consistent_hash.conf', data))
+
+    def test_http_consistent_hash_key(self):
+        cfg.CONF.set_override('http_source_ip_consistent_hash', True)
+        self.addCleanup(cfg.CONF.clear_override,
+                        'http_source_ip_consistent_hash')
+        cfg.CONF.set_override('http_consistent_hash_key', 'uri')
+        self.addCleanup(cfg.CONF.clear_override, 'http_consistent_hash_key')
+        config = make_config('HTTP', 'SOURCE_IP')
+        self.assertIn('hash $request_uri consistent;',
+                      secfg.render_config(config, STATE_DIR))
+
+        cfg.CONF.set_override('http_consistent_hash_pool_keys',
+                              {'pool1': 'header:X-Session-Id'})
+        self.addCleanup(cfg.CONF.clear_override,
+                        'http_consistent_hash_pool_keys')
+        self.assertIn('hash $http_x_session_id consistent;',
+                      secfg.render_config(config, STATE_DIR))
+
+    def test_tcp_source_ip_keeps_ip_hash(self):
+        cfg.CONF.set_override('http_source_ip_consistent_hash', True)
+        self.addCleanup(cfg.CONF.clear_override,
+                        'http_source_ip_consistent_hash')
+        data = secfg.render_config(make_config('TCP', 'SOURCE_IP'),
+                                   STATE_DIR)
+        self.assertNotIn('consistent', data)
+        self.assertIn('ip_hash;', data)
+        self.assertTrue(matches_golden('tcp_source_ip_http.conf', data))
+
+    def test_proxy_cache_golden(self):
+        cfg.CONF.set_override('proxy_cache', True)
+        self.addCleanup(cfg.CONF.clear_override, 'proxy_cache')
+        cfg.CONF.set_override('proxy_cache_valid', 60)
+        self.addCleanup(cfg.CONF.clear_override, 'proxy_cache_valid')
+        data = secfg.render_config(make_config(), STATE_DIR)
+        self.assertIn('proxy_cache_path %s levels=1:2 '
+                      'keys_zone=cache_pool1:%s max_size=1g inactive=600s;'
+                      % (os.path.join(STATE_DIR, secfg.CACHE_DIR),
+                         secfg.CACHE_ZONE_SIZE), data)
+        self.assertIn('proxy_cache cache_pool1;', data)
+        self.assertIn('proxy_cache_bypass $http_authorization;', data)
+        self.assertIn('proxy_no_cache $http_authorization;', data)
+        self.assertTrue(matches_golden('http_round_robin_http_cache.conf',
+                                       data))
+
+    def test_proxy_cache_is_only_for_http(self):
+        cfg.CONF.set_override('proxy_cache', True)
+        self.addCleanup(cfg.CONF.clear_override, 'proxy_cache')
+        data = secfg.render_config(make_config('TCP'), STATE_DIR)
+        self.assertNotIn('proxy_cache', data)
+
+    def test_no_keepalive_golden(self):
+        cfg.CONF.set_override('upstream_keepalive', 0)
+        self.addCleanup(cfg.CONF.clear_override, 'upstream_keepalive')
+        data = secfg.render_config(make_config(), STATE_DIR)
+        self.assertNotIn('keepalive 0;', data)
+        self.assertNotIn('proxy_http_version', data)
+        self.assertNotIn('proxy_set_header Connection', data)
+        self.assertTrue(matches_golden(
+            'http_round_robin_http_no_keepalive.conf', data))
+
+    def test_expand_expected_codes(self):
+        self.assertEqual(['http_2xx'], secfg._expand_expected_codes('200'))
+        self.assertEqual(['http_2xx', 'http_3xx'],
+                         secfg._expand_expected_codes('200-304'))
+        self.assertEqual(['http_2xx', 'http_5xx'],
+                         secfg._expand_expected_codes('200, 503'))
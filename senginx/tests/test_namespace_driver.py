@@ -0,0 +1,409 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+import contextlib
+import os
+import shutil
+import tempfile
+import time
+
+import eventlet
+import mock
+from oslo.config import cfg
+
+from neutron.agent.linux import ip_lib
+from neutron.services.loadbalancer.drivers.senginx import agent_manager
+from neutron.services.loadbalancer.drivers.senginx import cfg as secfg
+from neutron.services.loadbalancer.drivers.senginx import namespace_driver
+from neutron.services.loadbalancer.drivers.senginx.tests import test_cfg
+from neutron.tests import base
+
+
+def make_config(pool_id, address='10.0.0.5', subnet_id='subnet1',
+                cidr='10.0.0.0/24', protocol='HTTP', monitor=None,
+                members=('10.0.0.10',)):
+    """Return the logical config of a pool with its vip on one subnet."""
+    config = test_cfg.make_config(protocol, 'ROUND_ROBIN', monitor,
+                                  len(members))
+    config['pool']['id'] = pool_id
+    config['vip']['port']['id'] = 'port-' + pool_id
+    config['vip']['port']['mac_address'] = 'fa:16:3e:00:00:01'
+    config['vip']['port']['network_id'] = 'net1'
+    config['vip']['port']['fixed_ips'] = [{
+        'ip_address': address,
+        'subnet_id': subnet_id,
+        'subnet': {'id': subnet_id, 'cidr': cidr, 'gateway_ip': None},
+    }]
+    for member, member_address in zip(config['members'], members):
+        member['address'] = member_address
+    return config
+
+
+class TestSEnginxNSDriver(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestSEnginxNSDriver, self).setUp()
+        cfg.CONF.register_opts(agent_manager.OPTS)
+        cfg.CONF.set_override('shared_instance', True)
+        self.addCleanup(cfg.CONF.clear_override, 'shared_instance')
+        self.state_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_path)
+        self.driver = self.make_driver()
+
+    def make_driver(self):
+        driver = namespace_driver.SEnginxNSDriver(
+            'sudo', self.state_path, mock.Mock(), mock.Mock())
+        driver._execute = mock.Mock()
+        driver._reload_shared = mock.Mock()
+        return driver
+
+    def test_batch_reloads_the_shared_instance_once(self):
+        self.driver.begin_batch()
+        for pool_id in ('pool1', 'pool2', 'pool3'):
+            self.driver._spawn_shared(make_config(pool_id))
+        self.assertFalse(self.driver._reload_shared.called)
+
+        self.assertEqual([], self.driver.end_batch())
+        self.assertEqual(1, self.driver._reload_shared.call_count)
+        self.assertEqual(1, self.driver.counters['reloads_applied'])
+        for pool_id in ('pool1', 'pool2', 'pool3'):
+            self.assertTrue(self.driver._get_applied_digest(pool_id))
+
+    def test_batch_returns_the_failed_pools(self):
+        self.driver._reload_shared.side_effect = RuntimeError()
+        self.driver.begin_batch()
+        for pool_id in ('pool1', 'pool2'):
+            self.driver._spawn_shared(make_config(pool_id))
+
+        self.assertEqual(['pool1', 'pool2'],
+                         sorted(self.driver.end_batch()))
+        # nothing was applied before, the fragments are removed
+        self.assertFalse(self.driver._is_shared('pool1'))
+        self.assertFalse(self.driver._get_applied_digest('pool1'))
+
+    def test_concurrent_changes_are_serialized_and_coalesced(self):
+        reloads = []
+
+        def _reload(test=True):
+            reloads.append('start')
+            eventlet.sleep(0.01)
+            reloads.append('end')
+        self.driver._reload_shared.side_effect = _reload
+
+        pool = eventlet.GreenPool()
+        for pool_id in ('pool1', 'pool2', 'pool3'):
+            pool.spawn_n(self.driver._spawn_shared, make_config(pool_id))
+        pool.waitall()
+
+        # the changes queued during the first reload share the second one
+        self.assertEqual(['start', 'end'] * 2, reloads)
+        for pool_id in ('pool1', 'pool2', 'pool3'):
+            self.assertTrue(self.driver._get_applied_digest(pool_id))
+
+    def test_failed_change_is_raised_to_its_caller(self):
+        self.driver._reload_shared.side_effect = RuntimeError()
+        self.assertRaises(RuntimeError, self.driver._spawn_shared,
+                          make_config('pool1'))
+        self.assertEqual({}, self.driver.shared_errors)
+
+    def create_own_instance(self, config):
+        cfg.CONF.set_override('shared_instance', False)
+        self.driver._plug = mock.Mock()
+        self.driver.create(config)
+        self.driver._execute.reset_mock()
+
+    def test_unchanged_render_skips_the_reload(self):
+        config = make_config('pool1')
+        self.create_own_instance(config)
+
+        # a change of the logical config which renders the same
+        config = make_config('pool1')
+        config['revision'] = 'rev2'
+        self.driver.update(config)
+        self.assertFalse(self.driver._execute.called)
+        self.assertEqual(1, self.driver.counters['reloads_skipped'])
+
+        # the same logical config again
+        self.driver.update(config)
+        self.assertFalse(self.driver._execute.called)
+        self.assertEqual(2, self.driver.counters['reloads_skipped'])
+
+    def test_changed_render_reloads(self):
+        config = make_config('pool1')
+        self.create_own_instance(config)
+        digest = self.driver._get_applied_digest('pool1')
+
+        config = make_config('pool1')
+        config['members'][0]['weight'] = 5
+        self.driver.update(config)
+        cmds = [call[0][0] for call in self.driver._execute.call_args_list]
+        self.assertIn(['-s', 'reload'], [cmd[-2:] for cmd in cmds])
+        self.assertEqual(0, self.driver.counters['reloads_skipped'])
+        self.assertEqual(2, self.driver.counters['reloads_applied'])
+        self.assertNotEqual(digest, self.driver._get_applied_digest('pool1'))
+
+    def test_batch_is_tested_once(self):
+        self.driver = namespace_driver.SEnginxNSDriver(
+            'sudo', self.state_path, mock.Mock(), mock.Mock())
+        self.driver._execute = mock.Mock()
+        self.driver.begin_batch()
+        for pool_id in ('pool1', 'pool2', 'pool3'):
+            self.driver._spawn_shared(make_config(pool_id))
+        self.assertFalse(self.driver._execute.called)
+
+        self.assertEqual([], self.driver.end_batch())
+        cmds = [call[0][0] for call in self.driver._execute.call_args_list]
+        self.assertEqual(1, len([cmd for cmd in cmds if '-t' in cmd]))
+        self.assertEqual(2, len(cmds))
+        conf_path = self.driver._get_state_file_path(
+            namespace_driver.SHARED_ID, 'conf')
+        with open(conf_path) as conf:
+            self.assertEqual(3, conf.read().count('/http.conf;'))
+
+    def test_failed_fragment_is_never_included(self):
+        def _execute(cmd, namespace=None):
+            if '-t' in cmd:
+                with open(cmd[cmd.index('-c') + 1]) as conf:
+                    if 'pool2' in conf.read():
+                        raise RuntimeError()
+        self.driver._execute.side_effect = _execute
+
+        self.driver.begin_batch()
+        for pool_id in ('pool1', 'pool2', 'pool3'):
+            self.driver._spawn_shared(make_config(pool_id))
+        self.assertEqual(['pool2'], self.driver.end_batch())
+
+        self.assertEqual(1, self.driver._reload_shared.call_count)
+        self.assertTrue(self.driver._is_shared('pool1'))
+        self.assertTrue(self.driver._is_shared('pool3'))
+        self.assertFalse(self.driver._is_shared('pool2'))
+        self.assertFalse(self.driver._get_applied_digest('pool2'))
+        fragments = self.driver._get_shared_fragments()
+        self.assertEqual(2, len(fragments['http']))
+        self.assertNotIn('pool2', ''.join(fragments['http']))
+
+    def test_rollback_keeps_the_conf_of_an_older_agent(self):
+        base_path = self.driver._get_state_file_path('pool1', '')
+        conf_path = os.path.join(base_path, 'conf')
+        with open(conf_path, 'w') as conf:
+            conf.write('applied')
+
+        self.driver._stage_config(conf_path, base_path, 'qlbaas-pool1',
+                                  'new')
+        self.driver._rollback('pool1', conf_path, base_path, 'qlbaas-pool1',
+                              restart=False)
+        with open(conf_path) as conf:
+            self.assertEqual('applied', conf.read())
+
+    def test_rollback_removes_a_conf_never_applied(self):
+        base_path = self.driver._get_state_file_path('pool1', '')
+        conf_path = os.path.join(base_path, 'conf')
+        self.driver._stage_config(conf_path, base_path, 'qlbaas-pool1',
+                                  'new')
+        self.driver._rollback('pool1', conf_path, base_path, 'qlbaas-pool1',
+                              restart=False)
+        self.assertFalse(os.path.exists(conf_path))
+
+    def test_route_tables_are_unique_and_reused(self):
+        self.assertEqual(1000, self.driver._allocate_route_table(
+            'subnet1', '10.0.0.5'))
+        self.assertEqual(1001, self.driver._allocate_route_table(
+            'subnet2', '10.0.0.5'))
+        self.assertEqual(1000, self.driver._allocate_route_table(
+            'subnet1', '10.0.0.6'))
+
+        self.assertIsNone(self.driver._release_route_table(
+            'subnet1', '10.0.0.5'))
+        self.assertEqual(1000, self.driver._release_route_table(
+            'subnet1', '10.0.0.6'))
+        self.assertEqual(1000, self.driver._allocate_route_table(
+            'subnet3', '10.1.0.5'))
+
+        # the allocation survives a restart of the agent
+        self.assertEqual(1001, self.make_driver()._allocate_route_table(
+            'subnet2', '10.0.0.7'))
+
+    def test_vip_routes_use_the_table_of_the_subnet(self):
+        routes = [['10.0.0.5', 'subnet1', '10.0.0.0/24', '10.0.0.1']]
+        self.driver._add_vip_routes('qlbaas-shared', 'tap1', routes)
+        cmds = [call[0][0] for call in self.driver._execute.call_args_list]
+        self.assertEqual(
+            [['ip', 'route', 'replace', '10.0.0.0/24', 'dev', 'tap1',
+              'src', '10.0.0.5', 'table', '1000'],
+             ['ip', 'route', 'replace', 'default', 'via', '10.0.0.1',
+              'dev', 'tap1', 'table', '1000'],
+             ['ip', 'rule', 'del', 'from', '10.0.0.5'],
+             ['ip', 'rule', 'add', 'from', '10.0.0.5', 'table', '1000',
+              'priority', '1000']], cmds)
+
+        self.driver._execute.reset_mock()
+        self.driver._del_vip_routes('qlbaas-shared', routes)
+        cmds = [call[0][0] for call in self.driver._execute.call_args_list]
+        self.assertEqual([['ip', 'rule', 'del', 'from', '10.0.0.5'],
+                          ['ip', 'route', 'flush', 'table', '1000']], cmds)
+
+    def test_overlapping_subnets_are_not_shared(self):
+        self.assertTrue(self.driver._use_shared(make_config('pool1')))
+        # another vip on the same subnet
+        self.assertTrue(self.driver._use_shared(
+            make_config('pool2', address='10.0.0.6')))
+        # a tenant network overlapping it
+        self.assertFalse(self.driver._use_shared(
+            make_config('pool3', subnet_id='subnet2', cidr='10.0.0.0/16')))
+        self.assertTrue(self.driver._use_shared(
+            make_config('pool4', address='10.1.0.5', subnet_id='subnet3',
+                        cidr='10.1.0.0/24', members=('10.1.0.10',))))
+
+    def test_checked_members_have_to_be_on_the_vip_subnet(self):
+        members = ('10.2.0.10',)
+        self.assertTrue(self.driver._use_shared(
+            make_config('pool1', members=members)))
+        self.assertFalse(self.driver._use_shared(
+            make_config('pool2', protocol='TCP', members=members)))
+        self.assertFalse(self.driver._use_shared(
+            make_config('pool3', monitor='HTTP', members=members)))
+
+    def test_plug_again_when_the_device_is_gone(self):
+        netns_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, netns_dir)
+        patcher = mock.patch.object(namespace_driver, 'NETNS_RUN_DIR',
+                                    netns_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        open(os.path.join(netns_dir, 'qlbaas-pool1'), 'w').close()
+
+        vif_driver = self.driver.vif_driver
+        vif_driver.get_device_name.return_value = 'tap1'
+        port = make_config('pool1')['vip']['port']
+        with mock.patch.object(ip_lib, 'device_exists',
+                               return_value=True) as device_exists:
+            self.driver._plug('pool1', 'qlbaas-pool1', port)
+            self.driver._plug('pool1', 'qlbaas-pool1', port)
+            device_exists.assert_called_with('tap1', 'sudo', 'qlbaas-pool1')
+        self.assertFalse(vif_driver.plug.called)
+        self.assertEqual(1, vif_driver.init_l3.call_count)
+
+        with mock.patch.object(ip_lib, 'device_exists', return_value=False):
+            self.driver._plug('pool1', 'qlbaas-pool1', port)
+        self.assertEqual(1, vif_driver.plug.call_count)
+        self.assertEqual(2, vif_driver.init_l3.call_count)
+
+    def test_new_certificate_makes_the_pool_stale(self):
+        cert_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cert_dir)
+        cfg.CONF.set_override('ssl_cert_dir', cert_dir)
+        self.addCleanup(cfg.CONF.clear_override, 'ssl_cert_dir')
+        config = make_config('pool1', protocol='HTTPS')
+        for ext, text in (('.crt', 'cert1'), ('.key', 'key1')):
+            with open(os.path.join(cert_dir, config['vip']['id'] + ext),
+                      'w') as pem:
+                pem.write(text)
+
+        self.assertTrue(self.driver.is_stale(config))
+        self.driver.logical_digests['pool1'] = (
+            namespace_driver._get_logical_digest(config))
+        self.assertFalse(self.driver.is_stale(config))
+
+        with open(os.path.join(cert_dir, config['vip']['id'] + '.crt'),
+                  'w') as pem:
+            pem.write('cert2')
+        self.assertTrue(self.driver.is_stale(config))
+
+    def test_vip_without_its_key_is_adopted(self):
+        server_config = make_config('pool1', protocol='HTTPS')
+        server_config['vip']['ssl_certificate'] = 'cert1\n'
+        server_config['vip']['ssl_key'] = 'key1'
+        self.create_own_instance(server_config)
+
+        # as restored from the snapshot by the next agent
+        config = agent_manager._strip_secrets(server_config)
+        self.assertNotIn('ssl_key', config['vip'])
+        self.driver = self.make_driver()
+        self.assertTrue(self.driver.adopt(config))
+        self.assertEqual('key1', config['vip']['ssl_key'])
+        self.assertFalse(self.driver.is_stale(server_config))
+
+    def make_orphans(self, *pool_ids):
+        netns_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, netns_dir)
+        patcher = mock.patch.object(namespace_driver, 'NETNS_RUN_DIR',
+                                    netns_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for pool_id in pool_ids:
+            os.mkdir(os.path.join(self.state_path, pool_id))
+        self.driver.destroy = mock.Mock()
+
+    def test_orphan_created_meanwhile_is_kept(self):
+        self.make_orphans('pool1', 'pool2')
+        known_pool_ids = set()
+
+        @contextlib.contextmanager
+        def pool_lock(pool_id):
+            # pool1 was being created when the orphans were listed
+            known_pool_ids.add('pool1')
+            yield
+
+        self.assertEqual(['pool1', 'pool2'], self.driver.remove_orphans(
+            known_pool_ids, pool_lock=pool_lock))
+        self.driver.destroy.assert_called_once_with('pool2')
+
+    def test_orphans_are_reported_in_dry_run(self):
+        cfg.CONF.set_override('orphan_dry_run', True)
+        self.addCleanup(cfg.CONF.clear_override, 'orphan_dry_run')
+        self.make_orphans('pool1')
+
+        self.driver.remove_orphans(set())
+        self.assertFalse(self.driver.destroy.called)
+        self.assertEqual(['pool1'],
+                         self.driver.get_configurations()['orphaned_pools'])
+
+    def write_log(self, pool_id):
+        log_path = self.driver._get_state_file_path(
+            pool_id, secfg.HTTP_ACCESS_LOG)
+        with open(log_path, 'w') as log_file:
+            log_file.write('line\n')
+        return log_path
+
+    def rotate_logs(self):
+        cfg.CONF.set_override('log_max_age', 100)
+        self.addCleanup(cfg.CONF.clear_override, 'log_max_age')
+        self.driver._get_pool_stats = mock.Mock(return_value=None)
+        with mock.patch.object(namespace_driver,
+                               'kill_pids_in_file') as kill:
+            self.driver.rotate_logs(['pool1'])
+        return kill.called
+
+    def test_log_age_is_kept_across_restarts(self):
+        log_path = self.write_log('pool1')
+        # the log was seen by the agent before its restart
+        started = time.time() - 200
+        self.driver._get_log_started(log_path, started)
+        self.driver = self.make_driver()
+
+        self.assertTrue(self.rotate_logs())
+        self.assertFalse(os.path.exists(log_path))
+        started_path = log_path + namespace_driver.LOG_STARTED_SUFFIX
+        self.assertGreater(os.path.getmtime(started_path), started)
+
+    def test_new_log_is_not_rotated(self):
+        log_path = self.write_log('pool1')
+        self.assertFalse(self.rotate_logs())
+        self.assertTrue(os.path.exists(log_path))
+        self.assertTrue(os.path.exists(
+            log_path + namespace_driver.LOG_STARTED_SUFFIX))
@@ -0,0 +1,291 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+import contextlib
+
+import mock
+
+from neutron.common import exceptions as q_exc
+from neutron.extensions import loadbalancer
+from neutron.plugins.common import constants
+from neutron.services.loadbalancer.drivers.senginx import plugin_driver
+from neutron.tests import base
+
+
+class TestLoadBalancerCallbacks(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestLoadBalancerCallbacks, self).setUp()
+        self.plugin = mock.Mock()
+        self.plugin._make_pool_dict.return_value = {'id': 'pool1'}
+        self.plugin._make_vip_dict.return_value = {'id': 'vip1'}
+        self.plugin._make_member_dict.return_value = {'id': 'member1'}
+        self.plugin._core_plugin._make_port_dict.return_value = {
+            'id': 'port1', 'fixed_ips': []}
+        self.callbacks = plugin_driver.LoadBalancerCallbacks(self.plugin)
+        self.context = mock.Mock()
+
+    def make_pool(self, status, vip_status=constants.ACTIVE,
+                  member_status=constants.PENDING_CREATE):
+        member = mock.Mock(id='member1', address='10.0.1.1',
+                           protocol_port=80, weight=1, admin_state_up=True,
+                           status=member_status)
+        monitor = mock.Mock(status=constants.ACTIVE)
+        monitor.healthmonitor = mock.Mock(
+            id='monitor1', type='HTTP', delay=5, timeout=3, max_retries=2,
+            http_method='GET', url_path='/', expected_codes='200',
+            admin_state_up=True)
+        pool = mock.Mock(id='pool1', protocol='HTTP',
+                         lb_method='ROUND_ROBIN', admin_state_up=True,
+                         status=status, members=[member],
+                         monitors=[monitor])
+        pool.vip = mock.Mock(id='vip1', port_id='port1', protocol='HTTP',
+                             protocol_port=80, connection_limit=-1,
+                             admin_state_up=True, status=vip_status,
+                             session_persistence=None)
+        pool.vip.port.fixed_ips = [mock.Mock(ip_address='10.0.0.5',
+                                             subnet_id='subnet1')]
+        return pool
+
+    def get_rows(self, pool):
+        """Return the rows of the revision queries for pool."""
+        vip = pool.vip
+        pools = [
+            (pool.id, pool.status, vip.status) +
+            tuple(plugin_driver._get_values(
+                pool, plugin_driver.POOL_REVISION_FIELDS) +
+                plugin_driver._get_values(
+                    vip, plugin_driver.VIP_REVISION_FIELDS) +
+                plugin_driver._get_values(
+                    None, plugin_driver.PERSISTENCE_REVISION_FIELDS)) +
+            (ip.ip_address, ip.subnet_id)
+            for ip in vip.port.fixed_ips
+        ]
+        members = [
+            (pool.id, m.status) + tuple(plugin_driver._get_values(
+                m, plugin_driver.MEMBER_REVISION_FIELDS))
+            for m in pool.members
+        ]
+        monitors = [
+            (pool.id, hm.status) + tuple(plugin_driver._get_values(
+                hm.healthmonitor, plugin_driver.MONITOR_REVISION_FIELDS))
+            for hm in pool.monitors
+        ]
+        return pools, members, monitors
+
+    def test_activate_pending_pool(self):
+        pool = self.make_pool(constants.PENDING_CREATE,
+                              constants.PENDING_UPDATE)
+        device = self.callbacks._make_logical_device(self.context, pool,
+                                                     True)
+
+        self.assertEqual(constants.ACTIVE, pool.status)
+        self.assertEqual(constants.ACTIVE, pool.vip.status)
+        self.assertEqual(constants.ACTIVE, pool.members[0].status)
+        self.assertEqual([{'id': 'member1'}], device['members'])
+
+    def test_invalid_pool_is_left_unchanged(self):
+        for status, vip_status in ((constants.PENDING_DELETE,
+                                    constants.ACTIVE),
+                                   (constants.ACTIVE, constants.ERROR)):
+            pool = self.make_pool(status, vip_status)
+            self.assertRaises(q_exc.Invalid,
+                              self.callbacks._make_logical_device,
+                              self.context, pool, True)
+            self.assertEqual(status, pool.status)
+            self.assertEqual(vip_status, pool.vip.status)
+            self.assertEqual(constants.PENDING_CREATE,
+                             pool.members[0].status)
+
+    def test_pending_pool_is_not_ready_without_activation(self):
+        pool = self.make_pool(constants.PENDING_UPDATE)
+        self.assertRaises(q_exc.Invalid,
+                          self.callbacks._make_logical_device,
+                          self.context, pool, False)
+        self.assertEqual(constants.PENDING_UPDATE, pool.status)
+
+    def test_revision_from_rows_matches_device(self):
+        pool = self.make_pool(constants.ACTIVE,
+                              member_status=constants.INACTIVE)
+        device = self.callbacks._make_logical_device(self.context, pool,
+                                                     False)
+        revisions = plugin_driver._hash_revisions(*self.get_rows(pool))
+        self.assertEqual({'pool1': device['revision']}, revisions)
+
+    def test_revision_ignores_member_health(self):
+        pool = self.make_pool(constants.ACTIVE,
+                              member_status=constants.ACTIVE)
+        revision = plugin_driver._hash_revisions(*self.get_rows(pool))
+        pool.members[0].status = constants.INACTIVE
+        self.assertEqual(revision,
+                         plugin_driver._hash_revisions(*self.get_rows(pool)))
+
+        pool.members[0].weight = 2
+        self.assertNotEqual(
+            revision, plugin_driver._hash_revisions(*self.get_rows(pool)))
+
+    def test_no_revision_for_pending_pools(self):
+        pool = self.make_pool(constants.ACTIVE)
+        self.assertEqual({'pool1': None},
+                         plugin_driver._hash_revisions(*self.get_rows(pool)))
+
+        pool = self.make_pool(constants.PENDING_UPDATE,
+                              member_status=constants.ACTIVE)
+        self.assertEqual({'pool1': None},
+                         plugin_driver._hash_revisions(*self.get_rows(pool)))
+
+    def test_pool_being_deleted_does_not_fail_the_stats_batch(self):
+        self.context = mock.MagicMock()
+        qry = mock.MagicMock()
+        qry.filter.return_value = qry
+        qry.__iter__.return_value = iter([('pool1',), ('pool2',)])
+        self.context.session.query.return_value = qry
+
+        def update_pool_stats(context, pool_id, data):
+            if pool_id == 'pool1':
+                raise loadbalancer.StateInvalid(id=pool_id,
+                                                state='PENDING_DELETE')
+        self.plugin.update_pool_stats.side_effect = update_pool_stats
+
+        self.assertEqual(1, self.callbacks.update_pools_stats(
+            self.context, {'pool1': {}, 'pool2': {'bytes_in': 1}}))
+        self.plugin.update_pool_stats.assert_called_with(
+            self.context, 'pool2', data={'bytes_in': 1})
+
+    def test_stats_of_the_other_pools_are_kept(self):
+        self.context = mock.MagicMock()
+        qry = mock.MagicMock()
+        qry.filter.return_value = qry
+        qry.__iter__.return_value = iter(
+            [('pool1',), ('pool2',), ('pool3',)])
+        self.context.session.query.return_value = qry
+        savepoints = []
+
+        @contextlib.contextmanager
+        def begin_nested():
+            savepoint = []
+            savepoints.append(savepoint)
+            try:
+                yield
+            except Exception:
+                savepoint.append('rollback')
+                raise
+            savepoint.append('commit')
+        self.context.session.begin_nested.side_effect = begin_nested
+
+        def update_pool_stats(context, pool_id, data):
+            savepoints[-1].append(pool_id)
+            if pool_id == 'pool2':
+                raise loadbalancer.StateInvalid(id=pool_id,
+                                                state='PENDING_DELETE')
+        self.plugin.update_pool_stats.side_effect = update_pool_stats
+
+        self.assertEqual(2, self.callbacks.update_pools_stats(
+            self.context, {'pool1': {}, 'pool2': {}, 'pool3': {}}))
+        self.assertEqual([['pool1', 'commit'], ['pool2', 'rollback'],
+                          ['pool3', 'commit']], savepoints)
+
+    def test_ready_pools_are_paged_by_id(self):
+        pool_ids = ['pool%d' % i for i in range(5)]
+
+        def get_ready_pool_ids(context, host, marker, limit):
+            return [pool_id for pool_id in pool_ids
+                    if marker is None or pool_id > marker][:limit]
+        self.callbacks._get_ready_pool_ids = mock.Mock(
+            side_effect=get_ready_pool_ids)
+
+        with mock.patch.object(plugin_driver, 'READY_POOLS_BATCH', 2):
+            self.assertEqual(pool_ids, self.callbacks.get_ready_devices(
+                self.context, 'host1'))
+            self.assertEqual(3, self.callbacks._get_ready_pool_ids.call_count)
+            self.assertEqual(['pool2', 'pool3', 'pool4'],
+                             self.callbacks.get_ready_devices(
+                                 self.context, 'host1', marker='pool1',
+                                 limit=3))
+
+
+class TestSEnginxOnHostPluginDriver(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestSEnginxOnHostPluginDriver, self).setUp()
+        # the rpc set up of __init__ is not needed
+        self.driver = plugin_driver.SEnginxOnHostPluginDriver.__new__(
+            plugin_driver.SEnginxOnHostPluginDriver)
+        self.driver.plugin = mock.Mock()
+        self.driver.plugin.get_lbaas_agent_hosting_pool.return_value = {
+            'agent': {'host': 'host1'}}
+        self.driver.agent_rpc = mock.Mock()
+        self.context = mock.MagicMock()
+        patcher = mock.patch.object(plugin_driver.loadbalancer_db,
+                                    'LoadBalancerPluginDb')
+        self.lb_db = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_cast_pools(self):
+        return sorted(call[0][1] for call in
+                      self.driver.agent_rpc.modify_pool.call_args_list)
+
+    def test_create_members_casts_once_per_pool(self):
+        self.lb_db.create_member.side_effect = (
+            lambda plugin, context, member: dict(member['member']))
+        members = [{'pool_id': 'pool1', 'address': '10.0.0.%d' % i}
+                   for i in range(3)]
+        members.append({'pool_id': 'pool2', 'address': '10.0.0.9'})
+
+        self.assertEqual(4, len(self.driver.create_members(self.context,
+                                                           members)))
+        self.assertEqual(['pool1', 'pool2'], self.get_cast_pools())
+
+    def test_update_members_sets_them_pending(self):
+        self.driver.plugin.get_member.side_effect = (
+            lambda context, member_id: {'pool_id': 'pool1'})
+        updated = []
+
+        def update_member(plugin, context, member_id, member):
+            updated.append(member['member']['status'])
+            return {'id': member_id, 'pool_id': member['member']['pool_id']}
+        self.lb_db.update_member.side_effect = update_member
+
+        self.driver.update_members(self.context, {
+            'member1': {'pool_id': 'pool1', 'weight': 2},
+            'member2': {'pool_id': 'pool1', 'weight': 3},
+            'member3': {'pool_id': 'pool2'},
+        })
+        self.assertEqual([constants.PENDING_UPDATE] * 3, updated)
+        # pool1 lost member3 and is notified once as well
+        self.assertEqual(['pool1', 'pool2'], self.get_cast_pools())
+
+    def test_delete_members_casts_once_per_pool(self):
+        self.driver.plugin.get_member.side_effect = (
+            lambda context, member_id: {'pool_id': 'pool1'})
+        self.driver.delete_members(self.context,
+                                   ['member1', 'member2', 'member3'])
+        self.assertEqual(3,
+                         self.driver.plugin._delete_db_member.call_count)
+        self.assertEqual(['pool1'], self.get_cast_pools())
+
+    def test_pool_health_monitors_cast_once_per_pool(self):
+        associations = [('monitor1', 'pool1'), ('monitor2', 'pool1'),
+                        ('monitor1', 'pool2')]
+        self.driver.create_pool_health_monitors(self.context, associations)
+        self.assertEqual(3, self.lb_db.create_pool_health_monitor.call_count)
+        self.assertEqual(['pool1', 'pool2'], self.get_cast_pools())
+
+        self.driver.agent_rpc.reset_mock()
+        self.driver.delete_pool_health_monitors(self.context, associations)
+        self.assertEqual(['pool1', 'pool2'], self.get_cast_pools())
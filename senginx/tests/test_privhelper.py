@@ -0,0 +1,54 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+
+from neutron.services.loadbalancer.drivers.senginx import privhelper
+from neutron.tests import base
+
+
+class TestPrivHelper(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestPrivHelper, self).setUp()
+        sock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, sock_dir)
+        self.sock_path = os.path.join(sock_dir, 'privhelper.sock')
+
+    def test_stop_removes_the_socket(self):
+        server = privhelper._HelperServer(self.sock_path, mock.Mock(), [])
+        self.addCleanup(server.server_close)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        server.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(os.path.exists(self.sock_path))
+
+    def test_stop_without_helper(self):
+        client = privhelper.PrivHelperClient('sudo', self.sock_path)
+        with mock.patch.object(privhelper.utils, 'execute') as execute:
+            client.stop()
+        # the helper is not started to be stopped
+        self.assertFalse(execute.called)
@@ -0,0 +1,106 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+import os
+import shutil
+import tempfile
+
+import mock
+
+from neutron.services.loadbalancer.drivers.senginx import process
+from neutron.tests import base
+
+CONF_PATH = '/var/lib/neutron/lbaas/pool1/conf'
+
+
+class TestProcessTracker(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestProcessTracker, self).setUp()
+        self.proc_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.proc_path)
+        patcher = mock.patch.object(process, 'PROC_PATH', self.proc_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.pid_path = os.path.join(self.proc_path, 'nginx.pid')
+        with open(self.pid_path, 'w') as pid_file:
+            pid_file.write('100\n')
+        self.tracker = process.ProcessTracker()
+
+    def make_process(self, pid, start_time, cmdline):
+        """Write the stat and cmdline of a process in the fake /proc."""
+        proc_dir = os.path.join(self.proc_path, str(pid))
+        if not os.path.isdir(proc_dir):
+            os.mkdir(proc_dir)
+        # the fields between the state and the start time are not read
+        fields = ['S'] + [str(i) for i in range(4, 22)] + [str(start_time)]
+        with open(os.path.join(proc_dir, 'stat'), 'w') as stat:
+            stat.write('%d (nginx: master) %s 0 0\n' % (pid,
+                                                         ' '.join(fields)))
+        with open(os.path.join(proc_dir, 'cmdline'), 'w') as cmd:
+            cmd.write(cmdline + '\0')
+
+    def make_master(self, pid, start_time):
+        self.make_process(pid, start_time,
+                          'nginx: master process %s -c %s -p /tmp' %
+                          (process.SENGINX_BIN, CONF_PATH))
+
+    def is_alive(self):
+        return self.tracker.is_alive('pool1', self.pid_path, CONF_PATH)
+
+    def test_master_is_alive_and_cached(self):
+        self.make_master(100, 5000)
+        self.assertTrue(self.is_alive())
+        self.assertEqual((100, '5000'), self.tracker.masters['pool1'])
+
+        # the cached master is not read again
+        os.unlink(os.path.join(self.proc_path, '100', 'cmdline'))
+        self.assertTrue(self.is_alive())
+
+    def test_reused_pid_with_another_start_time(self):
+        self.make_master(100, 5000)
+        self.assertTrue(self.is_alive())
+
+        # the master died and its pid went to another process
+        self.make_process(100, 6000, '/bin/sleep 60')
+        self.assertFalse(self.is_alive())
+        self.assertNotIn('pool1', self.tracker.masters)
+
+    def test_missing_proc_entry(self):
+        self.make_master(100, 5000)
+        self.assertTrue(self.is_alive())
+
+        shutil.rmtree(os.path.join(self.proc_path, '100'))
+        self.assertFalse(self.is_alive())
+        self.assertNotIn('pool1', self.tracker.masters)
+
+    def test_missing_pid_file(self):
+        os.unlink(self.pid_path)
+        self.assertFalse(self.is_alive())
+
+    def test_process_which_is_not_senginx(self):
+        self.make_process(100, 5000, 'nginx: master process '
+                          '/usr/sbin/nginx -c /etc/nginx/nginx.conf')
+        self.assertFalse(self.is_alive())
+
+    def test_master_of_another_instance(self):
+        self.make_process(100, 5000, 'nginx: master process %s -c %s' %
+                          (process.SENGINX_BIN,
+                           '/var/lib/neutron/lbaas/pool2/conf'))
+        self.assertFalse(self.is_alive())
@@ -0,0 +1,48 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+from oslo.config import cfg
+
+from neutron.services.loadbalancer.drivers.senginx import sizing
+from neutron.services.loadbalancer.drivers.senginx.tests import test_cfg
+from neutron.tests import base
+
+
+class TestWorkerSizing(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestWorkerSizing, self).setUp()
+        cfg.CONF.set_override('worker_profile', 'medium')
+        self.addCleanup(cfg.CONF.clear_override, 'worker_profile')
+
+    def test_every_worker_can_take_the_connection_limit(self):
+        config = test_cfg.make_config()
+        config['vip']['connection_limit'] = 2000
+        workers = sizing.get_worker_sizing(config, cpu_count=4)
+        self.assertEqual(2, workers['worker_processes'])
+        self.assertEqual(4001, workers['worker_connections'])
+
+    def test_single_worker_is_bound_to_a_cpu(self):
+        cfg.CONF.set_override('worker_profile', 'small')
+        cfg.CONF.set_override('worker_cpu_affinity', True)
+        self.addCleanup(cfg.CONF.clear_override, 'worker_cpu_affinity')
+        workers = sizing.get_worker_sizing(test_cfg.make_config(),
+                                           cpu_count=4)
+        self.assertEqual(1, workers['worker_processes'])
+        self.assertEqual(1, len(workers['worker_cpu_affinity']))
+        self.assertEqual(1, workers['worker_cpu_affinity'][0].count('1'))
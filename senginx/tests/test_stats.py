@@ -0,0 +1,140 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+import os
+import shutil
+import tempfile
+
+import mock
+
+from neutron.services.loadbalancer import constants as lb_const
+from neutron.services.loadbalancer.drivers.senginx import stats
+from neutron.tests import base
+
+
+def log_line(bytes_in, bytes_out, peer):
+    return '1395000000.123 %d %d %s\n' % (bytes_in, bytes_out, peer)
+
+
+class TestAccessLogReader(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestAccessLogReader, self).setUp()
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        self.log_path = os.path.join(self.state_dir, 'http.access.log')
+        for name, value in (('READ_CHUNK_SIZE', 16),
+                            ('MAX_LINE_LENGTH', 64)):
+            patcher = mock.patch.object(stats, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write(self, data):
+        with open(self.log_path, 'a') as log_file:
+            log_file.write(data)
+
+    def assertTotals(self, reader, bytes_in, bytes_out, connections):
+        self.assertEqual(bytes_in, reader.totals[lb_const.STATS_IN_BYTES])
+        self.assertEqual(bytes_out, reader.totals[lb_const.STATS_OUT_BYTES])
+        self.assertEqual(connections,
+                         reader.totals[lb_const.STATS_TOTAL_CONNECTIONS])
+
+    def test_read_appended_lines(self):
+        reader = stats.AccessLogReader(self.log_path)
+        self.write(log_line(10, 20, '10.0.0.1:80'))
+        reader.read()
+        self.write(log_line(1, 2, '10.0.0.1:80') +
+                   log_line(3, 4, '10.0.0.2:80'))
+        reader.read()
+
+        self.assertTotals(reader, 14, 26, 3)
+        self.assertEqual(
+            4, reader.peers['10.0.0.2:80'][lb_const.STATS_OUT_BYTES])
+
+    def test_state_survives_restart(self):
+        self.write(log_line(10, 20, '10.0.0.1:80'))
+        stats.AccessLogReader(self.log_path).read()
+        self.write(log_line(1, 2, '10.0.0.1:80'))
+
+        reader = stats.AccessLogReader(self.log_path)
+        reader.read()
+        self.assertTotals(reader, 11, 22, 2)
+
+    def test_skip_overlong_line_to_its_end(self):
+        # the end of the runaway line looks like a line of its own
+        runaway = '1395000000.123 5 5 %s 7 7 10.0.0.9:80\n' % ('x' * 100)
+        reader = stats.AccessLogReader(self.log_path)
+        self.write(log_line(10, 20, '10.0.0.1:80') + runaway[:70])
+        reader.read()
+        self.write(runaway[70:] + log_line(1, 2, '10.0.0.1:80'))
+        stats.AccessLogReader(self.log_path).read()
+
+        reader = stats.AccessLogReader(self.log_path)
+        self.assertTotals(reader, 11, 22, 2)
+        self.assertNotIn('10.0.0.9:80', reader.peers)
+        self.assertEqual(os.path.getsize(self.log_path), reader.offset)
+
+    def test_scale_applies_to_the_lines_read_with_it(self):
+        reader = stats.AccessLogReader(self.log_path)
+        self.write(log_line(10, 20, '10.0.0.1:80'))
+        reader.read()
+        # the log is sampled from now on
+        self.write(log_line(1, 2, '10.0.0.1:80'))
+        reader.read(10.0)
+
+        self.assertTotals(reader, 20, 40, 11)
+
+    def test_read_rotated_log_to_its_end(self):
+        reader = stats.AccessLogReader(self.log_path)
+        self.write(log_line(10, 20, '10.0.0.1:80'))
+        reader.read()
+        rotated_path = self.log_path + '.1'
+        os.rename(self.log_path, rotated_path)
+        reader.rotated(rotated_path)
+
+        # written before the log is reopened
+        with open(rotated_path, 'a') as log_file:
+            log_file.write(log_line(1, 2, '10.0.0.1:80'))
+        reader.read()
+        self.assertTotals(reader, 11, 22, 2)
+
+        with open(rotated_path, 'a') as log_file:
+            log_file.write(log_line(2, 4, '10.0.0.1:80'))
+        self.write(log_line(3, 6, '10.0.0.1:80'))
+        reader = stats.AccessLogReader(self.log_path)
+        reader.read()
+        self.assertTotals(reader, 16, 32, 4)
+        self.assertIsNone(reader.rotated_path)
+
+
+class TestPoolStats(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestPoolStats, self).setUp()
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        self.pool_stats = stats.PoolStats(self.state_dir)
+        self.pool_stats.get_active_connections = mock.Mock(return_value=3)
+        self.pool_stats.get_member_statuses = mock.Mock(
+            return_value={'10.0.0.1:80': 'ACTIVE'})
+
+    def test_no_traffic_counters_without_logs(self):
+        self.assertEqual(
+            {lb_const.STATS_ACTIVE_CONNECTIONS: 3,
+             'members': {'member1': {lb_const.STATS_STATUS: 'ACTIVE'}}},
+            self.pool_stats.get_stats({'10.0.0.1:80': 'member1'}, None))
@@ -0,0 +1,61 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+from oslo.config import cfg
+
+from neutron.services.loadbalancer.drivers.senginx.tests import test_cfg
+from neutron.services.loadbalancer.drivers.senginx import tuning
+from neutron.tests import base
+
+
+class TestHttpTuning(base.BaseTestCase):
+
+    def set_overrides(self, overrides):
+        cfg.CONF.set_override('http_profile_overrides', overrides)
+        self.addCleanup(cfg.CONF.clear_override, 'http_profile_overrides')
+
+    def test_profiles_are_within_bounds(self):
+        for name, profile in tuning.PROFILES.items():
+            for setting, (low, high) in tuning.BOUNDS.items():
+                self.assertTrue(low <= profile[setting] <= high,
+                                '%s of %s' % (setting, name))
+
+    def test_out_of_range_overrides_are_clamped(self):
+        self.set_overrides({'gzip_comp_level': '12',
+                            'proxy_buffers': '1',
+                            'client_body_buffer_size': '4'})
+        settings = tuning.get_http_tuning(test_cfg.make_config())
+        self.assertEqual(9, settings['gzip_comp_level'])
+        self.assertEqual(4, settings['proxy_buffers'])
+        self.assertEqual(8, settings['client_body_buffer_size'])
+
+    def test_invalid_and_unknown_overrides_are_ignored(self):
+        self.set_overrides({'proxy_buffers': 'many',
+                            'proxy_read_timeout': '5',
+                            'gzip': 'off'})
+        settings = tuning.get_http_tuning(test_cfg.make_config())
+        self.assertEqual(tuning.PROFILES['throughput']['proxy_buffers'],
+                         settings['proxy_buffers'])
+        self.assertNotIn('proxy_read_timeout', settings)
+        self.assertFalse(settings['gzip'])
+
+    def test_unknown_profile_uses_the_default(self):
+        cfg.CONF.set_override('http_pool_profiles', {'pool1': 'huge'})
+        self.addCleanup(cfg.CONF.clear_override, 'http_pool_profiles')
+        self.assertEqual(tuning.DEFAULT_PROFILE,
+                         tuning.get_profile_name(test_cfg.make_config()))
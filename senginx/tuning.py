@@ -0,0 +1,140 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+from oslo.config import cfg
+
+from neutron.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+OPTS = [
+    cfg.StrOpt(
+        'http_profile',
+        default='throughput',
+        help=_('Compression and buffering profile of the http pools: '
+               'throughput, bandwidth or low_memory'),
+    ),
+    cfg.DictOpt(
+        'http_pool_profiles',
+        default={},
+        help=_('Profile of specific http pools, as pool_id:profile pairs'),
+    ),
+    cfg.DictOpt(
+        'http_profile_overrides',
+        default={},
+        help=_('Settings overriding the profiles of all the http pools, '
+               'as name:value pairs'),
+    ),
+]
+
+cfg.CONF.register_opts(OPTS)
+
+DEFAULT_PROFILE = 'throughput'
+
+# buffer sizes are in kilobytes
+PROFILES = {
+    # large buffers keep responses off temp files and free the members
+    # early, cheap compression
+    'throughput': {
+        'gzip': True,
+        'gzip_comp_level': 1,
+        'gzip_min_length': 1024,
+        'proxy_buffers': 32,
+        'proxy_buffer_size': 16,
+        'client_body_buffer_size': 128,
+    },
+    # smaller responses on the wire at the cost of CPU
+    'bandwidth': {
+        'gzip': True,
+        'gzip_comp_level': 6,
+        'gzip_min_length': 256,
+        'proxy_buffers': 16,
+        'proxy_buffer_size': 8,
+        'client_body_buffer_size': 64,
+    },
+    # for nodes with many pools
+    'low_memory': {
+        'gzip': False,
+        'gzip_comp_level': 1,
+        'gzip_min_length': 1024,
+        'proxy_buffers': 8,
+        'proxy_buffer_size': 4,
+        'client_body_buffer_size': 16,
+    },
+}
+
+# inclusive bounds of the numeric settings
+BOUNDS = {
+    'gzip_comp_level': (1, 9),
+    'gzip_min_length': (0, 1024 * 1024),
+    # the busy buffers need two of them and must leave one free
+    'proxy_buffers': (4, 256),
+    'proxy_buffer_size': (4, 1024),
+    'client_body_buffer_size': (8, 16 * 1024),
+}
+
+GZIP_TYPES = (
+    'text/plain',
+    'text/css',
+    'text/xml',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'application/xml',
+)
+
+
+def get_profile_name(config):
+    profile = cfg.CONF.http_pool_profiles.get(config['pool']['id'],
+                                              cfg.CONF.http_profile)
+    if profile not in PROFILES:
+        LOG.warn(_('Unknown http profile %(profile)s for pool %(pool_id)s, '
+                   'using %(default)s'),
+                 {'profile': profile, 'pool_id': config['pool']['id'],
+                  'default': DEFAULT_PROFILE})
+        return DEFAULT_PROFILE
+    return profile
+
+
+def get_http_tuning(config):
+    """Return the validated tuning settings of an http pool."""
+    settings = dict(PROFILES[get_profile_name(config)])
+
+    for name, value in cfg.CONF.http_profile_overrides.items():
+        if name not in settings:
+            LOG.warn(_('Ignoring unknown http profile setting %s'), name)
+            continue
+        if name == 'gzip':
+            settings[name] = value.lower() in ('1', 'true', 'on', 'yes')
+            continue
+        try:
+            settings[name] = int(value)
+        except ValueError:
+            LOG.warn(_('Ignoring invalid value %(value)s of http profile '
+                       'setting %(name)s'), {'value': value, 'name': name})
+
+    for name, (low, high) in BOUNDS.items():
+        value = min(max(settings[name], low), high)
+        if value != settings[name]:
+            LOG.warn(_('Http profile setting %(name)s is out of '
+                       '[%(low)d, %(high)d], using %(value)d'),
+                     {'name': name, 'low': low, 'high': high,
+                      'value': value})
+            settings[name] = value
+
+    return settings
@@ -27,6 +27,11 @@ setup(
     author_email='paulyang.inf@gmail.com',
     packages=['senginx'],
     data_files=[('/etc/neutron/rootwrap.d', ['etc/lbaas-senginx.filters'])],
+    entry_points={
+        'console_scripts': [
+            'neutron-senginx-privhelper = senginx.privhelper:main',
+        ],
+    },
     test_suite='nose.collector',
     include_package_data=True
 )
@@ -0,0 +1,86 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+"""Time the privileged commands of a pool create, with and without helper.
+
+Usage: python tools/bench_privhelper.py [creates] [root helper]
+
+Runs the namespace commands of a pool create through the root helper,
+then through the privileged helper, and reports the mean latency of a
+create for each. The root helper defaults to the rootwrap of the agent,
+with lbaas-senginx.filters installed, and both runs need the rights of
+the agent user.
+"""
+
+import sys
+import time
+
+from neutron.agent.linux import utils
+from neutron.services.loadbalancer.drivers.senginx import privhelper
+
+DEFAULT_ROOT_HELPER = 'sudo neutron-rootwrap /etc/neutron/rootwrap.conf'
+NAMESPACE = 'qlbaas-bench-privhelper'
+
+
+def get_create_commands():
+    """Return the commands setting up and tearing down a namespace."""
+    def in_ns(*cmd):
+        return ['ip', 'netns', 'exec', NAMESPACE] + list(cmd)
+
+    return [
+        ['ip', 'netns', 'add', NAMESPACE],
+        in_ns('ip', 'link', 'set', 'lo', 'up'),
+        in_ns('ip', 'addr', 'show'),
+        in_ns('ip', 'route', 'show'),
+        in_ns('ip', 'rule', 'show'),
+        ['ip', 'netns', 'delete', NAMESPACE],
+    ]
+
+
+def bench(execute, creates):
+    commands = get_create_commands()
+    start = time.time()
+    for i in range(creates):
+        for cmd in commands:
+            execute(cmd)
+    return (time.time() - start) / creates
+
+
+def main():
+    creates = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    root_helper = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_ROOT_HELPER
+
+    helper = privhelper.PrivHelperClient(root_helper)
+    # the helper is started by the first command, outside of the timing
+    helper.execute(['ip', 'netns', 'list'])
+
+    results = [
+        ('root helper',
+         bench(lambda cmd: utils.execute(cmd, root_helper), creates)),
+        ('privileged helper', bench(helper.execute, creates)),
+    ]
+
+    print('%d commands per create' % len(get_create_commands()))
+    print('%-18s %10s' % ('path', 'ms/create'))
+    for name, latency in results:
+        print('%-18s %10.1f' % (name, latency * 1000))
+    print('speedup %.1fx' % (results[0][1] / results[1][1]))
+
+
+if __name__ == '__main__':
+    main()
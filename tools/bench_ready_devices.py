@@ -0,0 +1,183 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+"""Time get_ready_devices on an in-memory SQLite database.
+
+Usage: python tools/bench_ready_devices.py [pools] [agents] [members]
+
+The pools, 50000 by default, are spread over the agents, 100 by default,
+each with a vip and members. The listing of one agent is timed with and
+without revisions, in a single call and a page at a time as the agent
+does, then the listing of all the agents one after the other. The peak
+memory of the process is reported at the end.
+"""
+
+import resource
+import sys
+import time
+import uuid
+
+from oslo.config import cfg
+
+from neutron import context
+from neutron.common import constants as q_const
+from neutron.db import agents_db
+from neutron.db import api as db_api
+from neutron.db.loadbalancer import loadbalancer_db
+from neutron.db import models_v2
+from neutron.services.loadbalancer import agent_scheduler
+from neutron.services.loadbalancer.drivers.senginx import agent_api
+from neutron.services.loadbalancer.drivers.senginx import plugin_driver
+
+INSERT_BATCH = 10000
+
+
+def _insert(session, model, rows):
+    for i in range(0, len(rows), INSERT_BATCH):
+        session.execute(model.__table__.insert(), rows[i:i + INSERT_BATCH])
+
+
+def populate(session, pools, agents, members):
+    """Create the agents and their pools, return the agent hosts."""
+    network_id = str(uuid.uuid4())
+    subnet_id = str(uuid.uuid4())
+    hosts = ['host-%d' % i for i in range(agents)]
+    agent_ids = [str(uuid.uuid4()) for host in hosts]
+    now = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    with session.begin():
+        _insert(session, models_v2.Network, [{
+            'id': network_id, 'tenant_id': 'tenant', 'name': 'net',
+            'status': 'ACTIVE', 'admin_state_up': True, 'shared': False}])
+        _insert(session, models_v2.Subnet, [{
+            'id': subnet_id, 'tenant_id': 'tenant', 'network_id': network_id,
+            'ip_version': 4, 'cidr': '10.0.0.0/8', 'gateway_ip': '10.0.0.1',
+            'enable_dhcp': False, 'shared': False}])
+        _insert(session, agents_db.Agent, [{
+            'id': agent_id, 'agent_type': q_const.AGENT_TYPE_LOADBALANCER,
+            'binary': 'neutron-lbaas-agent', 'topic': 'lbaas_process_on_host',
+            'host': host, 'admin_state_up': True, 'created_at': now,
+            'started_at': now, 'heartbeat_timestamp': now,
+            'configurations': '{}'} for host, agent_id in zip(hosts,
+                                                            agent_ids)])
+
+        ports, ips, vips, pool_rows, bindings, member_rows = ([] for i in
+                                                              range(6))
+        for i in range(pools):
+            pool_id = str(uuid.uuid4())
+            vip_id = str(uuid.uuid4())
+            port_id = str(uuid.uuid4())
+            address = '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+            ports.append({
+                'id': port_id, 'tenant_id': 'tenant', 'name': '',
+                'network_id': network_id,
+                'mac_address': 'fa:16:3e:%02x:%02x:%02x' % (
+                    i >> 16 & 255, i >> 8 & 255, i & 255),
+                'admin_state_up': True, 'status': 'ACTIVE',
+                'device_id': pool_id, 'device_owner': 'neutron:LOADBALANCER'})
+            ips.append({'port_id': port_id, 'ip_address': address,
+                        'subnet_id': subnet_id, 'network_id': network_id})
+            vips.append({
+                'id': vip_id, 'tenant_id': 'tenant', 'name': '',
+                'description': '', 'port_id': port_id, 'protocol_port': 80,
+                'protocol': 'HTTP', 'pool_id': pool_id, 'status': 'ACTIVE',
+                'admin_state_up': True, 'connection_limit': -1})
+            pool_rows.append({
+                'id': pool_id, 'tenant_id': 'tenant', 'vip_id': vip_id,
+                'name': '', 'description': '', 'subnet_id': subnet_id,
+                'protocol': 'HTTP', 'lb_method': 'ROUND_ROBIN',
+                'status': 'ACTIVE', 'admin_state_up': True})
+            bindings.append({'pool_id': pool_id,
+                             'agent_id': agent_ids[i % agents]})
+            member_rows.extend({
+                'id': str(uuid.uuid4()), 'tenant_id': 'tenant',
+                'pool_id': pool_id, 'address': '10.255.%d.%d' % (
+                    j >> 8 & 255, j & 255),
+                'protocol_port': 8080, 'weight': 1, 'status': 'ACTIVE',
+                'admin_state_up': True} for j in range(members))
+
+        _insert(session, models_v2.Port, ports)
+        _insert(session, models_v2.IPAllocation, ips)
+        _insert(session, loadbalancer_db.Pool, pool_rows)
+        _insert(session, loadbalancer_db.Vip, vips)
+        _insert(session, agent_scheduler.PoolLoadbalancerAgentBinding,
+                bindings)
+        _insert(session, loadbalancer_db.Member, member_rows)
+
+    return hosts
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def list_paged(callbacks, ctx, host):
+    """List the revisions of an agent's pools as the agent does."""
+    revisions = {}
+    marker = None
+    while True:
+        devices = callbacks.get_ready_devices(
+            ctx, host, with_revisions=True, marker=marker,
+            limit=agent_api.READY_DEVICES_PAGE)
+        revisions.update(devices)
+        if len(devices) < agent_api.READY_DEVICES_PAGE:
+            return revisions
+        marker = devices[-1][0]
+
+
+def main():
+    pools = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    agents = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    members = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+
+    cfg.CONF.set_override('connection', 'sqlite://', group='database')
+    db_api.configure_db()
+    ctx = context.get_admin_context()
+
+    elapsed, hosts = timed(populate, ctx.session, pools, agents, members)
+    print('populated %d pools over %d agents in %.1fs' %
+          (pools, agents, elapsed))
+
+    callbacks = plugin_driver.LoadBalancerCallbacks(None)
+    host = hosts[0]
+    runs = [
+        ('ids', lambda: callbacks.get_ready_devices(ctx, host)),
+        ('revisions', lambda: callbacks.get_ready_devices(
+            ctx, host, with_revisions=True)),
+        ('revisions paged', lambda: list_paged(callbacks, ctx, host)),
+    ]
+    print('%-20s %8s %10s' % ('one agent', 'pools', 'ms'))
+    for name, func in runs:
+        elapsed, result = timed(func)
+        print('%-20s %8d %10.1f' % (name, len(result), elapsed * 1000))
+
+    start = time.time()
+    listed = sum(len(list_paged(callbacks, ctx, host)) for host in hosts)
+    elapsed = time.time() - start
+    if listed != pools:
+        raise AssertionError('%d pools listed out of %d' % (listed, pools))
+    print('all %d agents: %.1fs, %.1fms per agent' %
+          (agents, elapsed, elapsed * 1000 / agents))
+    print('peak rss %d MB' %
+          (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024))
+
+
+if __name__ == '__main__':
+    main()
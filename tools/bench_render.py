@@ -0,0 +1,71 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2014 Neusoft Corporation (Neusoft)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+# @author: Paul Yang, Neusoft
+
+"""Time the rendering of the SEnginx configuration of large pools.
+
+Usage: python tools/bench_render.py [repeat]
+
+Each pool size is rendered for every vip protocol, the best of the runs is
+reported with the size of the output. The output is checked to hold one
+server per member, the exact output is covered by the golden files of
+senginx/tests/test_cfg.py.
+"""
+
+import sys
+import time
+
+from oslo.config import cfg
+
+from neutron.services.loadbalancer.drivers.senginx import agent_manager
+from neutron.services.loadbalancer.drivers.senginx import cfg as secfg
+from neutron.services.loadbalancer.drivers.senginx.tests import test_cfg
+
+MEMBER_COUNTS = (10, 1000, 50000)
+PROTOCOLS = ('HTTP', 'TCP')
+
+
+def bench(protocol, members, repeat):
+    config = test_cfg.make_config(protocol, 'ROUND_ROBIN', 'HTTP', members)
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        data = secfg.render_config(config, test_cfg.STATE_DIR)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    servers = data.count('\n        server 10.')
+    if servers != members:
+        raise AssertionError('%d servers rendered for %d members' %
+                             (servers, members))
+    return best, len(data)
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    cfg.CONF.register_opts(agent_manager.OPTS)
+
+    print('%-6s %8s %10s %10s' % ('proto', 'members', 'ms', 'bytes'))
+    for protocol in PROTOCOLS:
+        for members in MEMBER_COUNTS:
+            elapsed, size = bench(protocol, members, repeat)
+            print('%-6s %8d %10.2f %10d' % (protocol, members,
+                                            elapsed * 1000, size))
+
+
+if __name__ == '__main__':
+    main()